@@ -0,0 +1,102 @@
+"""
+Compares the evaluation time of constraint trees with their compiled form.
+
+    python3 -m benchmarks.constraints --leaves 8 --repeat 100000
+
+The benchmark builds a routing constraint that ORs --leaves projects, a
+long chain that repeats identical constraints and a deeply nested tree
+with double negations and reports the time per evaluation for both
+variants.
+"""
+
+import argparse
+import sys
+import timeit
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pipedput.constraints import (
+    AbstractConstraint,
+    compile_constraint,
+    IsProject,
+    IsTag,
+    WasPipelineStartedFromUI,
+    WasSuccessful,
+)
+
+EVENT = {
+    "object_attributes": {"status": "success", "tag": True, "source": "push"},
+    "project": {"path_with_namespace": "benchmark/project-0"},
+}
+
+
+def _chain(constraints: Sequence[AbstractConstraint], operator: str):
+    result = constraints[0]
+    for constraint in constraints[1:]:
+        result = result & constraint if operator == "&" else result | constraint
+    return result
+
+
+def create_trees(leaves: int) -> Dict[str, AbstractConstraint]:
+    # none of the projects match, so every operand of the chain is evaluated
+    projects = _chain([IsProject(f"benchmark/other-{i}") for i in range(leaves)], "|")
+    nested = WasSuccessful()
+    for _ in range(leaves):
+        nested = ~~(nested & ~~IsTag())
+    return {
+        "routing": WasSuccessful() & IsTag() & (projects | ~WasPipelineStartedFromUI()),
+        "duplicates": _chain([IsTag(), WasSuccessful()] * leaves, "&"),
+        "nested": nested,
+    }
+
+
+def run(leaves: int, repeat: int) -> List[Tuple[str, Optional[float], float]]:
+    results = []
+    for name, tree in create_trees(leaves).items():
+        compiled_tree = compile_constraint(tree)
+        assert compiled_tree is not None
+        recursive_s: Optional[float] = None
+        try:
+            assert bool(compiled_tree(EVENT)) == bool(tree(EVENT))
+        except RecursionError:
+            # large trees can’t be evaluated recursively at all
+            pass
+        else:
+            recursive_s = min(
+                timeit.repeat(lambda: tree(EVENT), number=repeat, repeat=3)
+            )
+        compiled_s = min(
+            timeit.repeat(lambda: compiled_tree(EVENT), number=repeat, repeat=3)
+        )
+        results.append(
+            (
+                name,
+                recursive_s / repeat if recursive_s is not None else None,
+                compiled_s / repeat,
+            )
+        )
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--leaves", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    for name, recursive_s, compiled_s in run(args.leaves, args.repeat):
+        if recursive_s is None:
+            print(
+                f"{name:>12}: recursive exceeds the recursion limit  "
+                f"compiled {compiled_s * 1e9:8.0f}ns"
+            )
+            continue
+        print(
+            f"{name:>12}: recursive {recursive_s * 1e9:8.0f}ns  "
+            f"compiled {compiled_s * 1e9:8.0f}ns  "
+            f"({recursive_s / compiled_s:.1f}x)"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
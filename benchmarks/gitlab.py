@@ -0,0 +1,161 @@
+"""
+A local GitLab stand-in that serves synthetic pipeline artifacts.
+"""
+
+from contextlib import contextmanager
+import datetime
+from http.server import ThreadingHTTPServer
+import itertools
+import os
+import random
+import threading
+from typing import Dict, Iterator, List, Optional
+import zipfile
+
+from pipedput.typing import GitLabPipelineEvent
+from tests.utils import MockGitLabServer, start_gitlab_mock_server
+
+_ids = itertools.count(1)
+_ids_lock = threading.Lock()
+
+
+def _next_id() -> int:
+    with _ids_lock:
+        return next(_ids)
+
+
+def create_artifact_zip(
+    path: str,
+    file_count: int = 10,
+    file_size: int = 64 * 1024,
+    suffix: str = ".bin",
+    compressible: bool = False,
+) -> str:
+    """
+    Creates an artifact archive with file_count files of file_size bytes.
+    Incompressible random data is used unless compressible is set.
+    """
+    rng = random.Random(file_count * file_size)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for index in range(file_count):
+            if compressible:
+                data = b"a" * file_size
+            else:
+                data = rng.getrandbits(file_size * 8).to_bytes(file_size, "little")
+            directory = f"dist/{index % 8}"
+            archive.writestr(f"{directory}/file-{index}{suffix}", data)
+    return path
+
+
+class SyntheticGitLabServer(MockGitLabServer):
+    """Serves the artifact archives that have been registered with register_artifact."""
+
+    ARTIFACTS: Dict[int, str] = {}
+
+    @contextmanager
+    def _find_artifact(self, build_id):
+        try:
+            artifact_path = self.ARTIFACTS[build_id]
+        except KeyError:
+            raise FileNotFoundError("No artifact found for build id") from None
+        with open(artifact_path, "rb") as artifact:
+            yield artifact
+
+    def _handle_artifact(self, match):
+        with self._find_artifact(int(match.group("build_id"))) as artifact:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", self._size(artifact))
+            self.end_headers()
+            while True:
+                chunk = artifact.read(1024 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+
+class GitLabStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = start_gitlab_mock_server(
+            handler_class=SyntheticGitLabServer,
+            address=(host, port),
+            server_class=ThreadingHTTPServer,
+        )
+        host, port = self._server.server_address[:2]
+        self.web_url = f"http://{host}:{port}"
+
+    def register_artifact(self, build_id: int, artifact_path: str):
+        SyntheticGitLabServer.ARTIFACTS[build_id] = artifact_path
+
+    def create_event(
+        self,
+        artifact_paths: List[str],
+        project_path: str = "benchmark/project",
+        tag: bool = True,
+        ref: Optional[str] = None,
+        status: str = "success",
+    ) -> GitLabPipelineEvent:
+        """creates a pipeline event with one build per artifact archive"""
+        pipeline_id = _next_id()
+        now = datetime.datetime.now().isoformat()
+        builds = []
+        for artifact_path in artifact_paths:
+            build_id = _next_id()
+            self.register_artifact(build_id, artifact_path)
+            builds.append(
+                {
+                    "id": build_id,
+                    "stage": "build",
+                    "name": f"build-{build_id}",
+                    "status": "success",
+                    "manual": False,
+                    "artifacts_file": {
+                        "filename": os.path.basename(artifact_path),
+                        "size": os.stat(artifact_path).st_size,
+                    },
+                }
+            )
+        sha = f"{pipeline_id:040x}"
+        return {  # type: ignore
+            "object_kind": "pipeline",
+            "object_attributes": {
+                "id": pipeline_id,
+                "ref": ref or ("v1.0.0" if tag else "main"),
+                "tag": tag,
+                "sha": sha,
+                "source": "push",
+                "status": status,
+                "finished_at": now,
+            },
+            "user": {
+                "id": 1,
+                "name": "Benchmark",
+                "username": "benchmark",
+                "email": "benchmark@localhost",
+            },
+            "project": {
+                "id": 1,
+                "name": project_path.split("/")[-1],
+                "web_url": f"{self.web_url}/{project_path}",
+                "git_http_url": f"{self.web_url}/{project_path}.git",
+                "path_with_namespace": project_path,
+                "default_branch": "main",
+            },
+            "commit": {
+                "id": sha,
+                "author": {"name": "Benchmark", "email": "benchmark@localhost"},
+            },
+            "builds": builds,
+        }
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def iter_events(
+    gitlab: GitLabStandIn, artifact_paths: List[str], projects: List[str]
+) -> Iterator[GitLabPipelineEvent]:
+    """endlessly yields events that cycle through the given projects"""
+    for project_path in itertools.cycle(projects):
+        yield gitlab.create_event(artifact_paths, project_path=project_path)
@@ -0,0 +1,358 @@
+"""
+Drives the pipedput web-hook endpoint with synthetic pipeline events.
+
+    python3 -m benchmarks.load --events 200 --rate 20 --files 50 --file-size 65536
+
+Artifacts are served by a local GitLab stand-in. The report contains the
+accept latency of the web-hook endpoint, the end-to-end deployment latency,
+the time of the download, extract, glob and hook stages and the peak RSS of
+the process.
+
+    python3 -m benchmarks.load --events 20 --stage-rss
+
+--stage-rss processes the events one after another and measures the peak
+RSS of every stage: the high-water mark of the process (VmHWM) is reset
+through /proc/self/clear_refs before a stage and read after it, so this
+only works on Linux. The report also contains the largest growth of the
+RSS during a stage. The thresholds are checked in this mode as well, but
+its latencies aren’t comparable with those of concurrent runs.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from benchmarks.gitlab import create_artifact_zip, GitLabStandIn, iter_events
+from pipedput.hooks import GenericGlobHook
+
+CONFIG_TEMPLATE = """
+from benchmarks.load import BenchmarkHook
+from pipedput.conf import Project
+
+TESTING = True
+MAIL_SUPPRESS_SEND = True
+CONFIG_RELOAD_INTERVAL = None
+SCHEDULER_WORKERS = {workers}
+ASYNC_ENGINE = {async_engine}
+ASYNC_ENGINE_CONCURRENCY = {workers}
+PROJECTS = [
+    Project(key, BenchmarkHook(), max_concurrent_runs={max_concurrent_runs})
+    for key in {project_keys!r}
+]
+"""
+
+
+class BenchmarkHook(GenericGlobHook):
+    """Reads every matching file, which is roughly what an upload does."""
+
+    DEFAULT_NAME = "benchmark"
+    GLOB_PATTERN = "**/*.bin"
+
+    def _handle_artifact(self, event, artifact_path, artifact_name, **kwargs):
+        digest = hashlib.sha256()
+        with open(artifact_path, "rb") as artifact:
+            for chunk in iter(functools.partial(artifact.read, 1024 * 1024), b""):
+                digest.update(chunk)
+        yield self._success(asset=artifact_name, notify=False)
+
+
+def _max_rss_kib() -> int:
+    # the high-water mark of the whole process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss() -> None:
+    # 5 resets the peak resident set size to the current one
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+
+def _read_status_kib(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} is missing from /proc/self/status.")
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+@dataclasses.dataclass()
+class StageStats:
+    durations: List[float] = dataclasses.field(default_factory=list)
+    peak_rss_kib: Optional[int] = None
+    # the largest growth of the RSS during a call of the stage
+    rss_growth_kib: Optional[int] = None
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "count": len(self.durations),
+            "p50_ms": percentile(self.durations, 50) * 1000,
+            "p99_ms": percentile(self.durations, 99) * 1000,
+            "total_s": sum(self.durations),
+        }
+        if self.peak_rss_kib is not None:
+            summary["peak_rss_mib"] = self.peak_rss_kib / 1024
+            summary["rss_growth_mib"] = (self.rss_growth_kib or 0) / 1024
+        return summary
+
+
+class StageRecorder:
+    def __init__(self, measure_rss: bool = False) -> None:
+        """
+        :param measure_rss: measure the peak RSS of every stage, which is only
+            correct if stages run one after another
+        """
+        self.measure_rss = measure_rss
+        self._lock = threading.Lock()
+        self.stages: Dict[str, StageStats] = {}
+
+    def record(
+        self,
+        stage: str,
+        duration: float,
+        start_rss_kib: Optional[int] = None,
+        peak_rss_kib: Optional[int] = None,
+    ):
+        with self._lock:
+            stats = self.stages.setdefault(stage, StageStats())
+            stats.durations.append(duration)
+            if start_rss_kib is not None and peak_rss_kib is not None:
+                stats.peak_rss_kib = max(stats.peak_rss_kib or 0, peak_rss_kib)
+                stats.rss_growth_kib = max(
+                    stats.rss_growth_kib or 0, peak_rss_kib - start_rss_kib
+                )
+
+    def wrap(self, stage: str, func: Callable, consume: bool = False) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_rss_kib = None
+            if self.measure_rss:
+                _reset_peak_rss()
+                start_rss_kib = _read_status_kib("VmRSS")
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                if consume:
+                    result = list(result)
+                return result
+            finally:
+                duration = time.perf_counter() - start
+                peak_rss_kib = None
+                if self.measure_rss:
+                    peak_rss_kib = _read_status_kib("VmHWM")
+                self.record(stage, duration, start_rss_kib, peak_rss_kib)
+
+        return wrapper
+
+
+def _instrument(recorder: StageRecorder, completed: Dict[int, float]):
+    # the config file imports this module by name, which differs from __main__
+    from benchmarks.load import BenchmarkHook
+    from pipedput import aio, handler
+
+    for module in (handler, aio):
+        module.download_file = recorder.wrap(  # type: ignore
+            "download", module.download_file
+        )
+        module.unzip = recorder.wrap("extract", module.unzip)  # type: ignore
+    BenchmarkHook._glob = recorder.wrap(  # type: ignore
+        "glob", BenchmarkHook._glob, consume=True
+    )
+    BenchmarkHook._handle_artifact = recorder.wrap(  # type: ignore
+        "hook", BenchmarkHook._handle_artifact, consume=True
+    )
+
+    def track_completion(func):
+        @functools.wraps(func)
+        def wrapper(project, event, *args):
+            try:
+                return func(project, event, *args)
+            finally:
+                completed[event["object_attributes"]["id"]] = time.perf_counter()
+
+        return wrapper
+
+    for module in (handler, aio):
+        module._report_deployments = track_completion(  # type: ignore
+            module._report_deployments
+        )
+        module._report_error = track_completion(module._report_error)  # type: ignore
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    work_dir = tempfile.mkdtemp(prefix="pipedput-benchmark-")
+    artifact_paths = [
+        create_artifact_zip(
+            os.path.join(work_dir, f"artifacts-{index}.zip"),
+            file_count=args.files,
+            file_size=args.file_size,
+            compressible=args.compressible,
+        )
+        for index in range(args.artifacts)
+    ]
+    project_keys = [f"project-{index}" for index in range(args.projects)]
+    config_file = os.path.join(work_dir, "config.py")
+    with open(config_file, "w") as config:
+        config.write(
+            CONFIG_TEMPLATE.format(
+                workers=args.workers,
+                async_engine=args.async_engine,
+                max_concurrent_runs=args.max_concurrent_runs,
+                project_keys=project_keys,
+            )
+        )
+    os.environ["PIPEDPUT_CONFIG_FILE"] = config_file
+    from pipedput.app import app
+
+    gitlab = GitLabStandIn()
+    recorder = StageRecorder(measure_rss=args.stage_rss)
+    accepted: Dict[int, float] = {}
+    completed: Dict[int, float] = {}
+    accept_latencies: List[float] = []
+    _instrument(recorder, completed)
+    events = iter_events(
+        gitlab, artifact_paths, [f"benchmark/{key}" for key in project_keys]
+    )
+    client_local = threading.local()
+
+    def post(event):
+        client = getattr(client_local, "client", None)
+        if client is None:
+            client = client_local.client = app.test_client()
+        key = event["project"]["name"]
+        start = time.perf_counter()
+        accepted[event["object_attributes"]["id"]] = start
+        response = client.post(f"/api/projects/{key}/publish", json=event)
+        accept_latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"Event was rejected: {response.status_code}")
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as clients:
+        futures = []
+        for index in range(args.events):
+            delay = started_at + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(clients.submit(post, next(events)))
+        for future in futures:
+            future.result()
+    deadline = time.perf_counter() + args.timeout
+    while len(completed) < len(accepted) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    duration = time.perf_counter() - started_at
+    gitlab.shutdown()
+
+    end_to_end = [
+        completed[pipeline_id] - accepted_at
+        for pipeline_id, accepted_at in accepted.items()
+        if pipeline_id in completed
+    ]
+    return {
+        "events": args.events,
+        "completed": len(end_to_end),
+        "duration_s": duration,
+        "throughput_per_s": len(end_to_end) / duration,
+        "accept": {
+            "p50_ms": percentile(accept_latencies, 50) * 1000,
+            "p99_ms": percentile(accept_latencies, 99) * 1000,
+        },
+        "end_to_end": {
+            "p50_ms": percentile(end_to_end, 50) * 1000,
+            "p99_ms": percentile(end_to_end, 99) * 1000,
+        },
+        "stages": {stage: stats.summary() for stage, stats in recorder.stages.items()},
+        "peak_rss_mib": _max_rss_kib() / 1024,
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    print(
+        f"{report['completed']}/{report['events']} events in "
+        f"{report['duration_s']:.2f}s ({report['throughput_per_s']:.1f}/s), "
+        f"peak RSS {report['peak_rss_mib']:.1f}MiB"
+    )
+    for name in ("accept", "end_to_end"):
+        latency = report[name]
+        print(
+            f"{name:>12}: p50 {latency['p50_ms']:8.2f}ms  p99 {latency['p99_ms']:8.2f}ms"
+        )
+    for stage, stats in report["stages"].items():
+        peak_rss = ""
+        if "peak_rss_mib" in stats:
+            peak_rss = (
+                f"peak RSS {stats['peak_rss_mib']:.1f}MiB "
+                f"(+{stats['rss_growth_mib']:.1f}MiB)  "
+            )
+        print(
+            f"{stage:>12}: p50 {stats['p50_ms']:8.2f}ms  p99 {stats['p99_ms']:8.2f}ms  "
+            f"{peak_rss}({stats['count']} calls)"
+        )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=20, help="events per second")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--projects", type=int, default=4)
+    parser.add_argument("--artifacts", type=int, default=1, help="per event")
+    parser.add_argument("--files", type=int, default=20, help="per artifact")
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--compressible", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-concurrent-runs", type=int, default=1)
+    parser.add_argument("--async-engine", action="store_true")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--stage-rss",
+        action="store_true",
+        help="process events one after another and measure the peak RSS of stages",
+    )
+    parser.add_argument("--json", dest="json_file", default=None)
+    parser.add_argument("--max-accept-p99-ms", type=float, default=None)
+    parser.add_argument("--max-end-to-end-p99-ms", type=float, default=None)
+    args = parser.parse_args(argv)
+    if args.stage_rss:
+        if args.async_engine:
+            parser.error("--stage-rss can’t be combined with --async-engine")
+        # every event is processed in the request that delivers it
+        args.workers = 0
+        args.clients = 1
+
+    report = run(args)
+    print_report(report)
+    if args.json_file:
+        with open(args.json_file, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+
+    failed = report["completed"] < report["events"]
+    for name, threshold in (
+        ("accept", args.max_accept_p99_ms),
+        ("end_to_end", args.max_end_to_end_p99_ms),
+    ):
+        if threshold is not None and report[name]["p99_ms"] > threshold:
+            print(f"{name} p99 exceeds threshold of {threshold:.1f}ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Measures the import time of the WSGI entry point with `python -X importtime`.
+
+    PIPEDPUT_CONFIG_FILE=/path/to/config.py python3 -m benchmarks.startup
+
+The process exits with a non-zero status if the import takes longer than
+the configured budget or if one of the lazily loaded modules is imported
+during startup.
+"""
+
+import argparse
+import dataclasses
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_MODULE = "pipedput.app"
+DEFAULT_BUDGET_MS = float(os.environ.get("PIPEDPUT_STARTUP_BUDGET_MS", 1000))
+# These modules must only be imported when they are actually needed.
+LAZY_MODULES = ("flask_mail", "html2text", "sentry_sdk")
+
+_IMPORT_TIME_PATTERN = re.compile(
+    r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<name>.+)$"
+)
+
+
+@dataclasses.dataclass()
+class ImportTime:
+    name: str
+    self_us: int
+    cumulative_us: int
+
+
+@dataclasses.dataclass()
+class StartupReport:
+    module: str
+    imports: Dict[str, ImportTime]
+
+    @property
+    def total_ms(self) -> float:
+        return self.imports[self.module].cumulative_us / 1000
+
+    def slowest(self, count: int = 10) -> List[ImportTime]:
+        imports = sorted(self.imports.values(), key=lambda i: i.self_us)
+        return imports[::-1][:count]
+
+    def imported_lazy_modules(self, lazy_modules: Sequence[str] = LAZY_MODULES):
+        return [name for name in lazy_modules if name in self.imports]
+
+
+def measure(
+    module: str = DEFAULT_MODULE, config_file: Optional[str] = None
+) -> StartupReport:
+    env = dict(os.environ)
+    if config_file is not None:
+        env["PIPEDPUT_CONFIG_FILE"] = config_file
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    imports = {}
+    for line in process.stderr.decode().splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        name = match.group("name").strip()
+        imports[name] = ImportTime(
+            name, int(match.group("self")), int(match.group("cumulative"))
+        )
+    return StartupReport(module, imports)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default=DEFAULT_MODULE)
+    parser.add_argument("--config-file", default=None)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    reports = [measure(args.module, args.config_file) for _ in range(args.runs)]
+    best = min(reports, key=lambda report: report.total_ms)
+    print(f"import {args.module}: {best.total_ms:.1f}ms (best of {args.runs})")
+    print("slowest modules (self time):")
+    for import_time in best.slowest():
+        print(f"  {import_time.self_us / 1000:8.1f}ms  {import_time.name}")
+
+    failed = False
+    lazy_modules = best.imported_lazy_modules()
+    if lazy_modules:
+        print(f"modules imported during startup: {', '.join(lazy_modules)}")
+        failed = True
+    if best.total_ms > args.budget_ms:
+        print(f"startup exceeds budget of {args.budget_ms:.1f}ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
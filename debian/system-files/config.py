@@ -28,6 +28,21 @@ MAIL_USERNAME = "pipedput@mail.example.org"
 MAIL_PASSWORD = "abc123"
 MAIL_DEFAULT_SENDER = "pipedput@mail.example.org"
 
+# Number of pipeline events that are processed in parallel.
+# Events of the same project are always processed one after another.
+SCHEDULER_WORKERS = 4
+
+# Artifacts are extracted below this directory. Make sure it’s large
+# enough for the extracted artifacts of all concurrently processed events.
+WORKSPACE_ROOT = "/var/lib/pipedput/workspaces"
+
+# Pending mail digests are kept in this database across restarts.
+MAIL_DIGEST_DB = "/var/lib/pipedput/digests.sqlite3"
+
+# Events waiting for processing are tracked in this database if
+# ADMISSION_CONTROL is enabled.
+ADMISSION_DB = "/var/lib/pipedput/admission.sqlite3"
+
 # You can define any type of variables like you would
 # in any other python file!
 pipeline_token = "my_secret_pipeline_token"
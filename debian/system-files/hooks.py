@@ -1,5 +1,3 @@
-import shutil
-
 from pipedput.constraints import AbstractConstraint
 from pipedput.hooks import GenericGlobHook
 from pipedput.typing import GitLabPipelineEvent
@@ -31,7 +29,8 @@ class BackupJPEGs(GenericGlobHook):
         **kwargs,
     ):
         try:
-            shutil.copy(artifact_path, self.BACKUP_DIR)
+            # hardlinks, reflinks or copies the file, whichever is cheapest
+            self._publish(artifact_path, self.BACKUP_DIR)
         except PermissionError:
             yield self._error(asset=artifact_name)
         else:
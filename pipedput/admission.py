@@ -0,0 +1,206 @@
+"""
+Admission control for the web-hook endpoint.
+
+Every accepted pipeline event is recorded with a ticket in an SQLite
+database that is shared by the web workers and the mules of a node. The
+ticket is carried with the event and marked as started once the event is
+processed and removed once it has been processed. The waiting tickets show
+how many events are queued and how long the oldest one has been waiting.
+
+If too many events are waiting, older events of pipelines that have sent a
+newer event since are dropped first, because only the latest state of a
+pipeline matters. If that isn’t enough, new events are rejected with
+429 Too Many Requests. Events of branch pipelines are also rejected with
+503 Service Unavailable if the oldest event has waited for too long. Part
+of the queue is reserved for tag pipelines, so releases are accepted while
+branch pipelines are rejected.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import logging
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+from pipedput.typing import GitLabPipelineEvent
+from pipedput.utils import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    project_key TEXT NOT NULL,
+    pipeline_id INTEGER,
+    is_tag INTEGER NOT NULL,
+    admitted_at REAL NOT NULL,
+    started_at REAL,
+    dropped INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tickets_waiting ON tickets (started_at, dropped, admitted_at);
+CREATE INDEX IF NOT EXISTS tickets_pipeline ON tickets (project_key, pipeline_id);
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class AdmissionControl:
+    """Limits the pipeline events that are waiting to be processed."""
+
+    # events that may wait at once
+    max_pending: int = 1000
+    # seconds the oldest event may wait before branch pipelines are rejected
+    max_age: Optional[float] = 900
+    # part of max_pending that only tag pipelines may use
+    reserved_for_tags: int = 100
+    # seconds GitLab is asked to wait before it sends a rejected event again
+    retry_after: int = 60
+    # seconds after which tickets of events that were lost, e.g. because
+    # their process crashed, no longer count
+    ticket_timeout: float = 3 * 3600
+
+
+@dataclasses.dataclass(frozen=True)
+class Decision:
+    ticket: Optional[int] = None
+    # the HTTP status code of a rejection
+    status: Optional[int] = None
+    reason: Optional[str] = None
+    dropped: int = 0
+
+    @property
+    def was_admitted(self) -> bool:
+        return self.ticket is not None
+
+
+def is_tag_pipeline(event: GitLabPipelineEvent) -> bool:
+    return event.get("object_attributes", {}).get("tag", False) is True
+
+
+class AdmissionStore:
+    def __init__(self, path: str) -> None:
+        """
+        :param path: the path of the SQLite database
+        """
+        self.path = path
+        self._database = SQLiteDatabase(path, _SCHEMA)
+
+    def _count_waiting(self, connection: sqlite3.Connection):
+        return connection.execute(
+            "SELECT COUNT(*), MIN(admitted_at) FROM tickets "
+            "WHERE started_at IS NULL AND dropped = 0"
+        ).fetchone()
+
+    def admit(
+        self,
+        control: AdmissionControl,
+        project_key: str,
+        event: GitLabPipelineEvent,
+        queued_elsewhere: int = 0,
+        now: Optional[float] = None,
+    ) -> Decision:
+        """
+        Decides whether an event is admitted and returns the ticket of an
+        admitted event.
+
+        :param queued_elsewhere:
+            events that are waiting in other queues, e.g. the work queue
+        """
+        now = time.time() if now is None else now
+        pipeline_id = event.get("object_attributes", {}).get("id", None)
+        is_tag = is_tag_pipeline(event)
+        limit = control.max_pending
+        if not is_tag:
+            limit -= control.reserved_for_tags
+        connection = self._database.connection
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "DELETE FROM tickets WHERE admitted_at < ?",
+                (now - control.ticket_timeout,),
+            )
+            waiting, oldest = self._count_waiting(connection)
+            dropped = 0
+            if waiting + queued_elsewhere >= limit:
+                # the event supersedes the waiting events of its pipeline,
+                # other pipelines keep only their newest waiting event
+                dropped = connection.execute(
+                    "UPDATE tickets SET dropped = 1 "
+                    "WHERE started_at IS NULL AND dropped = 0 AND ("
+                    "  (project_key = ? AND pipeline_id = ?) OR id NOT IN ("
+                    "    SELECT MAX(id) FROM tickets"
+                    "    WHERE started_at IS NULL AND dropped = 0"
+                    "    GROUP BY project_key, pipeline_id"
+                    "  )"
+                    ")",
+                    (project_key, pipeline_id),
+                ).rowcount
+                waiting, oldest = self._count_waiting(connection)
+            if waiting + queued_elsewhere >= limit:
+                return Decision(
+                    status=429,
+                    reason=f"{waiting + queued_elsewhere} events are waiting.",
+                    dropped=dropped,
+                )
+            if (
+                not is_tag
+                and control.max_age is not None
+                and oldest is not None
+                and now - oldest > control.max_age
+            ):
+                return Decision(
+                    status=503,
+                    reason=f"Events have been waiting for {now - oldest:.0f}s.",
+                    dropped=dropped,
+                )
+            ticket = connection.execute(
+                "INSERT INTO tickets "
+                "(project_key, pipeline_id, is_tag, admitted_at) VALUES (?, ?, ?, ?)",
+                (project_key, pipeline_id, is_tag, now),
+            ).lastrowid
+        return Decision(ticket=ticket, dropped=dropped)
+
+    def start(self, ticket: int, now: Optional[float] = None) -> bool:
+        """
+        Marks the event of a ticket as started. Returns False if the event
+        has been dropped because it has been superseded.
+        """
+        now = time.time() if now is None else now
+        with self._database.connection as connection:
+            connection.execute(
+                "UPDATE tickets SET started_at = ? WHERE id = ? AND dropped = 0",
+                (now, ticket),
+            )
+            row = connection.execute(
+                "SELECT dropped FROM tickets WHERE id = ?", (ticket,)
+            ).fetchone()
+        # tickets that timed out have been removed, their events still run
+        return row is None or not row[0]
+
+    def finish(self, ticket: int) -> None:
+        with self._database.connection as connection:
+            connection.execute("DELETE FROM tickets WHERE id = ?", (ticket,))
+
+    def count_waiting(self) -> int:
+        return self._count_waiting(self._database.connection)[0]
+
+
+_ticket: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "pipedput_admission_ticket", default=None
+)
+
+
+def get_ticket() -> Optional[int]:
+    """returns the admission ticket of the event that is currently processed"""
+    return _ticket.get()
+
+
+@contextlib.contextmanager
+def ticket_context(ticket: Optional[int]) -> Iterator[None]:
+    """carries an admission ticket into the scheduler with the event"""
+    token = _ticket.set(ticket)
+    try:
+        yield
+    finally:
+        _ticket.reset(token)
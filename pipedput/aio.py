@@ -0,0 +1,335 @@
+"""
+An optional asyncio-based processing engine.
+
+The engine processes many pipeline events concurrently in a single
+process. Blocking work (downloads, constraints that call the GitLab API,
+synchronous hooks and mail delivery) runs in a thread pool, while hooks
+derived from AsyncHook are awaited directly on the event loop and may use
+run_command to spawn subprocesses without blocking it.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import logging
+import os
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+import weakref
+
+from pipedput import locks, process, tracing
+from pipedput.handler import (
+    _extraction_error,
+    _finish_admitted_event,
+    _get_artifacts,
+    _get_extraction_limits,
+    _report_deployments,
+    _report_error,
+    _start_admitted_event,
+    get_workspace_manager,
+    Project,
+)
+from pipedput.hooks import Hook
+from pipedput.instrumentation import stage
+from pipedput.log import log_context
+from pipedput.process import ProcessLimits, ProcessResult
+from pipedput.typing import DeploymentStateLike, GitLabPipelineEvent, HookLike
+from pipedput.utils import download_file, ExtractionLimits, unzip
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+
+def _run_checked(
+    cmd: Sequence[str], limits: ProcessLimits, check: bool, cwd: Optional[str]
+) -> ProcessResult:
+    locks.check_leases()
+    return process.run(cmd, limits=limits, check=check, cwd=cwd)
+
+
+async def run_command(
+    cmd: Sequence[str],
+    check: bool = False,
+    timeout: Optional[float] = None,
+    limits: Optional[ProcessLimits] = None,
+    cwd: Optional[str] = None,
+) -> ProcessResult:
+    """
+    Runs a command with pipedput.process.run in a thread of the default
+    executor of the event loop, so the loop isn’t blocked. The command gets
+    the same process group, limits and measurements as the commands of
+    synchronous hooks.
+
+    :param timeout: overrides the timeout of limits
+    :raises pipedput.locks.LockLost:
+        if a lock held by the task has been taken over by another holder
+    """
+    limits = limits or ProcessLimits()
+    if timeout is not None:
+        limits = dataclasses.replace(limits, timeout=timeout)
+    loop = asyncio.get_running_loop()
+    # the thread needs the leases and the trace context of the task
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        None, functools.partial(context.run, _run_checked, cmd, limits, check, cwd)
+    )
+
+
+@contextlib.asynccontextmanager
+async def _unlocked() -> AsyncIterator[None]:
+    yield
+
+
+class AsyncHook(Hook):
+    """
+    Base class for hooks that are executed on the event loop of the AsyncEngine.
+    When used with the synchronous engine, the hook runs in its own event loop.
+    """
+
+    async def _execute_async(
+        self, event: GitLabPipelineEvent, artifacts_directory: str
+    ) -> AsyncIterator[DeploymentStateLike]:
+        raise NotImplementedError()
+        yield  # pragma: no cover
+
+    async def _run_async(
+        self, cmd: Sequence[str], check: bool = True, cwd: Optional[str] = None
+    ) -> ProcessResult:
+        """runs an external command within the process limits of the hook"""
+        return await run_command(cmd, check, limits=self._process_limits, cwd=cwd)
+
+    def _lock_async(self, event: GitLabPipelineEvent):
+        lock_key = self.get_lock_key(event)
+        if lock_key is None:
+            return _unlocked()
+        return locks.hold_async(lock_key)
+
+    async def _call_async(
+        self, event: GitLabPipelineEvent, artifacts_directory: str
+    ) -> List[DeploymentStateLike]:
+        deployments = []
+        try:
+            async for deployment in self._execute_async(event, artifacts_directory):
+                deployments.append(deployment)
+        except Exception as exc:
+            deployments.append(self._error(exc=exc))
+        return deployments
+
+    async def call_async(
+        self, event: GitLabPipelineEvent, artifacts_directory: str
+    ) -> List[DeploymentStateLike]:
+        try:
+            async with self._lock_async(event):
+                return await self._call_async(event, artifacts_directory)
+        except Exception as exc:
+            return [self._error(exc=exc)]
+
+    def _execute(self, event: GitLabPipelineEvent, artifacts_directory: str):
+        # Hook.__call__ already holds the lock
+        yield from asyncio.run(self._call_async(event, artifacts_directory))
+
+
+class AsyncEngine:
+    """Processes pipeline events concurrently on an asyncio event loop."""
+
+    DEFAULT_CONCURRENCY = 16
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ) -> None:
+        """
+        :param concurrency: the maximum number of events that are processed at once
+        :param executor: the executor used for blocking operations
+        """
+        self._concurrency = concurrency
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="pipedput-engine"
+        )
+        self._semaphores: MutableMapping[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def _run_blocking(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        # executor threads don’t inherit the log context of the task
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(context.run, func, *args)
+        )
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # semaphores are bound to the loop they are used in
+        loop = asyncio.get_running_loop()
+        try:
+            return self._semaphores[loop]
+        except KeyError:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self._concurrency)
+            return semaphore
+
+    async def _should_execute(self, hook: HookLike, event: GitLabPipelineEvent):
+        return await self._run_blocking(hook.should_execute_for, event)
+
+    async def _call_hook(
+        self, hook: HookLike, event: GitLabPipelineEvent, artifacts_directory: str
+    ) -> List[DeploymentStateLike]:
+        if isinstance(hook, AsyncHook):
+            if not await self._should_execute(hook, event):
+                return []
+            return await hook.call_async(event, artifacts_directory)
+        return await self._run_blocking(lambda: list(hook(event, artifacts_directory)))
+
+    async def _process_artifact(
+        self,
+        project: Project,
+        url: str,
+        event: GitLabPipelineEvent,
+        size: Optional[int] = None,
+    ) -> List[DeploymentStateLike]:
+        deployments = []
+        # waiting for free space must not block the event loop
+        workspace = await self._run_blocking(get_workspace_manager().acquire, size)
+        try:
+            artifact_file = os.path.join(workspace.path, "artifacts.zip")
+            artifact_dir = os.path.join(workspace.path, "data")
+            logger.info("Downloading artifact archive from '{}'.".format(url))
+            with stage("download", url=url):
+                await self._run_blocking(
+                    download_file, url, artifact_file, project.artifact_download_token
+                )
+            try:
+                with stage("extract", url=url):
+                    await self._run_blocking(
+                        unzip,
+                        artifact_file,
+                        artifact_dir,
+                        _get_extraction_limits(project),
+                    )
+            except ExtractionLimits.Exceeded as exc:
+                return [_extraction_error(url, exc)]
+            for hook in project.hooks:
+                with log_context(hook=hook.name), stage("hook", hook=hook.name):
+                    deployments.extend(await self._call_hook(hook, event, artifact_dir))
+        finally:
+            await self._run_blocking(workspace.close)
+        return deployments
+
+    async def _deploy(
+        self,
+        project: Project,
+        event: GitLabPipelineEvent,
+        deployments: List[DeploymentStateLike],
+    ) -> None:
+        """adds the deployments to the list as soon as an artifact is processed"""
+        with stage("constraints"):
+            should_execute = await asyncio.gather(
+                *(self._should_execute(hook, event) for hook in project.hooks)
+            )
+        if any(should_execute):
+            for artifact_url, artifact_size in _get_artifacts(event):
+                deployments.extend(
+                    await self._process_artifact(
+                        project, artifact_url, event, artifact_size
+                    )
+                )
+
+    @contextlib.asynccontextmanager
+    async def _trace(
+        self, project: Project, event: GitLabPipelineEvent
+    ) -> AsyncIterator[None]:
+        with tracing.span(
+            "process pipeline",
+            project_key=project.key,
+            pipeline_id=event["object_attributes"]["id"],
+        ):
+            yield
+
+    async def process(self, project: Project, event: GitLabPipelineEvent) -> None:
+        """processes a single pipeline event and sends the resulting report"""
+        try:
+            if await self._run_blocking(_start_admitted_event, event):
+                await self._process(project, event)
+        finally:
+            await self._run_blocking(_finish_admitted_event)
+
+    async def _process(self, project: Project, event: GitLabPipelineEvent) -> None:
+        async with self._get_semaphore(), self._trace(project, event):
+            deployments: List[DeploymentStateLike] = []
+            try:
+                await self._deploy(project, event, deployments)
+            except Exception as exc:
+                await self._run_blocking(
+                    _report_error, project, event, exc, deployments
+                )
+            else:
+                await self._run_blocking(
+                    _report_deployments, project, event, deployments
+                )
+
+    async def process_many(
+        self, events: Sequence[Tuple[Project, GitLabPipelineEvent]]
+    ) -> None:
+        """processes all events concurrently and returns once all of them are done"""
+        await asyncio.gather(
+            *(self.process(project, event) for project, event in events)
+        )
+
+    def start(self) -> None:
+        """starts an event loop in a background thread that accepts submitted events"""
+        if self._thread is not None:
+            return
+        loop = asyncio.new_event_loop()
+        # run_command uses the default executor
+        loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(
+            target=loop.run_forever, name="pipedput-engine-loop", daemon=True
+        )
+        self._loop = loop
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._loop is None or self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    def submit(
+        self, project: Project, event: GitLabPipelineEvent
+    ) -> concurrent.futures.Future:
+        """submits an event to the background event loop from any thread"""
+        self.start()
+        assert self._loop is not None
+        return asyncio.run_coroutine_threadsafe(
+            self.process(project, event), self._loop
+        )
+
+
+_engine: Optional[AsyncEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(concurrency: int = AsyncEngine.DEFAULT_CONCURRENCY) -> AsyncEngine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine(concurrency)
+        return _engine
@@ -1,44 +1,186 @@
 import os
-from typing import Optional
+import tempfile
+import threading
+import time
+from typing import Optional, TYPE_CHECKING
 
 from flask import Flask, request
-from flask_mail import Mail
 
-from pipedput import __version__
-from pipedput.handler import process_project_pipeline, Project
+from pipedput import __version__, locks, tracing
+from pipedput.admission import AdmissionStore, Decision
+from pipedput.auth import ProjectIndex
+from pipedput.event import PipelineEvent
+from pipedput.eventstore import EventStore
+from pipedput.handler import process_project_pipeline, Project, resume_digests
+from pipedput.log import log_context, new_correlation_id
+from pipedput.reload import ConfigReloader, ConfigSnapshot
+from pipedput.scheduler import classify
 from pipedput.typing import GitLabPipelineEvent
 
+if TYPE_CHECKING:
+    from flask_mail import Mail
+
 app = Flask("pipedput")
 config_file = os.environ.get("PIPEDPUT_CONFIG_FILE", None)
 if config_file is None:
     raise ImportError("please set the PIPEDPUT_CONFIG_FILE environment variable")
 if not os.path.isabs(config_file):
     raise ImportError("please provide an absolute path for the config file")
-app.config.from_pyfile(os.path.realpath(config_file))
-mail = Mail(app)
-
-SENTRY_DSN = app.config.get("SENTRY_DSN", None)
-if SENTRY_DSN:
-    import sentry_sdk
-    from sentry_sdk.integrations.flask import FlaskIntegration
-
-    sentry_sdk.init(  # type: ignore
-        dsn=SENTRY_DSN,
-        integrations=[FlaskIntegration()],
-        send_default_pii=True,
-        release=f"pipedput@v{__version__}",
+config_reloader = ConfigReloader(app, os.path.realpath(config_file))
+config_reloader.load()
+_mail: Optional["Mail"] = None
+_is_sentry_initialized = False
+_event_store: Optional[EventStore] = None
+_event_store_maintained_at = 0.0
+_admission_store: Optional[AdmissionStore] = None
+_admission_store_lock = threading.Lock()
+
+
+def get_mail() -> "Mail":
+    global _mail
+    if _mail is None:
+        from flask_mail import Mail
+
+        _mail = Mail(app)
+    return _mail
+
+
+def __getattr__(name: str):
+    # Flask-Mail is only imported once the first mail is sent.
+    if name == "mail":
+        return get_mail()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@config_reloader.add_listener
+def _reinit_mail(snapshot: ConfigSnapshot):
+    if _mail is not None:
+        _mail.state = _mail.init_app(app)
+
+
+def init_sentry():
+    """
+    Initializes Sentry once per process. Processes call this as soon as they
+    start, so that errors that are raised before the first request or
+    pipeline event are reported as well.
+    """
+    global _is_sentry_initialized
+    if _is_sentry_initialized:
+        return
+    _is_sentry_initialized = True
+    sentry_dsn = app.config.get("SENTRY_DSN", None)
+    if sentry_dsn:
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+
+        sentry_sdk.init(  # type: ignore
+            dsn=sentry_dsn,
+            integrations=[FlaskIntegration()],
+            send_default_pii=True,
+            release=f"pipedput@v{__version__}",
+        )
+
+
+def get_event_store() -> Optional[EventStore]:
+    global _event_store
+    directory = app.config.get("EVENT_STORE_DIR", None)
+    if not directory:
+        return None
+    if _event_store is None or _event_store.directory != directory:
+        _event_store = EventStore(
+            directory,
+            segment_size=app.config.get(
+                "EVENT_STORE_SEGMENT_SIZE", EventStore.DEFAULT_SEGMENT_SIZE
+            ),
+            max_size=app.config.get("EVENT_STORE_MAX_SIZE", None),
+            max_age=app.config.get("EVENT_STORE_MAX_AGE", None),
+            segment_max_age=app.config.get(
+                "EVENT_STORE_SEGMENT_MAX_AGE", EventStore.DEFAULT_SEGMENT_MAX_AGE
+            ),
+        )
+    return _event_store
+
+
+@config_reloader.add_listener
+def _reconfigure_event_store(snapshot: ConfigSnapshot):
+    if _event_store is not None:
+        _event_store.max_size = app.config.get("EVENT_STORE_MAX_SIZE", None)
+        _event_store.max_age = app.config.get("EVENT_STORE_MAX_AGE", None)
+        _event_store.segment_max_age = app.config.get(
+            "EVENT_STORE_SEGMENT_MAX_AGE", EventStore.DEFAULT_SEGMENT_MAX_AGE
+        )
+
+
+def get_admission_store() -> Optional[AdmissionStore]:
+    global _admission_store
+    if app.config.get("ADMISSION_CONTROL", None) is None:
+        return None
+    path = app.config.get("ADMISSION_DB", None) or os.path.join(
+        tempfile.gettempdir(), "pipedput-admission.sqlite3"
     )
+    # the web server handles requests in several threads
+    with _admission_store_lock:
+        if _admission_store is None or _admission_store.path != path:
+            _admission_store = AdmissionStore(path)
+        return _admission_store
+
+
+def maintain_event_store():
+    """
+    Compresses closed event store segments and applies the retention limits
+    at most once per EVENT_STORE_MAINTENANCE_INTERVAL seconds.
+    """
+    global _event_store_maintained_at
+    event_store = get_event_store()
+    interval = app.config.get("EVENT_STORE_MAINTENANCE_INTERVAL", 300)
+    now = time.monotonic()
+    if event_store is None or now - _event_store_maintained_at < interval:
+        return
+    _event_store_maintained_at = now
+    try:
+        event_store.maintain()
+    except Exception:
+        app.logger.exception("Could not maintain the event store.")
+
+
+def prepare_process():
+    """
+    Runs the setup that is deferred until a process handles its first
+    request or pipeline event and picks up configuration changes.
+    """
+    init_sentry()
+    config_reloader.reload_if_changed()
+    tracing.set_exporter(app.config.get("TRACING_EXPORTER", None))
+    locks.set_backend(app.config.get("LOCK_BACKEND", None))
 
 
 def get_project_by_key(key: str) -> Project:
-    for project in app.config["PROJECTS"]:
-        if project.key == key:
-            return project
-    raise Project.DoesNotExist()
+    return config_reloader.projects.get(key)
 
 
 def is_allowed(project: Project, token: Optional[str]) -> bool:
-    return project.pipeline_secret is None or project.pipeline_secret == token
+    try:
+        config_reloader.projects.authenticate(project.key, token)
+    except (Project.DoesNotExist, ProjectIndex.NotAllowed):
+        return False
+    return True
+
+
+app.before_request(prepare_process)
+
+
+def _start_process():
+    init_sentry()
+    resume_digests()
+
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    # web workers and mules are forked before they handle anything
+    postfork(_start_process)
 
 
 @app.route("/api/projects/<project_key>/publish", methods=["POST"])
@@ -46,11 +188,12 @@ def handle_pipeline_event(project_key: str):
     event: GitLabPipelineEvent = request.json  # type: ignore
 
     try:
-        project = get_project_by_key(project_key)
+        project = config_reloader.projects.authenticate(
+            project_key, request.headers.get("X-Gitlab-Token", None)
+        )
     except Project.DoesNotExist:
         return f"No project identified by {project_key} is defined.", 404
-
-    if not is_allowed(project, request.headers.get("X-Gitlab-Token", None)):
+    except ProjectIndex.NotAllowed:
         return f"You’re not allowed to publish {project_key}.", 403
 
     try:
@@ -59,6 +202,73 @@ def handle_pipeline_event(project_key: str):
     except (AttributeError, ValueError):
         return "Only pipeline events will be processed.", 400
 
+    event = PipelineEvent(event)  # type: ignore
+    correlation_id = request.headers.get("X-Request-Id", None) or new_correlation_id()
+    with log_context(
+        correlation_id=correlation_id,
+        project_key=project.key,
+        pipeline_id=event["object_attributes"]["id"],
+    ), tracing.span(
+        "accept pipeline event",
+        kind=tracing.SPAN_KIND_SERVER,
+        traceparent=request.headers.get("traceparent", None),
+        project_key=project.key,
+        pipeline_id=event["object_attributes"]["id"],
+    ):
+        decision = _admit_pipeline_event(project, event)
+        if decision is not None and not decision.was_admitted:
+            if decision.status == 503:
+                message = "Pipeline events have been waiting for too long."
+            else:
+                message = "Too many pipeline events are waiting."
+            return (
+                f"{message} {decision.reason} Please retry later.",
+                decision.status,
+                {
+                    "Retry-After": str(app.config["ADMISSION_CONTROL"].retry_after),
+                    "X-Correlation-Id": correlation_id,
+                },
+            )
+        ticket = decision.ticket if decision is not None else None
+        _accept_pipeline_event(project, event, correlation_id, ticket)
+    return "Request accepted.", 200, {"X-Correlation-Id": correlation_id}
+
+
+def _admit_pipeline_event(project: Project, event: PipelineEvent) -> Optional[Decision]:
+    """applies ADMISSION_CONTROL and returns None if it is disabled"""
+    control = app.config.get("ADMISSION_CONTROL", None)
+    admission_store = get_admission_store()
+    if control is None or admission_store is None:
+        return None
+    work_queue = app.config.get("WORK_QUEUE", None)
+    try:
+        decision = admission_store.admit(
+            control,
+            project.key,
+            event,
+            work_queue.count_pending() if work_queue is not None else 0,
+        )
+    except Exception:
+        # admission control must never prevent a deployment
+        app.logger.exception("Could not apply admission control.")
+        return None
+    if decision.dropped:
+        app.logger.warning("Dropped %d superseded pipeline events.", decision.dropped)
+    if not decision.was_admitted:
+        app.logger.warning(
+            "Rejected pipeline event with status %d: %s",
+            decision.status,
+            decision.reason,
+        )
+    return decision
+
+
+def _accept_pipeline_event(
+    project: Project,
+    event: PipelineEvent,
+    correlation_id: str,
+    ticket: Optional[int] = None,
+) -> None:
     app.logger.info(
         "Accepted request for pipeline %s for project %s finished at %s with ref %s.",
         event["object_attributes"]["id"],
@@ -66,8 +276,32 @@ def handle_pipeline_event(project_key: str):
         event["object_attributes"]["finished_at"],
         event["object_attributes"]["ref"],
     )
-    process_project_pipeline(project, event)
-    return "Request accepted.", 200
+    event_store = get_event_store()
+    if event_store is not None:
+        try:
+            event_store.append(project.key, event)
+        except Exception:
+            # the event store must never prevent a deployment
+            app.logger.exception("Could not store pipeline event.")
+    process_project_pipeline(
+        project,
+        event,
+        correlation_id,
+        tracing.get_traceparent(),
+        ticket,
+        _classify_pipeline_event(event),
+    )
+
+
+def _classify_pipeline_event(event: PipelineEvent) -> Optional[str]:
+    """returns the scheduler lane of the event (PRIORITY_LANES)"""
+    try:
+        lane = classify(app.config.get("PRIORITY_LANES", ()), event)
+    except Exception:
+        app.logger.exception("Could not classify pipeline event.")
+        return None
+    app.logger.debug("Classified pipeline event into lane %s.", lane)
+    return lane
 
 
 if __name__ == "__main__":
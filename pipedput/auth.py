@@ -0,0 +1,72 @@
+import hashlib
+import hmac
+from typing import Dict, Iterable, Optional, Tuple
+
+from pipedput.handler import Project
+from pipedput.utils import Configuration
+
+
+def _digest(secret: str) -> bytes:
+    return hashlib.sha256(secret.encode()).digest()
+
+
+class ProjectIndex:
+    """
+    Lookup table for configured projects.
+
+    Pipeline secrets are only stored as digests and every project may
+    have multiple active secrets, so that they can be rotated without
+    rejecting events that are signed with the previous secret.
+    """
+
+    class NotAllowed(Exception):
+        pass
+
+    def __init__(self, projects: Iterable[Project]) -> None:
+        self._entries: Dict[str, Tuple[Project, Tuple[bytes, ...]]] = {}
+        for project in projects:
+            Configuration.assert_false(
+                project.key in self._entries,
+                f"The project key '{project.key}' is used more than once. "
+                f"Project keys must be unique.",
+            )
+            digests = tuple(_digest(secret) for secret in project.pipeline_secrets)
+            self._entries[project.key] = (project, digests)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        return (project for project, _ in self._entries.values())
+
+    def get(self, key: str) -> Project:
+        try:
+            return self._entries[key][0]
+        except KeyError:
+            raise Project.DoesNotExist() from None
+
+    def authenticate(self, key: str, token: Optional[str]) -> Project:
+        """
+        Resolves the project for the given key and checks the token against
+        all of its secrets.
+
+        :raises Project.DoesNotExist: if no project is identified by key
+        :raises ProjectIndex.NotAllowed: if the token matches none of the secrets
+        """
+        try:
+            project, digests = self._entries[key]
+        except KeyError:
+            raise Project.DoesNotExist() from None
+        if not digests:
+            return project
+        if token is None:
+            raise self.NotAllowed()
+        token_digest = _digest(token)
+        # Compare against every digest so that the time spent does not
+        # depend on which of the secrets matched.
+        is_allowed = False
+        for digest in digests:
+            is_allowed |= hmac.compare_digest(digest, token_digest)
+        if not is_allowed:
+            raise self.NotAllowed()
+        return project
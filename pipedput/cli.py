@@ -0,0 +1,407 @@
+"""
+Command line interface for pipedput.
+
+    pipedput --config /etc/pipedput/config.py replay --project my-project event.json
+
+Replaying processes stored pipeline events with the configured projects.
+Deployment mails are only sent with --send-mail.
+
+    pipedput --config /etc/pipedput/config.py events --project my-project
+
+Lists the events in the event store and exports them as JSON files that
+can be replayed with --export.
+
+    pipedput --config /etc/pipedput/config.py send-digests
+
+Sends the mail digests whose window has passed, or all pending digests
+with --all.
+
+    pipedput --config /etc/pipedput/config.py worker
+
+Processes pipeline events from the work queue that is shared by several
+nodes (WORK_QUEUE) until it is interrupted.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import cProfile
+import dataclasses
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    TYPE_CHECKING,
+)
+
+from pipedput.typing import DeploymentStateLike, GitLabPipelineEvent
+
+if TYPE_CHECKING:
+    from pipedput.handler import Project
+
+
+class StageProfiler:
+    """Collects a separate cProfile profile for every processing stage."""
+
+    def __init__(self) -> None:
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self._active = threading.local()
+
+    @contextlib.contextmanager
+    def __call__(self, name: str, attributes: Dict[str, Any]) -> Iterator[None]:
+        # only one profiler can be active at a time
+        if getattr(self._active, "stage", None) is not None:
+            yield
+            return
+        key = f"{name}:{attributes['hook']}" if "hook" in attributes else name
+        profile = self.profiles.setdefault(key, cProfile.Profile())
+        self._active.stage = key
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active.stage = None
+
+    def print_stats(self, stream: TextIO, limit: int = 15):
+        for key, profile in self.profiles.items():
+            print(f"\n=== {key} ===", file=stream)
+            stats = pstats.Stats(profile, stream=stream)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+
+    def dump_stats(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for key, profile in self.profiles.items():
+            filename = key.replace(os.sep, "_").replace(":", "-") + ".prof"
+            profile.dump_stats(os.path.join(directory, filename))
+
+
+@dataclasses.dataclass()
+class ReplayResult:
+    source: str
+    event: GitLabPipelineEvent
+    deployments: List[DeploymentStateLike] = dataclasses.field(default_factory=list)
+    assets: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+    exc: Optional[Exception] = None
+    duration: float = 0.0
+
+    @property
+    def has_failed(self) -> bool:
+        return self.exc is not None or any(
+            not deployment.was_successful for deployment in self.deployments
+        )
+
+
+def _iter_event_files(paths: Sequence[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(".json"):
+                    yield os.path.join(path, filename)
+        else:
+            yield path
+
+
+def _load_event(path: str) -> GitLabPipelineEvent:
+    from pipedput.event import PipelineEvent
+
+    with open(path) as event_file:
+        return PipelineEvent(json.load(event_file))
+
+
+def _dry_run(project: "Project", event: GitLabPipelineEvent) -> Dict[str, List[str]]:
+    """evaluates constraints and lists the assets every hook would handle"""
+    from pipedput.handler import (
+        _get_artifacts,
+        _get_extraction_limits,
+        get_workspace_manager,
+    )
+    from pipedput.hooks import GenericGlobHook
+    from pipedput.instrumentation import stage
+    from pipedput.utils import download_file, unzip
+
+    with stage("constraints"):
+        hooks = [hook for hook in project.hooks if hook.should_execute_for(event)]
+    assets: Dict[str, List[str]] = {hook.name: [] for hook in hooks}
+    if not hooks:
+        return assets
+    for url, size in _get_artifacts(event):
+        with get_workspace_manager().acquire(size) as workspace:
+            artifact_file = os.path.join(workspace.path, "artifacts.zip")
+            artifact_dir = os.path.join(workspace.path, "data")
+            with stage("download", url=url):
+                download_file(url, artifact_file, project.artifact_download_token)
+            with stage("extract", url=url):
+                unzip(artifact_file, artifact_dir, _get_extraction_limits(project))
+            for hook in hooks:
+                if isinstance(hook, GenericGlobHook):
+                    with stage("hook", hook=hook.name):
+                        assets[hook.name].extend(
+                            os.path.relpath(path, artifact_dir)
+                            for path in hook.find_artifacts(artifact_dir)
+                        )
+    return assets
+
+
+def _replay(
+    project: "Project", source: str, dry_run: bool, send_mail: bool
+) -> ReplayResult:
+    from pipedput.handler import _deploy, _report_deployments, _report_error
+
+    result = ReplayResult(source, _load_event(source))
+    start = time.perf_counter()
+    try:
+        if dry_run:
+            result.assets = _dry_run(project, result.event)
+        else:
+            for deployment in _deploy(project, result.event):
+                result.deployments.append(deployment)
+    except Exception as exc:
+        result.exc = exc
+        if send_mail and not dry_run:
+            _report_error(project, result.event, exc, result.deployments)
+    else:
+        if send_mail and not dry_run:
+            _report_deployments(project, result.event, result.deployments)
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def _print_result(result: ReplayResult, stream: TextIO):
+    attributes = result.event.get("object_attributes", {})
+    print(
+        f"{result.source}: pipeline {attributes.get('id')} "
+        f"({attributes.get('ref')}) in {result.duration:.3f}s",
+        file=stream,
+    )
+    if result.exc is not None:
+        print(f"  error: {result.exc!r}", file=stream)
+    for hook_name, assets in result.assets.items():
+        print(f"  {hook_name}: {len(assets)} matching assets", file=stream)
+        for asset in assets:
+            print(f"    {asset}", file=stream)
+    for deployment in result.deployments:
+        state = "success" if deployment.was_successful else "failure"
+        asset = f" {deployment.asset}" if deployment.asset else ""
+        print(f"  {deployment.target_name}{asset}: {state}", file=stream)
+
+
+def replay(args: argparse.Namespace, stream: Optional[TextIO] = None) -> int:
+    from pipedput.app import config_reloader, prepare_process
+    from pipedput.handler import Project
+    from pipedput.instrumentation import add_observer, remove_observer
+
+    # replayed deployments must hold the locks of the configured backend
+    prepare_process()
+    try:
+        project = config_reloader.projects.get(args.project)
+    except Project.DoesNotExist:
+        print(f"No project identified by {args.project} is defined.", file=sys.stderr)
+        return 2
+    stream = stream or sys.stdout
+    event_files = list(_iter_event_files(args.events))
+    if not event_files:
+        print("No events to replay.", file=sys.stderr)
+        return 2
+
+    profiler = StageProfiler() if args.profile else None
+    if profiler is not None:
+        add_observer(profiler)
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            results = list(
+                executor.map(
+                    lambda source: _replay(
+                        project, source, args.dry_run, args.send_mail
+                    ),
+                    event_files,
+                )
+            )
+    finally:
+        if profiler is not None:
+            remove_observer(profiler)
+    duration = time.perf_counter() - start
+
+    for result in results:
+        _print_result(result, stream)
+    if len(results) > 1:
+        print(
+            f"\nreplayed {len(results)} events in {duration:.3f}s "
+            f"({len(results) / duration:.2f} events/s, "
+            f"concurrency {args.concurrency})",
+            file=stream,
+        )
+    if profiler is not None:
+        if args.profile_dir:
+            profiler.dump_stats(args.profile_dir)
+        else:
+            profiler.print_stats(stream)
+    return 1 if any(result.has_failed for result in results) else 0
+
+
+def events(args: argparse.Namespace, stream: Optional[TextIO] = None) -> int:
+    from pipedput.app import get_event_store
+
+    event_store = get_event_store()
+    if event_store is None:
+        print("The event store is disabled (EVENT_STORE_DIR).", file=sys.stderr)
+        return 2
+    stream = stream or sys.stdout
+    stored_events = event_store.find(
+        project_key=args.project,
+        pipeline_id=args.pipeline_id,
+        sha=args.sha,
+        status=args.status,
+        limit=args.limit,
+    )
+    if args.export:
+        os.makedirs(args.export, exist_ok=True)
+    for stored_event in stored_events:
+        received_at = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(stored_event.received_at)
+        )
+        print(
+            f"{received_at} {stored_event.project_key}: "
+            f"pipeline {stored_event.pipeline_id} {stored_event.status} "
+            f"({stored_event.sha})",
+            file=stream,
+        )
+        if args.export:
+            filename = f"{stored_event.project_key}-{stored_event.id}.json"
+            with open(os.path.join(args.export, filename), "w") as event_file:
+                json.dump(event_store.load(stored_event), event_file)
+    return 0
+
+
+def send_digests(args: argparse.Namespace, stream: Optional[TextIO] = None) -> int:
+    from pipedput.handler import send_due_digests
+
+    stream = stream or sys.stdout
+    sent = send_due_digests(force=args.all)
+    print(f"Sent {sent} mail digests.", file=stream)
+    return 0
+
+
+def worker(args: argparse.Namespace, stream: Optional[TextIO] = None) -> int:
+    from pipedput.app import prepare_process
+    from pipedput.handler import get_queue_consumer, resume_digests
+
+    stream = stream or sys.stdout
+    prepare_process()
+    resume_digests()
+    consumer = get_queue_consumer()
+    if consumer is None:
+        print("No work queue is configured (WORK_QUEUE).", file=sys.stderr)
+        return 2
+    print(f"Processing events from the work queue as {consumer.node}.", file=stream)
+    try:
+        while True:
+            time.sleep(args.reload_interval)
+            # picks up configuration changes
+            prepare_process()
+            consumer = get_queue_consumer() or consumer
+    except KeyboardInterrupt:
+        consumer.stop()
+    return 0
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pipedput")
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("PIPEDPUT_CONFIG_FILE", None),
+        help="path to the configuration file (default: $PIPEDPUT_CONFIG_FILE)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="process stored pipeline events"
+    )
+    replay_parser.set_defaults(func=replay)
+    replay_parser.add_argument("--project", required=True, help="the project key")
+    replay_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="evaluate constraints and list matching assets without deploying",
+    )
+    replay_parser.add_argument(
+        "--profile", action="store_true", help="profile every processing stage"
+    )
+    replay_parser.add_argument(
+        "--profile-dir", help="write profiles to this directory instead of stdout"
+    )
+    replay_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of events that are replayed at the same time",
+    )
+    replay_parser.add_argument(
+        "--send-mail", action="store_true", help="send deployment reports"
+    )
+    replay_parser.add_argument(
+        "events", nargs="+", help="event JSON files or directories containing them"
+    )
+
+    events_parser = subparsers.add_parser(
+        "events", help="list and export events from the event store"
+    )
+    events_parser.set_defaults(func=events)
+    events_parser.add_argument("--project", help="the project key")
+    events_parser.add_argument("--pipeline-id", type=int)
+    events_parser.add_argument("--sha")
+    events_parser.add_argument("--status")
+    events_parser.add_argument("--limit", type=int)
+    events_parser.add_argument(
+        "--export", help="write every listed event as JSON file to this directory"
+    )
+
+    send_digests_parser = subparsers.add_parser(
+        "send-digests", help="send mail digests whose window has passed"
+    )
+    send_digests_parser.set_defaults(func=send_digests)
+    send_digests_parser.add_argument(
+        "--all", action="store_true", help="send all pending digests right away"
+    )
+
+    worker_parser = subparsers.add_parser(
+        "worker", help="process pipeline events from the shared work queue"
+    )
+    worker_parser.set_defaults(func=worker)
+    worker_parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=5,
+        help="seconds between checks for configuration changes",
+    )
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.config is None:
+        parser.error("please provide a config file with --config")
+    os.environ["PIPEDPUT_CONFIG_FILE"] = os.path.abspath(args.config)
+    if getattr(args, "profile", False) and args.concurrency > 1:
+        parser.error("--profile can’t be combined with --concurrency")
+    from pipedput.app import init_sentry
+
+    # commands report their errors, not only those that prepare the process
+    init_sentry()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,21 @@
+from pipedput.admission import AdmissionControl  # noqa: F401
 from pipedput.constraints import (  # noqa: F401
     Callback,
+    IsDefaultBranch,
     IsProject,
+    IsProjectIn,
     IsTag,
+    JobNameIn,
     OnBranch,
     OnDefaultBranch,
+    RefIn,
+    UserIn,
     WasManuallyStarted,
     WasManuallyTriggered,
     WasPipelineStartedFromUI,
     WasSuccessful,
 )
+from pipedput.digest import MailDigest  # noqa: F401
 from pipedput.handler import Contact, Project  # noqa: F401
 from pipedput.hooks import (  # noqa: F401
     DeploymentState,
@@ -16,3 +23,10 @@ from pipedput.hooks import (  # noqa: F401
     PublishToDebRepository,
     PublishToPythonRepository,
 )
+from pipedput.locks import FileLockBackend, LocalLockBackend  # noqa: F401
+from pipedput.log import configure_json_logging  # noqa: F401
+from pipedput.process import ProcessLimits  # noqa: F401
+from pipedput.scheduler import Lane  # noqa: F401
+from pipedput.tracing import FileSpanExporter, OTLPSpanExporter  # noqa: F401
+from pipedput.utils import ExtractionLimits  # noqa: F401
+from pipedput.workqueue import FileQueueBackend, SQLiteQueueBackend  # noqa: F401
@@ -1,9 +1,31 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import fnmatch
+import hashlib
 import json
-from typing import Any, Callable
+import re
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
+from urllib.parse import urlsplit
 from urllib.request import Request, urlopen
 import warnings
 
-from pipedput.typing import GitLabPipelineEvent
+from pipedput import tracing
+from pipedput.event import PipelineEvent
+from pipedput.typing import Constraint, GitLabPipelineEvent
 from pipedput.utils import get_api_base_url_from_event
 
 
@@ -45,6 +67,133 @@ class _Not(AbstractConstraint):
         return not self._constraint(event)
 
 
+def _strip_negations(constraint) -> Tuple[bool, Any]:
+    negated = False
+    while isinstance(constraint, _Not):
+        negated = not negated
+        constraint = constraint._constraint
+    return negated, constraint
+
+
+def _iter_operands(
+    operator: Type[_AbstractConstraintOperator], constraint
+) -> Iterator[Any]:
+    """yields the operands of a chain of operators, inlining nested chains"""
+    stack = [constraint]
+    while stack:
+        current = stack.pop()
+        negated, inner = _strip_negations(current)
+        if not negated and isinstance(inner, operator):
+            stack.append(inner._second_constraint)
+            stack.append(inner._first_constraint)
+        else:
+            yield current
+
+
+def _get_leaf_signature(constraint) -> Hashable:
+    # constraints of the same type and state are considered identical,
+    # everything else is only identical to itself
+    if isinstance(constraint, AbstractConstraint):
+        state = tuple(sorted(vars(constraint).items()))
+        try:
+            hash(state)
+        except TypeError:
+            return id(constraint)
+        return type(constraint), state
+    return id(constraint)
+
+
+def _all(predicates: Tuple[Constraint, ...]) -> Constraint:
+    def evaluate(event: GitLabPipelineEvent):
+        for predicate in predicates:
+            if not predicate(event):
+                return False
+        return True
+
+    return evaluate
+
+
+def _any(predicates: Tuple[Constraint, ...]) -> Constraint:
+    def evaluate(event: GitLabPipelineEvent):
+        for predicate in predicates:
+            if predicate(event):
+                return True
+        return False
+
+    return evaluate
+
+
+def _negate(predicate: Constraint) -> Constraint:
+    def evaluate(event: GitLabPipelineEvent):
+        return not predicate(event)
+
+    return evaluate
+
+
+def _fold_memberships(operands: List[Any]) -> List[Any]:
+    """merges equality and membership constraints of the same kind"""
+    folded: List[Any] = []
+    positions: Dict[type, int] = {}
+    for operand in operands:
+        if type(operand) is IsProject:
+            operand = IsProjectIn([operand._name])
+        if isinstance(operand, _AbstractMembershipConstraint):
+            kind = type(operand)
+            if kind in positions:
+                index = positions[kind]
+                folded[index] = folded[index].union(operand)
+                continue
+            positions[kind] = len(folded)
+        folded.append(operand)
+    return folded
+
+
+def _compile(constraint) -> Tuple[Constraint, Hashable]:
+    negated, constraint = _strip_negations(constraint)
+    if isinstance(constraint, (_And, _Or)):
+        operator = _And if isinstance(constraint, _And) else _Or
+        predicates: List[Constraint] = []
+        signatures: List[Hashable] = []
+        seen: Set[Hashable] = set()
+        # chains are flattened iteratively, so this only recurses whenever
+        # the operator changes
+        operands = list(_iter_operands(operator, constraint))
+        if operator is _Or:
+            operands = _fold_memberships(operands)
+        for operand in operands:
+            predicate, signature = _compile(operand)
+            if signature not in seen:
+                seen.add(signature)
+                predicates.append(predicate)
+                signatures.append(signature)
+        signature = (operator.__name__, tuple(signatures))
+        if len(predicates) == 1:
+            predicate, signature = predicates[0], signatures[0]
+        elif operator is _And:
+            predicate = _all(tuple(predicates))
+        else:
+            predicate = _any(tuple(predicates))
+    else:
+        predicate, signature = constraint, _get_leaf_signature(constraint)
+    if negated:
+        return _negate(predicate), ("not", signature)
+    return predicate, signature
+
+
+def compile_constraint(constraint: Optional[Constraint]) -> Optional[Constraint]:
+    """
+    Compiles a tree of combined constraints into a single predicate.
+
+    Chains of the same operator are merged, double negations are removed
+    and identical operands are only evaluated once. The result is
+    equivalent to the original constraint, but avoids one nested call per
+    operator and can’t exceed the recursion limit for long chains.
+    """
+    if constraint is None:
+        return None
+    return _compile(constraint)[0]
+
+
 class Callback(AbstractConstraint):
     """only process the event if the callback returned the expected value"""
 
@@ -77,39 +226,216 @@ class IsProject(AbstractConstraint):
         return event["project"]["path_with_namespace"] == self._name
 
 
+class _AbstractMembershipConstraint(AbstractConstraint):
+    def __init__(
+        self,
+        values: Iterable[str] = (),
+        globs: Iterable[str] = (),
+        regexes: Iterable[str] = (),
+    ) -> None:
+        """
+        :param values: the values that match exactly
+        :param globs: shell-style patterns like 'foo/*'
+        :param regexes: regular expressions that must match the whole value
+        """
+        super().__init__()
+        self._values = frozenset(values)
+        self._globs = tuple(globs)
+        self._regexes = tuple(regexes)
+        # all patterns are combined into a single regular expression
+        patterns = [fnmatch.translate(glob) for glob in self._globs]
+        patterns.extend(self._regexes)
+        self._pattern = (
+            re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+            if patterns
+            else None
+        )
+
+    def _matches(self, value: Optional[str]) -> bool:
+        if value in self._values:
+            return True
+        return (
+            self._pattern is not None
+            and isinstance(value, str)
+            and self._pattern.fullmatch(value) is not None
+        )
+
+    def union(self, other: "_AbstractMembershipConstraint"):
+        return type(self)(
+            self._values | other._values,
+            self._globs + other._globs,
+            self._regexes + other._regexes,
+        )
+
+
+class IsProjectIn(_AbstractMembershipConstraint):
+    """only process the event if the project is one of the provided projects"""
+
+    def __call__(self, event: GitLabPipelineEvent):
+        return self._matches(event["project"]["path_with_namespace"])
+
+
+class RefIn(_AbstractMembershipConstraint):
+    """only process the event if the pipeline is executed for one of the provided refs"""
+
+    def __call__(self, event: GitLabPipelineEvent):
+        return self._matches(event["object_attributes"]["ref"])
+
+
+class UserIn(_AbstractMembershipConstraint):
+    """only process the event if the pipeline was started by one of the provided users"""
+
+    def __call__(self, event: GitLabPipelineEvent):
+        return self._matches(event["user"]["username"])
+
+
+class JobNameIn(_AbstractMembershipConstraint):
+    """only process the event if the pipeline contains one of the provided jobs"""
+
+    def __call__(self, event: GitLabPipelineEvent):
+        job_names = PipelineEvent.parse(event).builds_by_name
+        if not self._values.isdisjoint(job_names):
+            return True
+        return self._pattern is not None and any(
+            self._matches(job_name) for job_name in job_names
+        )
+
+
+class RefResolver:
+    """
+    Resolves the refs that contain a commit and shares the result between
+    all constraints and projects that evaluate events for the same commit
+    with the same token within ttl seconds. Concurrent lookups for the same commit wait for a
+    single request.
+    """
+
+    PER_PAGE = 100
+    _NEXT_LINK_PATTERN = re.compile(r'<(?P<url>[^>]+)>;\s*rel="?next"?')
+
+    def __init__(self, ttl: float = 60, max_entries: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: (
+            "OrderedDict[Tuple[str, int, str, str], Tuple[float, Future]]"
+        ) = OrderedDict()
+
+    def _get_next_page_url(self, response) -> Optional[str]:
+        link_header = response.headers.get("Link", None)
+        if not link_header:
+            return None
+        match = self._NEXT_LINK_PATTERN.search(link_header)
+        return match.group("url") if match else None
+
+    @staticmethod
+    def _get_origin(url: str) -> Tuple[str, Optional[str], Optional[int]]:
+        parts = urlsplit(url)
+        default_port = {"http": 80, "https": 443}.get(parts.scheme, None)
+        return parts.scheme, parts.hostname, parts.port or default_port
+
+    def _fetch(self, url: str, api_token: str) -> List[Dict[str, Any]]:
+        refs: List[Dict[str, Any]] = []
+        origin = self._get_origin(url)
+        next_url: Optional[str] = url
+        while next_url is not None:
+            # the token must not be sent to other hosts
+            if self._get_origin(next_url) != origin:
+                raise ValueError(
+                    f"Refusing to follow the next page link {next_url} to "
+                    "another origin."
+                )
+            request = Request(next_url, headers={"PRIVATE-TOKEN": api_token})
+            with tracing.span(
+                "GET commit refs", kind=tracing.SPAN_KIND_CLIENT, url=next_url
+            ), urlopen(request) as response:
+                refs.extend(json.load(response))
+                next_url = self._get_next_page_url(response)
+        return refs
+
+    def get_refs(
+        self, event: GitLabPipelineEvent, api_token: str
+    ) -> List[Dict[str, Any]]:
+        base_url = get_api_base_url_from_event(event)
+        project_id = event["project"]["id"]
+        commit_sha = event["commit"]["id"]
+        # results are only shared between users of the same token
+        token_digest = hashlib.sha256(api_token.encode()).hexdigest()
+        key = (base_url, project_id, commit_sha, token_digest)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            is_cached = entry is not None and now - entry[0] < self.ttl
+            if is_cached:
+                self._entries.move_to_end(key)
+                future = entry[1]
+            else:
+                future = Future()
+                self._entries[key] = (now, future)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if is_cached:
+            return future.result()
+        url = (
+            f"{base_url}/projects/{project_id}/repository/commits/{commit_sha}/refs"
+            f"?per_page={self.PER_PAGE}"
+        )
+        try:
+            future.set_result(self._fetch(url, api_token))
+        except Exception as exc:
+            future.set_exception(exc)
+            # failed lookups are not cached
+            with self._lock:
+                if self._entries.get(key, (None, None))[1] is future:
+                    del self._entries[key]
+        return future.result()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+ref_resolver = RefResolver()
+
+
 class OnBranch(AbstractConstraint):
     """only process the event if the pipeline is executed for the specified branch"""
 
-    def __init__(self, api_token: str, branch_name: str) -> None:
+    def __init__(
+        self,
+        api_token: str,
+        branch_name: str,
+        ref_resolver: Optional[RefResolver] = None,
+    ) -> None:
+        """
+        :param api_token: a GitLab token that is allowed to read the repository
+        :param branch_name: the name of the branch
+        :param ref_resolver: the resolver used to look up refs, shared by default
+        """
         super().__init__()
         self._api_token = api_token
         self._branch_name = branch_name
+        self._ref_resolver = ref_resolver
 
     def __call__(self, event: GitLabPipelineEvent):
         return self._is_commit_contained_in_ref(event, self._branch_name)
 
     def _is_commit_contained_in_ref(self, event, ref_name: str):
-        base_url = get_api_base_url_from_event(event)
-        project_id = event["project"]["id"]
-        commit_sha = event["commit"]["id"]
-        commit_url = (
-            f"{base_url}/projects/{project_id}/repository/commits/{commit_sha}/refs"
-        )
-        request = Request(commit_url, headers={"PRIVATE-TOKEN": self._api_token})
-        with urlopen(request) as response:
-            data = json.load(response)
+        resolver = self._ref_resolver or ref_resolver
         return any(
-            [ref["type"] == "branch" and ref["name"] == ref_name for ref in data]
+            ref["type"] == "branch" and ref["name"] == ref_name
+            for ref in resolver.get_refs(event, self._api_token)
         )
 
 
 class OnDefaultBranch(OnBranch):
     """only process the event if the pipeline is executed for the default branch of this project"""
 
-    def __init__(self, api_token: str) -> None:
+    def __init__(
+        self, api_token: str, ref_resolver: Optional[RefResolver] = None
+    ) -> None:
         # self.branch_name should never be used, but just to be sure we use
         # a branch_name that is not valid under the git ref name rules
-        super().__init__(api_token, ":DEFAULT:")
+        super().__init__(api_token, ":DEFAULT:", ref_resolver)
 
     def __call__(self, event: GitLabPipelineEvent):
         return self._is_commit_contained_in_ref(
@@ -124,6 +450,20 @@ class IsTag(AbstractConstraint):
         return event["object_attributes"]["tag"] is True
 
 
+class IsDefaultBranch(AbstractConstraint):
+    """
+    only process the event if the pipeline is executed for the default branch
+    of the project. Unlike OnDefaultBranch it only looks at the event and
+    doesn’t ask GitLab whether the commit is contained in the branch.
+    """
+
+    def __call__(self, event: GitLabPipelineEvent):
+        return (
+            event["object_attributes"]["tag"] is not True
+            and event["object_attributes"]["ref"] == event["project"]["default_branch"]
+        )
+
+
 class WasSuccessful(AbstractConstraint):
     """only process the event if the pipeline was successful"""
 
@@ -147,11 +487,10 @@ class WasManuallyStarted(AbstractConstraint):
         self._require = require
 
     def __call__(self, event: GitLabPipelineEvent):
+        event = PipelineEvent.parse(event)
         if isinstance(self._require, str):
-            for build in event["builds"]:
-                if build["name"] == self._require:
-                    return build["manual"]
-            return False
+            build = event.builds_by_name.get(self._require, None)
+            return build["manual"] if build is not None else False
         else:
             return self._require(build["manual"] for build in event["builds"])
 
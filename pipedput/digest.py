@@ -0,0 +1,180 @@
+"""
+Digests that combine the deployment reports of many pipelines into one mail.
+
+Reports that are sent as a digest are stored in an SQLite database until
+the digest window of their group has passed, so pending digests survive
+restarts. A group collects the reports of one recipient, either per project
+or for all projects. Processes claim due groups before sending them, so a
+digest is sent only once even if several processes flush digests.
+"""
+
+import dataclasses
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import uuid
+
+from pipedput.report import DeploymentReport
+from pipedput.utils import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    group_key TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    recipient_name TEXT,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    due_at REAL NOT NULL,
+    claim TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS entries_group_key ON entries (group_key, due_at);
+CREATE INDEX IF NOT EXISTS entries_claim ON entries (claim);
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class MailDigest:
+    """Sends deployment reports as a periodic digest instead of one by one."""
+
+    PER_PROJECT = "project"
+    PER_RECIPIENT = "recipient"
+
+    # seconds reports are collected before the digest is sent
+    interval: float = 3600
+    # PER_PROJECT sends a digest per project and recipient,
+    # PER_RECIPIENT combines the reports of all projects of a recipient
+    group_by: str = PER_PROJECT
+    # reports with failures or errors bypass the digest
+    send_failures_immediately: bool = True
+
+    def accepts(self, report: DeploymentReport) -> bool:
+        if self.interval <= 0:
+            return False
+        return report.was_successful or not self.send_failures_immediately
+
+    def get_group_key(self, project_key: str, recipient: str) -> str:
+        if self.group_by == self.PER_RECIPIENT:
+            return recipient
+        return f"{project_key}:{recipient}"
+
+
+@dataclasses.dataclass(frozen=True)
+class Digest:
+    group_key: str
+    recipient: str
+    recipient_name: Optional[str]
+    entries: List[Dict[str, Any]]
+    claim: str
+
+
+class DigestStore:
+    # claims of processes that crashed while sending a digest expire
+    CLAIM_TIMEOUT = 600
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: the path of the SQLite database
+        """
+        self.path = path
+        self._database = SQLiteDatabase(path, _SCHEMA)
+
+    def add(
+        self,
+        recipients: Iterable[Tuple[str, str, Optional[str]]],
+        data: Dict[str, Any],
+        interval: float,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Adds a report to the digests of all recipients.
+
+        :param recipients: tuples of group key, email address and name
+        :param data: the JSON-serializable report
+        :param interval: seconds after which the digest is due
+        """
+        now = time.time() if now is None else now
+        serialized_data = json.dumps(data)
+        connection = self._database.connection
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO entries "
+                "(group_key, recipient, recipient_name, data, created_at, due_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (group_key, email, name, serialized_data, now, now + interval)
+                    for group_key, email, name in recipients
+                ],
+            )
+
+    def claim_due(
+        self, force: bool = False, now: Optional[float] = None
+    ) -> List[Digest]:
+        """
+        Claims all groups whose oldest report is due. Claimed digests must
+        either be completed once they have been sent or released.
+
+        :param force: claim all groups regardless of their due date
+        """
+        now = time.time() if now is None else now
+        claim = uuid.uuid4().hex
+        connection = self._database.connection
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "UPDATE entries SET claim = ?, claimed_at = ? "
+                "WHERE (claim IS NULL OR claimed_at < ?) AND group_key IN ("
+                "  SELECT group_key FROM entries"
+                "  WHERE claim IS NULL OR claimed_at < ?"
+                "  GROUP BY group_key HAVING ? OR MIN(due_at) <= ?"
+                ")",
+                (
+                    claim,
+                    now,
+                    now - self.CLAIM_TIMEOUT,
+                    now - self.CLAIM_TIMEOUT,
+                    force,
+                    now,
+                ),
+            )
+            rows = connection.execute(
+                "SELECT group_key, recipient, recipient_name, data FROM entries "
+                "WHERE claim = ? ORDER BY group_key, created_at, id",
+                (claim,),
+            ).fetchall()
+        digests: Dict[str, Digest] = {}
+        for group_key, recipient, recipient_name, data in rows:
+            digest = digests.get(group_key, None)
+            if digest is None:
+                digest = digests[group_key] = Digest(
+                    group_key, recipient, recipient_name, [], claim
+                )
+            digest.entries.append(json.loads(data))
+        return list(digests.values())
+
+    def complete(self, digest: Digest) -> None:
+        """removes the reports of a digest that has been sent"""
+        with self._database.connection as connection:
+            connection.execute(
+                "DELETE FROM entries WHERE group_key = ? AND claim = ?",
+                (digest.group_key, digest.claim),
+            )
+
+    def release(self, digest: Digest) -> None:
+        """makes a digest that could not be sent available again"""
+        with self._database.connection as connection:
+            connection.execute(
+                "UPDATE entries SET claim = NULL, claimed_at = NULL "
+                "WHERE group_key = ? AND claim = ?",
+                (digest.group_key, digest.claim),
+            )
+
+    def count_pending(self) -> int:
+        return self._database.connection.execute(
+            "SELECT COUNT(*) FROM entries"
+        ).fetchone()[0]
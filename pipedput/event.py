@@ -0,0 +1,46 @@
+from typing import Any, Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+from pipedput.typing import GitLabBuild, GitLabPipelineEvent
+
+
+class PipelineEvent(dict):
+    """
+    A pipeline event with indexes that are built once per request.
+
+    The event remains a plain dict for templates, JSON serialization and
+    existing hooks, but constraints and the handler can use the indexes
+    instead of scanning all builds for every lookup. Events must not be
+    modified once they have been parsed.
+    """
+
+    __slots__ = ("builds_by_name", "builds_with_artifacts", "_api_base_url")
+
+    def __init__(self, data: Mapping[str, Any]) -> None:
+        super().__init__(data)
+        builds = self.get("builds", None) or []
+        self.builds_by_name: Dict[str, GitLabBuild] = {}
+        for build in builds:
+            # the first build of a given name wins
+            self.builds_by_name.setdefault(build.get("name", None), build)
+        self.builds_with_artifacts: Tuple[GitLabBuild, ...] = tuple(
+            build
+            for build in builds
+            if (build.get("artifacts_file", None) or {}).get("filename", None)
+            is not None
+        )
+        self._api_base_url: Optional[str] = None
+
+    @classmethod
+    def parse(cls, event: GitLabPipelineEvent) -> "PipelineEvent":
+        """returns event itself if it has already been parsed"""
+        if isinstance(event, cls):
+            return event
+        return cls(event)
+
+    @property
+    def api_base_url(self) -> str:
+        if self._api_base_url is None:
+            base_url = urlparse(self["project"]["web_url"])
+            self._api_base_url = f"{base_url.scheme}://{base_url.netloc}/api/v4"
+        return self._api_base_url
@@ -0,0 +1,328 @@
+"""
+An append-only store for received pipeline events.
+
+Every process appends events to its own segment file, so writers never
+contend for a file. Segments are closed once they exceed the segment size
+or the segment age and compressed during maintenance. Maintenance closes
+old segments of other processes too: it renames them while it holds an
+flock on them and writers check under the same flock that their segment
+is still open before they append to it. An SQLite database indexes all stored
+events by project key, pipeline id, commit sha and pipeline status.
+"""
+
+import contextlib
+import dataclasses
+import fcntl
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from pipedput.event import PipelineEvent
+from pipedput.typing import GitLabPipelineEvent
+from pipedput.utils import is_process_running, SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    project_key TEXT NOT NULL,
+    pipeline_id INTEGER,
+    sha TEXT,
+    status TEXT,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_project_key ON events (project_key, pipeline_id);
+CREATE INDEX IF NOT EXISTS events_pipeline_id ON events (pipeline_id);
+CREATE INDEX IF NOT EXISTS events_sha ON events (sha);
+CREATE INDEX IF NOT EXISTS events_status ON events (status);
+CREATE INDEX IF NOT EXISTS events_segment ON events (segment);
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class StoredEvent:
+    id: int
+    segment: str
+    offset: int
+    length: int
+    project_key: str
+    pipeline_id: Optional[int]
+    sha: Optional[str]
+    status: Optional[str]
+    received_at: float
+
+
+class EventStore:
+    INDEX_FILE = "index.sqlite3"
+    OPEN_SUFFIX = ".jsonl.open"
+    CLOSED_SUFFIX = ".jsonl"
+    COMPRESSED_SUFFIX = ".jsonl.gz"
+    DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+    DEFAULT_SEGMENT_MAX_AGE = 3600
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        max_size: Optional[int] = None,
+        max_age: Optional[float] = None,
+        segment_max_age: Optional[float] = DEFAULT_SEGMENT_MAX_AGE,
+    ) -> None:
+        """
+        :param directory: the directory that contains segments and the index
+        :param segment_size: the size in bytes after which a segment is closed
+        :param max_size: the maximum size in bytes of all closed segments
+        :param max_age: the maximum age in seconds of the newest event of a
+            closed segment
+        :param segment_max_age: the age in seconds after which a segment is
+            closed, so that max_age applies on installations with few events
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_max_age = segment_max_age
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._segment: Optional[str] = None
+        self._segment_fd: Optional[int] = None
+        self._segment_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._database = SQLiteDatabase(
+            os.path.join(directory, self.INDEX_FILE), _SCHEMA
+        )
+
+    def _path(self, segment: str, suffix: str) -> str:
+        return os.path.join(self.directory, segment + suffix)
+
+    @staticmethod
+    def _get_created_at(segment: str) -> float:
+        # segment names contain their creation time in nanoseconds
+        return int(segment.split("-")[1]) / 1e9
+
+    def _is_segment_old(self, segment: str, now: float) -> bool:
+        return (
+            self.segment_max_age is not None
+            and now - self._get_created_at(segment) > self.segment_max_age
+        )
+
+    def _is_segment_open(self, fd: int) -> bool:
+        assert self._segment is not None
+        try:
+            stat = os.stat(self._path(self._segment, self.OPEN_SUFFIX))
+        except FileNotFoundError:
+            return False
+        return stat.st_ino == os.fstat(fd).st_ino
+
+    def _open_segment(self) -> int:
+        pid = os.getpid()
+        if self._pid != pid:
+            # the file descriptor belongs to the parent process
+            self._segment = None
+            self._segment_fd = None
+            self._pid = pid
+        if self._segment_fd is None:
+            self._segment = f"segment-{time.time_ns()}-{pid}"
+            self._segment_fd = os.open(
+                self._path(self._segment, self.OPEN_SUFFIX),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o640,
+            )
+            self._segment_size = 0
+        return self._segment_fd
+
+    def _close_segment(self):
+        if self._segment_fd is None or self._segment is None:
+            return
+        fd = self._segment_fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self._is_segment_open(fd):
+                os.rename(
+                    self._path(self._segment, self.OPEN_SUFFIX),
+                    self._path(self._segment, self.CLOSED_SUFFIX),
+                )
+        finally:
+            os.close(fd)
+            self._segment = None
+            self._segment_fd = None
+
+    def append(self, project_key: str, event: GitLabPipelineEvent) -> None:
+        data = json.dumps(event, separators=(",", ":")).encode() + b"\n"
+        attributes = event.get("object_attributes", None) or {}
+        with self._lock:
+            if self._segment is not None and self._is_segment_old(
+                self._segment, time.time()
+            ):
+                self._close_segment()
+            while True:
+                fd = self._open_segment()
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if self._is_segment_open(fd):
+                    break
+                # maintenance has closed the segment
+                os.close(fd)
+                self._segment = None
+                self._segment_fd = None
+            try:
+                offset = self._segment_size
+                os.write(fd, data)
+                self._segment_size += len(data)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._database.connection.execute(
+                "INSERT INTO events "
+                "(segment, offset, length, project_key, pipeline_id, sha, status, "
+                "received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self._segment,
+                    offset,
+                    len(data),
+                    project_key,
+                    attributes.get("id", None),
+                    attributes.get("sha", None),
+                    attributes.get("status", None),
+                    time.time(),
+                ),
+            )
+            if self._segment_size >= self.segment_size:
+                self._close_segment()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_segment()
+
+    def find(
+        self,
+        project_key: Optional[str] = None,
+        pipeline_id: Optional[int] = None,
+        sha: Optional[str] = None,
+        status: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> List[StoredEvent]:
+        """returns the matching events in the order they were received"""
+        conditions, params = [], []
+        for column, value in (
+            ("project_key", project_key),
+            ("pipeline_id", pipeline_id),
+            ("sha", sha),
+            ("status", status),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("received_at >= ?")
+            params.append(since)
+        query = "SELECT id, segment, offset, length, project_key, pipeline_id, "
+        query += "sha, status, received_at FROM events"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY received_at, id"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        rows = self._database.connection.execute(query, params).fetchall()
+        return [StoredEvent(*row) for row in rows]
+
+    def load(self, stored_event: StoredEvent) -> GitLabPipelineEvent:
+        for suffix, opener in (
+            (self.OPEN_SUFFIX, open),
+            (self.CLOSED_SUFFIX, open),
+            (self.COMPRESSED_SUFFIX, gzip.open),
+        ):
+            try:
+                with opener(self._path(stored_event.segment, suffix), "rb") as file:
+                    file.seek(stored_event.offset)
+                    return PipelineEvent(json.loads(file.read(stored_event.length)))
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(f"Segment {stored_event.segment} does not exist.")
+
+    def iter_events(self, **filters) -> Iterator[GitLabPipelineEvent]:
+        for stored_event in self.find(**filters):
+            yield self.load(stored_event)
+
+    def _segments(self, suffix: str) -> List[str]:
+        return sorted(
+            filename[: -len(suffix)]
+            for filename in os.listdir(self.directory)
+            if filename.endswith(suffix)
+        )
+
+    def _close_foreign_segment(self, segment: str) -> None:
+        path = self._path(segment, self.OPEN_SUFFIX)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            # waits for a running append to finish
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with contextlib.suppress(FileNotFoundError):
+                os.rename(path, self._path(segment, self.CLOSED_SUFFIX))
+        finally:
+            os.close(fd)
+
+    def maintain(self, now: Optional[float] = None) -> None:
+        """
+        Closes segments of processes that have died and segments that are
+        older than segment_max_age, compresses closed segments and removes
+        segments that exceed the retention limits.
+        """
+        now = time.time() if now is None else now
+        for segment in self._segments(self.OPEN_SUFFIX):
+            pid = int(segment.rsplit("-", 1)[-1])
+            if not is_process_running(pid) or self._is_segment_old(segment, now):
+                self._close_foreign_segment(segment)
+        for segment in self._segments(self.CLOSED_SUFFIX):
+            source = self._path(segment, self.CLOSED_SUFFIX)
+            target = self._path(segment, self.COMPRESSED_SUFFIX)
+            with open(source, "rb") as segment_file, gzip.open(
+                target + ".tmp", "wb"
+            ) as compressed_file:
+                shutil.copyfileobj(segment_file, compressed_file)
+            os.rename(target + ".tmp", target)
+            os.unlink(source)
+        self._apply_retention(now)
+
+    def _get_received_at(self, segment: str) -> float:
+        """returns when the newest event of a segment was received"""
+        (received_at,) = self._database.connection.execute(
+            "SELECT MAX(received_at) FROM events WHERE segment = ?", (segment,)
+        ).fetchone()
+        return received_at if received_at is not None else self._get_created_at(segment)
+
+    def _apply_retention(self, now: float):
+        segments = self._segments(self.COMPRESSED_SUFFIX)
+        sizes = {
+            segment: os.stat(self._path(segment, self.COMPRESSED_SUFFIX))
+            for segment in segments
+        }
+        total_size = sum(stat.st_size for stat in sizes.values())
+        # segment names start with their creation time, so they are sorted by
+        # age, the modification time is when a segment was compressed
+        for segment in segments:
+            stat = sizes[segment]
+            is_too_old = (
+                self.max_age is not None
+                and now - self._get_received_at(segment) > self.max_age
+            )
+            is_too_large = self.max_size is not None and total_size > self.max_size
+            if not is_too_old and not is_too_large:
+                continue
+            self._database.connection.execute(
+                "DELETE FROM events WHERE segment = ?", (segment,)
+            )
+            os.unlink(self._path(segment, self.COMPRESSED_SUFFIX))
+            total_size -= stat.st_size
+            logger.info("Removed event store segment %s.", segment)
@@ -1,9 +1,23 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
 import dataclasses
 import functools
 import logging
 import os
 import tempfile
-from typing import Callable, Iterable, Iterator, Optional, Union
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 try:
     from uwsgidecorators import mulefunc
@@ -17,32 +31,51 @@ except ImportError:
         return wrapper
 
 
+from pipedput import admission, tracing
+from pipedput.digest import Digest, DigestStore, MailDigest
+from pipedput.event import PipelineEvent
+from pipedput.hooks import DeploymentState
+from pipedput.instrumentation import stage
+from pipedput.log import get_correlation_id, log_context, new_correlation_id
+from pipedput.report import DeploymentReport
+from pipedput.scheduler import Lane, Scheduler
 from pipedput.typing import DeploymentStateLike, GitLabPipelineEvent, HookLike
 from pipedput.utils import (
     create_template_renderer,
     download_file,
-    get_api_base_url_from_event,
+    ExtractionLimits,
+    render_template,
     send_mail,
     unzip,
 )
+from pipedput.workqueue import QueueConsumer, WorkItem
+from pipedput.workspace import WorkspaceManager
 
 logger = logging.getLogger(__name__)
 
 
-def _get_artifact_urls(event: GitLabPipelineEvent) -> Iterator[str]:
+def _get_artifacts(event: GitLabPipelineEvent) -> Iterator[Tuple[str, Optional[int]]]:
     """
-    generator that yields artifact urls from a gitlab pipeline event
+    generator that yields the url and the size of all artifact archives
+    of a gitlab pipeline event
 
     url format:
         https://example.com/api/v4/projects/<project_id>/jobs/<job_id>/artifacts
     """
-    base_url = get_api_base_url_from_event(event)
+    event = PipelineEvent.parse(event)
+    base_url = event.api_base_url
     project_id = event["project"]["id"]
 
-    for build in event["builds"]:
-        if build["artifacts_file"]["filename"] is not None:
-            job_id = build["id"]
-            yield f"{base_url}/projects/{project_id}/jobs/{job_id}/artifacts"
+    for build in event.builds_with_artifacts:
+        job_id = build["id"]
+        url = f"{base_url}/projects/{project_id}/jobs/{job_id}/artifacts"
+        yield url, build["artifacts_file"].get("size", None)
+
+
+def _get_artifact_urls(event: GitLabPipelineEvent) -> Iterator[str]:
+    """generator that yields artifact urls from a gitlab pipeline event"""
+    for url, _size in _get_artifacts(event):
+        yield url
 
 
 def _get_default_recipients(event: GitLabPipelineEvent):
@@ -93,6 +126,223 @@ def _send_report_mail(
                 )
 
 
+def _get_digest_recipients(
+    project: "Project", event: GitLabPipelineEvent
+) -> List[Tuple[str, Optional[str]]]:
+    """returns the email addresses and names that receive reports for event"""
+    recipients = {event["user"]["email"]: event["user"].get("name", None)}
+    author = event.get("commit", {}).get("author", {})
+    if author.get("email", None):
+        recipients.setdefault(author["email"], author.get("name", None))
+    for maintainer in project.maintainers:
+        if maintainer.email:
+            recipients.setdefault(maintainer.email, maintainer.name)
+    return list(recipients.items())
+
+
+def _get_digest_data(
+    event: GitLabPipelineEvent, report: DeploymentReport
+) -> Dict[str, Any]:
+    attributes = event.get("object_attributes", {})
+    return {
+        "project": event["project"]["path_with_namespace"],
+        "web_url": event["project"].get("web_url", None),
+        "pipeline_id": attributes.get("id", None),
+        "ref": attributes.get("ref", None),
+        "exc": report.exc,
+        "summaries": [
+            dataclasses.asdict(summary) for summary in report.summaries.values()
+        ],
+    }
+
+
+def _get_mail_digest(project: "Project") -> Optional[MailDigest]:
+    from pipedput.app import app
+
+    if project.mail_digest is not None:
+        return project.mail_digest
+    return app.config.get("MAIL_DIGEST", None)
+
+
+def _add_to_digest(
+    project: "Project",
+    event: GitLabPipelineEvent,
+    report: DeploymentReport,
+    mail_digest: MailDigest,
+):
+    get_digest_store().add(
+        [
+            (mail_digest.get_group_key(project.key, email), email, name)
+            for email, name in _get_digest_recipients(project, event)
+        ],
+        _get_digest_data(event, report),
+        mail_digest.interval,
+    )
+    logger.info(
+        "Added deployment report for %s to the mail digest.",
+        event["project"]["path_with_namespace"],
+    )
+
+
+def _send_digest_mail(digest: Digest):
+    from pipedput.app import app
+
+    projects = sorted({entry["project"] for entry in digest.entries})
+    subject = f"[pipedput] {', '.join(projects)} deployment digest"
+    if len(projects) > 3:
+        subject = f"[pipedput] deployment digest for {len(projects)} projects"
+    with app.app_context():
+        deployment_documentation = app.config.get("DEPLOYMENT_DOCUMENTATION_URL", "")
+    send_mail(
+        subject=subject,
+        recipients=[digest.recipient],
+        html=render_template(
+            "mails/digest.html",
+            digest=digest,
+            deployment_documentation=deployment_documentation,
+        ),
+    )
+
+
+def send_due_digests(force: bool = False) -> int:
+    """
+    Sends all digests whose window has passed and returns the number of
+    sent digests. Digests that could not be sent are retried later.
+
+    :param force: send all pending digests regardless of their window
+    """
+    digest_store = get_digest_store()
+    sent = 0
+    for digest in digest_store.claim_due(force=force):
+        try:
+            _send_digest_mail(digest)
+        except Exception:
+            logger.exception("Could not send mail digest to %s.", digest.recipient)
+            digest_store.release(digest)
+        else:
+            digest_store.complete(digest)
+            sent += 1
+    return sent
+
+
+def _send_digests_periodically():
+    from pipedput.app import app
+
+    while True:
+        # digests that became due while no process was running are sent
+        # right away
+        try:
+            send_due_digests()
+        except Exception:
+            logger.exception("Could not send mail digests.")
+        time.sleep(app.config.get("MAIL_DIGEST_POLL_INTERVAL", 30))
+
+
+_digest_store: Optional[DigestStore] = None
+_digest_sender_pid: Optional[int] = None
+_digest_store_lock = threading.Lock()
+
+
+def _get_digest_store_path() -> str:
+    from pipedput.app import app
+
+    return app.config.get("MAIL_DIGEST_DB", None) or os.path.join(
+        tempfile.gettempdir(), "pipedput-digests.sqlite3"
+    )
+
+
+def get_digest_store() -> DigestStore:
+    """
+    Returns the digest store of the current process and starts the thread
+    that sends due digests.
+    """
+    global _digest_store, _digest_sender_pid
+
+    path = _get_digest_store_path()
+    with _digest_store_lock:
+        if _digest_store is None or _digest_store.path != path:
+            _digest_store = DigestStore(path)
+        if _digest_sender_pid != os.getpid():
+            _digest_sender_pid = os.getpid()
+            threading.Thread(
+                target=_send_digests_periodically,
+                name="pipedput-digests",
+                daemon=True,
+            ).start()
+        return _digest_store
+
+
+def resume_digests():
+    """
+    Starts sending the digests that are pending from before a restart, so
+    that they don’t wait for the next pipeline event.
+    """
+    if _digest_sender_pid != os.getpid() and os.path.exists(_get_digest_store_path()):
+        get_digest_store()
+
+
+def _prepare_process():
+    from pipedput.app import prepare_process
+
+    prepare_process()
+
+
+def _maintain_event_store():
+    from pipedput.app import maintain_event_store
+
+    maintain_event_store()
+
+
+def _report_deployments(
+    project: "Project",
+    event: GitLabPipelineEvent,
+    deployments: Iterable[DeploymentStateLike],
+    exc: Optional[Exception] = None,
+):
+    """
+    Sends a single report for all deployments. The deployments are consumed
+    one after another. If deployments raises an error, the error is reported
+    together with the deployments that were completed before.
+    """
+    report = DeploymentReport()
+    try:
+        for deployment in deployments:
+            logger.info(
+                "Deployment of %s to %s completed %s.",
+                deployment.asset,
+                deployment.target_name,
+                "with success" if deployment.was_successful else "with failures",
+            )
+            report.add(deployment)
+    except Exception as deployment_exc:
+        exc = deployment_exc
+    if exc is not None:
+        logger.error("Intercepted unexpected error %s.", str(exc), exc_info=exc)
+        report.set_error(exc)
+    if not report.notify:
+        return
+    mail_digest = _get_mail_digest(project)
+    if mail_digest is not None and mail_digest.accepts(report):
+        _add_to_digest(project, event, report, mail_digest)
+    else:
+        _send_report_mail(
+            project,
+            event,
+            create_template_renderer(
+                "mails/deployment.html", event=event, report=report
+            ),
+        )
+
+
+def _report_error(
+    project: "Project",
+    event: GitLabPipelineEvent,
+    exc: Exception,
+    deployments: Iterable[DeploymentStateLike] = (),
+):
+    _report_deployments(project, event, deployments, exc)
+
+
 def _handle_error():
     def decorator(func):
         @functools.wraps(func)
@@ -100,12 +350,7 @@ def _handle_error():
             try:
                 func(project, event)
             except Exception as exc:
-                logger.error("Intercepted unexpected error %s.", str(exc), exc_info=exc)
-                _send_report_mail(
-                    project,
-                    event,
-                    create_template_renderer("mails/error.html", event=event, exc=exc),
-                )
+                _report_error(project, event, exc)
 
         return wrapper
 
@@ -118,24 +363,76 @@ def _handle_deployment_report():
     ):
         @functools.wraps(func)
         def wrapper(project: Project, event: GitLabPipelineEvent):
-            notify = False
-            deployments = []
-            for deployment in func(project, event):
-                logger.info(
-                    "Deployment to %s completed %s.",
-                    deployment.target_name,
-                    "with success" if deployment.was_successful else "with failures",
-                )
-                notify |= deployment.notify
-                deployments.append(deployment)
-            if notify:
-                _send_report_mail(
-                    project,
-                    event,
-                    create_template_renderer(
-                        "mails/deployment.html", event=event, deployments=deployments
-                    ),
-                )
+            _report_deployments(project, event, func(project, event))
+
+        return wrapper
+
+    return decorator
+
+
+def _start_admitted_event(event: GitLabPipelineEvent) -> bool:
+    """returns False if the event has been superseded while it was waiting"""
+    from pipedput.app import get_admission_store
+
+    ticket = admission.get_ticket()
+    if ticket is None:
+        return True
+    admission_store = get_admission_store()
+    if admission_store is None:
+        return True
+    try:
+        started = admission_store.start(ticket)
+    except Exception:
+        logger.exception("Could not start admission ticket %d.", ticket)
+        return True
+    if not started:
+        logger.info(
+            "Skipped event of pipeline %s that has been superseded by a newer event.",
+            event["object_attributes"]["id"],
+        )
+    return started
+
+
+def _finish_admitted_event():
+    from pipedput.app import get_admission_store
+
+    ticket = admission.get_ticket()
+    if ticket is None:
+        return
+    admission_store = get_admission_store()
+    if admission_store is None:
+        return
+    try:
+        admission_store.finish(ticket)
+    except Exception:
+        logger.exception("Could not finish admission ticket %d.", ticket)
+
+
+def _handle_admission():
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(project: Project, event: GitLabPipelineEvent):
+            try:
+                if _start_admitted_event(event):
+                    func(project, event)
+            finally:
+                _finish_admitted_event()
+
+        return wrapper
+
+    return decorator
+
+
+def _trace_pipeline():
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(project: Project, event: GitLabPipelineEvent):
+            with tracing.span(
+                "process pipeline",
+                project_key=project.key,
+                pipeline_id=event["object_attributes"]["id"],
+            ):
+                func(project, event)
 
         return wrapper
 
@@ -163,9 +460,13 @@ class Project:
         self,
         key: str,
         hooks: Optional[Union[HookLike, Iterable[HookLike]]] = None,
-        pipeline_secret: Optional[str] = None,
+        pipeline_secret: Optional[Union[str, Iterable[str]]] = None,
         artifact_download_token: Optional[str] = None,
         maintainers: Iterable[Contact] = tuple(),
+        priority: int = 0,
+        max_concurrent_runs: int = 1,
+        extraction_limits: Optional[ExtractionLimits] = None,
+        mail_digest: Optional[MailDigest] = None,
     ) -> None:
         """
         :param key: the unique project key
@@ -175,7 +476,8 @@ class Project:
         :param pipeline_secret:
             Refers to the 'Secret Token' field that can and SHOULD be defined
             for each web-hook and is used to check if the pipeline event
-            originates from your GitLab.
+            originates from your GitLab. Pass multiple secrets if you want
+            to rotate them without rejecting pipeline events in the meantime.
         :param artifact_download_token:
             A GitLab API token with `api` scope in case you want pipedput to act
             on pipeline events for a private project.
@@ -183,11 +485,33 @@ class Project:
             An iterable of Contact instances representing the project maintainers.
             People listed as maintainers will receive status mails for all
             errors and deployments.
+        :param priority:
+            Pending pipeline events of projects with a higher priority are
+            processed before those of projects with a lower priority.
+        :param max_concurrent_runs:
+            The maximum number of pipeline events of this project that are
+            processed at the same time.
+        :param extraction_limits:
+            Limits for extracting the artifact archives of this project.
+            Defaults to the EXTRACTION_LIMITS config variable.
+        :param mail_digest:
+            Sends the deployment reports of this project as a periodic digest.
+            Defaults to the MAIL_DIGEST config variable.
         """
         self.key = key
         self.pipeline_secret = pipeline_secret
         self.artifact_download_token = artifact_download_token
         self.maintainers = maintainers
+        self.priority = priority
+        self.max_concurrent_runs = max_concurrent_runs
+        self.extraction_limits = extraction_limits
+        self.mail_digest = mail_digest
+        if pipeline_secret is None:
+            self.pipeline_secrets: Tuple[str, ...] = tuple()
+        elif isinstance(pipeline_secret, str):
+            self.pipeline_secrets = (pipeline_secret,)
+        else:
+            self.pipeline_secrets = tuple(pipeline_secret)
         if hooks is None:
             self.hooks = []
         elif isinstance(hooks, Iterable):
@@ -200,23 +524,261 @@ class Project:
         return self
 
 
+_workspace_manager: Optional[WorkspaceManager] = None
+_workspace_manager_lock = threading.Lock()
+
+
+def get_workspace_manager() -> WorkspaceManager:
+    """
+    Returns the workspace manager of the current process. Workspaces of
+    crashed processes are removed once the manager has been created.
+    """
+    global _workspace_manager
+    from pipedput.app import app
+
+    root = app.config.get("WORKSPACE_ROOT", None)
+    with _workspace_manager_lock:
+        if _workspace_manager is None or _workspace_manager.root != (
+            root or tempfile.gettempdir()
+        ):
+            _workspace_manager = WorkspaceManager(root)
+            _workspace_manager.cleanup_orphans()
+        _workspace_manager.expansion_factor = app.config.get(
+            "WORKSPACE_EXPANSION_FACTOR", WorkspaceManager.DEFAULT_EXPANSION_FACTOR
+        )
+        _workspace_manager.min_free_bytes = app.config.get(
+            "WORKSPACE_MIN_FREE_BYTES", 0
+        )
+        _workspace_manager.wait_timeout = app.config.get("WORKSPACE_WAIT_TIMEOUT", 600)
+        return _workspace_manager
+
+
+def _get_extraction_limits(project: Project) -> Optional[ExtractionLimits]:
+    from pipedput.app import app
+
+    if project.extraction_limits is not None:
+        return project.extraction_limits
+    return app.config.get("EXTRACTION_LIMITS", None)
+
+
+def _extraction_error(url: str, exc: ExtractionLimits.Exceeded) -> DeploymentState:
+    logger.warning("Refused to extract artifact archive from '%s': %s", url, exc)
+    return DeploymentState(
+        "artifact extraction", False, notify=True, asset=url, exc=exc
+    )
+
+
 def _process_artifact(
-    project: Project, url: str, event: GitLabPipelineEvent
+    project: Project,
+    url: str,
+    event: GitLabPipelineEvent,
+    size: Optional[int] = None,
 ) -> Iterator[DeploymentStateLike]:
-    with tempfile.TemporaryDirectory() as run_dir:
-        artifact_file = os.path.join(run_dir, "artifacts.zip")
-        artifact_dir = os.path.join(run_dir, "data")
+    with get_workspace_manager().acquire(size) as workspace:
+        artifact_file = os.path.join(workspace.path, "artifacts.zip")
+        artifact_dir = os.path.join(workspace.path, "data")
         logger.info("Downloading artifact archive from '{}'.".format(url))
-        download_file(url, artifact_file, project.artifact_download_token)
-        unzip(artifact_file, artifact_dir)
+        with stage("download", url=url):
+            download_file(url, artifact_file, project.artifact_download_token)
+        try:
+            with stage("extract", url=url):
+                unzip(artifact_file, artifact_dir, _get_extraction_limits(project))
+        except ExtractionLimits.Exceeded as exc:
+            yield _extraction_error(url, exc)
+            return
         for hook in project.hooks:
-            yield from hook(event, artifact_dir)
+            with log_context(hook=hook.name), stage("hook", hook=hook.name):
+                yield from hook(event, artifact_dir)
 
 
-@mulefunc
+def _should_process(project: Project, event: GitLabPipelineEvent) -> bool:
+    with stage("constraints"):
+        return any(hook.should_execute_for(event) for hook in project.hooks)
+
+
+def _deploy(
+    project: Project, event: GitLabPipelineEvent
+) -> Iterator[DeploymentStateLike]:
+    if _should_process(project, event):
+        for artifact_url, artifact_size in _get_artifacts(event):
+            yield from _process_artifact(project, artifact_url, event, artifact_size)
+
+
+@_handle_admission()
+@_trace_pipeline()
 @_handle_error()
 @_handle_deployment_report()
-def process_project_pipeline(project: Project, event: GitLabPipelineEvent):
-    if any(hook.should_execute_for(event) for hook in project.hooks):
-        for artifact_url in _get_artifact_urls(event):
-            yield from _process_artifact(project, artifact_url, event)
+def _process_project_pipeline(project: Project, event: GitLabPipelineEvent):
+    yield from _deploy(project, event)
+
+
+def _run_inline(project: Project, event: GitLabPipelineEvent) -> Future:
+    future: Future = Future()
+    try:
+        _process_project_pipeline(project, event)
+    except BaseException as exc:
+        future.set_exception(exc)
+    else:
+        future.set_result(None)
+    return future
+
+
+def _submit_in_context(
+    executor: ThreadPoolExecutor, project: Project, event: GitLabPipelineEvent
+) -> Future:
+    # worker threads don’t inherit the log context of the scheduler
+    return executor.submit(
+        contextvars.copy_context().run, _process_project_pipeline, project, event
+    )
+
+
+# the number of mules pipedput ran before events were scheduled in one mule
+DEFAULT_SCHEDULER_WORKERS = 4
+_scheduler: Optional[Scheduler] = None
+_scheduler_is_inline = False
+_scheduler_lanes: Tuple[Lane, ...] = ()
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """
+    Returns the scheduler of the current process.
+
+    Depending on the configuration events are processed by the async engine
+    (ASYNC_ENGINE), by a pool of SCHEDULER_WORKERS threads or, if
+    SCHEDULER_WORKERS is 0, one after another in the thread that submitted
+    them.
+    """
+    global _scheduler, _scheduler_is_inline, _scheduler_lanes
+    from pipedput.app import app
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            workers = app.config.get("SCHEDULER_WORKERS", DEFAULT_SCHEDULER_WORKERS)
+            if app.config.get("ASYNC_ENGINE", False):
+                from pipedput.aio import AsyncEngine, get_engine
+
+                concurrency = app.config.get(
+                    "ASYNC_ENGINE_CONCURRENCY", AsyncEngine.DEFAULT_CONCURRENCY
+                )
+                engine = get_engine(concurrency)
+                _scheduler = Scheduler(engine.submit, concurrency)
+            elif workers:
+                executor = ThreadPoolExecutor(
+                    workers, thread_name_prefix="pipedput-worker"
+                )
+                _scheduler = Scheduler(
+                    functools.partial(_submit_in_context, executor), workers
+                )
+            else:
+                _scheduler = Scheduler(_run_inline)
+                _scheduler_is_inline = True
+        lanes = tuple(app.config.get("PRIORITY_LANES", ()))
+        if lanes != _scheduler_lanes:
+            _scheduler.set_lanes(lanes)
+            _scheduler_lanes = lanes
+            if lanes and _scheduler_is_inline:
+                logger.warning(
+                    "PRIORITY_LANES have no effect, because SCHEDULER_WORKERS is 0 "
+                    "and events are processed in the order they are received."
+                )
+        return _scheduler
+
+
+def _submit_work_item(item: WorkItem) -> Future:
+    from pipedput.app import get_project_by_key
+
+    try:
+        project = get_project_by_key(item.project_key)
+    except Project.DoesNotExist:
+        logger.warning(
+            "Dropped event %s of unknown project %s.", item.id, item.project_key
+        )
+        future: Future = Future()
+        future.set_result(None)
+        return future
+    with log_context(
+        correlation_id=item.correlation_id or new_correlation_id(),
+        project_key=project.key,
+        pipeline_id=item.event.get("object_attributes", {}).get("id", None),
+    ), tracing.span(
+        "dequeue pipeline", traceparent=item.traceparent, attempt=item.attempts
+    ):
+        return get_scheduler().submit(project, item.event, item.lane)
+
+
+_queue_consumer: Optional[QueueConsumer] = None
+_queue_consumer_pid: Optional[int] = None
+_queue_consumer_lock = threading.Lock()
+
+
+def get_queue_consumer() -> Optional[QueueConsumer]:
+    """
+    Returns the consumer of the shared work queue (WORK_QUEUE) of the current
+    process and starts it. Returns None if no work queue is configured.
+    """
+    global _queue_consumer, _queue_consumer_pid
+    from pipedput.app import app
+
+    backend = app.config.get("WORK_QUEUE", None)
+    with _queue_consumer_lock:
+        consumer = _queue_consumer
+        if _queue_consumer_pid == os.getpid():
+            if consumer is not None and consumer.backend is backend:
+                return consumer
+            if consumer is not None:
+                consumer.stop()
+        elif backend is None:
+            return None
+        _queue_consumer = None
+        _queue_consumer_pid = os.getpid()
+        if backend is not None:
+            _queue_consumer = QueueConsumer(
+                backend,
+                _submit_work_item,
+                get_scheduler().capacity,
+                app.config.get("WORK_QUEUE_POLL_INTERVAL", 1),
+            )
+            _queue_consumer.start()
+        return _queue_consumer
+
+
+@mulefunc
+def process_project_pipeline(
+    project: Project,
+    event: GitLabPipelineEvent,
+    correlation_id: Optional[str] = None,
+    traceparent: Optional[str] = None,
+    ticket: Optional[int] = None,
+    lane: Optional[str] = None,
+):
+    # mules don’t handle requests, so they need to prepare themselves
+    _prepare_process()
+    # the log context doesn’t cross process boundaries
+    with log_context(
+        correlation_id=correlation_id or new_correlation_id(),
+        project_key=project.key,
+        pipeline_id=event.get("object_attributes", {}).get("id", None),
+    ), tracing.span(
+        "schedule pipeline", traceparent=traceparent
+    ), admission.ticket_context(
+        ticket
+    ):
+        queue_consumer = get_queue_consumer()
+        if queue_consumer is None:
+            get_scheduler().submit(project, event, lane)
+        else:
+            # any node may process the event
+            queue_consumer.backend.put(
+                project.key,
+                event,
+                get_correlation_id(),
+                tracing.get_traceparent(),
+                lane,
+            )
+            # the work queue counts towards the admission limits on its own
+            _finish_admitted_event()
+            queue_consumer.wake()
+    resume_digests()
+    # compressing segments is too expensive for the web-hook endpoint
+    _maintain_event_store()
@@ -1,3 +1,4 @@
+import contextlib
 import dataclasses
 import glob
 import logging
@@ -6,11 +7,18 @@ import re
 import subprocess
 import tarfile
 import tempfile
+import time
 from typing import Any, Iterator, Mapping, Optional, Sequence
 from urllib.parse import urlsplit
 
+from pipedput import locks, process
+from pipedput.constraints import compile_constraint
 from pipedput.typing import Constraint, DeploymentStateLike, GitLabPipelineEvent
-from pipedput.utils import Configuration, get_api_base_url_from_event
+from pipedput.utils import (
+    Configuration,
+    get_api_base_url_from_event,
+    publish_file,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +31,8 @@ class DeploymentState:
     asset: Optional[str] = None
     exc: Optional[Exception] = None
     error: Optional[str] = None
+    # seconds the hook spent on this deployment
+    duration: Optional[float] = None
 
 
 class Hook:
@@ -34,9 +44,14 @@ class Hook:
         should_deploy: Optional[Constraint] = None,
         name: Optional[str] = None,
         notify_on_success: bool = DEFAULT_NOTIFY,
+        process_limits: Optional[process.ProcessLimits] = None,
+        lock_key: Optional[str] = None,
     ):
         self._should_deploy = should_deploy
+        self._compiled_should_deploy = compile_constraint(should_deploy)
         self._notify_on_success = notify_on_success
+        self._process_limits = process_limits or process.ProcessLimits()
+        self._lock_key = lock_key
         if name is not None:
             self.name = name
         elif self.DEFAULT_NAME is not None:
@@ -52,9 +67,53 @@ class Hook:
         notify = kwargs.pop("notify", self._notify_on_success)
         return DeploymentState(self.name, True, notify=notify, **kwargs)
 
+    def _publish(
+        self, artifact_path: str, destination: str, allow_hardlink: bool = True
+    ) -> str:
+        """
+        Publishes an extracted artifact to destination, preferably without
+        copying it. See pipedput.utils.publish_file.
+        """
+        method = publish_file(artifact_path, destination, allow_hardlink)
+        logger.debug(
+            "Hook %s published %s to %s using %s.",
+            self.name,
+            artifact_path,
+            destination,
+            method,
+        )
+        return method
+
+    def _run(
+        self, cmd: Sequence[str], check: bool = True, cwd: Optional[str] = None
+    ) -> process.ProcessResult:
+        """
+        Runs an external command within the process limits of the hook.
+        See pipedput.process.run.
+
+        :raises pipedput.locks.LockLost:
+            if the lock of the hook has been taken over by another holder
+        """
+        locks.check_leases()
+        return process.run(cmd, limits=self._process_limits, check=check, cwd=cwd)
+
+    def get_lock_key(self, event: GitLabPipelineEvent) -> Optional[str]:
+        """
+        Returns the key of the lock that is held while the hook deploys, e.g.
+        the repository it uploads to. Hooks with the same key don’t deploy
+        at the same time. None disables locking.
+        """
+        return self._lock_key
+
+    def _lock(self, event: GitLabPipelineEvent):
+        lock_key = self.get_lock_key(event)
+        if lock_key is None:
+            return contextlib.nullcontext()
+        return locks.hold(lock_key)
+
     def should_execute_for(self, event: GitLabPipelineEvent) -> bool:
-        if self._should_deploy is not None:
-            return self._should_deploy(event)
+        if self._compiled_should_deploy is not None:
+            return self._compiled_should_deploy(event)
         else:
             return True
 
@@ -63,14 +122,26 @@ class Hook:
     ) -> Iterator[DeploymentStateLike]:
         raise NotImplementedError()
 
+    @staticmethod
+    def _timed(
+        deployment: DeploymentStateLike, started_at: float
+    ) -> DeploymentStateLike:
+        if isinstance(deployment, DeploymentState) and deployment.duration is None:
+            deployment.duration = time.perf_counter() - started_at
+        return deployment
+
     def __call__(
         self, event: GitLabPipelineEvent, artifacts_directory: str
     ) -> Iterator[DeploymentStateLike]:
         if self.should_execute_for(event):
+            started_at = time.perf_counter()
             try:
-                yield from self._execute(event, artifacts_directory)
+                with self._lock(event):
+                    for deployment in self._execute(event, artifacts_directory):
+                        yield self._timed(deployment, started_at)
+                        started_at = time.perf_counter()
             except Exception as exc:
-                yield self._error(exc=exc)
+                yield self._timed(self._error(exc=exc), started_at)
 
 
 class GetVersionMixin:
@@ -101,17 +172,15 @@ class GetVersionMixin:
         """Retrieves a human-readable version name based on git-describe
         for the commit that triggered the pipeline"""
         self.check_prerequisites()
+        git = Configuration.get_bin_path("git")
         url = self._get_clone_url(event)
         with tempfile.TemporaryDirectory() as tmp_dir:
-            subprocess.run(
-                ["git", "clone", "--bare", url, tmp_dir],
-                stderr=subprocess.PIPE,
-            )
-            describe_output = subprocess.check_output(
-                ["git", "describe", "--always", "--tags", event["commit"]["id"]],
+            self._run([git, "clone", "--bare", url, tmp_dir], check=False)
+            describe_process = self._run(
+                [git, "describe", "--always", "--tags", event["commit"]["id"]],
                 cwd=tmp_dir,
             )
-            return describe_output.decode().strip()
+            return describe_process.stdout.decode().strip()
 
 
 class GenericGlobHook(Hook):
@@ -129,6 +198,10 @@ class GenericGlobHook(Hook):
     def _glob(self, path):
         return glob.iglob(path, recursive=True)
 
+    def find_artifacts(self, artifacts_directory: str) -> Iterator[str]:
+        """yields the paths of all files that match the glob pattern"""
+        return self._glob(os.path.join(artifacts_directory, self._glob_pattern))
+
     def _get_context(
         self, event: GitLabPipelineEvent, artifacts_directory: str
     ) -> Mapping[str, Any]:
@@ -142,9 +215,7 @@ class GenericGlobHook(Hook):
     ) -> Iterator[DeploymentStateLike]:
         ctx = self._get_context(event, artifacts_directory)
         had_match = False
-        for filepath in self._glob(
-            os.path.join(artifacts_directory, self._glob_pattern)
-        ):
+        for filepath in self.find_artifacts(artifacts_directory):
             had_match = True
             filename = os.path.basename(filepath)
             yield from self._handle_artifact(event, filepath, filename, **ctx)
@@ -199,6 +270,14 @@ class PublishToPythonRepository(GenericGlobHook):
         if self._pypirc_path is not None:
             Configuration.check_file_exists(self._pypirc_path, warn_only=warn_only)
 
+    def get_lock_key(self, event: GitLabPipelineEvent) -> Optional[str]:
+        if self._lock_key is not None:
+            return self._lock_key
+        if self._publish_to_gitlab:
+            gitlab_api_url = get_api_base_url_from_event(event)
+            return f"python:{gitlab_api_url}/projects/{event['project']['id']}"
+        return f"python:{self._repository or 'pypi'}"
+
     def _is_python_distributable(self, filepath):
         with tarfile.open(filepath) as tar:
             for member in tar.getmembers():
@@ -225,14 +304,10 @@ class PublishToPythonRepository(GenericGlobHook):
                 args.extend(["--repository-url", self._repository])
             else:
                 args.extend(["--repository", self._repository])
-        cmd = ["twine", "upload", *args, dist_path]
+        cmd = [Configuration.get_bin_path("twine"), "upload", *args, dist_path]
 
         try:
-            return subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-            )
+            return self._run(cmd)
         except subprocess.CalledProcessError as exc:
             logger.error(
                 "Could not upload python distributable with twine.",
@@ -275,7 +350,7 @@ class PublishToPythonRepository(GenericGlobHook):
                 twine_kwargs["repository_url"] = pypi_repo_url
             try:
                 process = self._twine(artifact_path, twine_args, **twine_kwargs)
-            except subprocess.CalledProcessError as exc:
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
                 logger.error(
                     "Unable to upload python distributable %s for pipeline %s.",
                     artifact_name,
@@ -306,6 +381,12 @@ class PublishToDebRepository(GenericGlobHook):
         Configuration.check_bin_exists("dput", warn_only=warn_only)
         Configuration.check_file_exists(self._dput_config_path, warn_only=warn_only)
 
+    def get_lock_key(self, event: GitLabPipelineEvent) -> Optional[str]:
+        if self._lock_key is not None:
+            return self._lock_key
+        # the repository is defined by the dput configuration
+        return f"deb:{os.path.abspath(self._dput_config_path)}"
+
     def _dput(
         self, change_path: str, dput_args: Optional[Sequence[str]] = None
     ) -> subprocess.CompletedProcess:
@@ -313,14 +394,15 @@ class PublishToDebRepository(GenericGlobHook):
         args = list(dput_args) if dput_args is not None else []
         if self.DPUT_ARGS:
             args.extend(self.DPUT_ARGS)
-        cmd = ["dput", "--config", self._dput_config_path, *args, change_path]
+        cmd = [
+            Configuration.get_bin_path("dput"),
+            "--config",
+            self._dput_config_path,
+            *args,
+            change_path,
+        ]
         try:
-            return subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+            return self._run(cmd)
         except subprocess.CalledProcessError as exc:
             # `dput` seems to use stdout for *all* problems/warnings/errors
             # Let's stick to emitting stderr, if it is non-empty and fall back to stdout.
@@ -359,7 +441,7 @@ class PublishToDebRepository(GenericGlobHook):
         )
         try:
             process = self._dput(artifact_path, dput_args)
-        except subprocess.CalledProcessError as exc:
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
             logger.error(
                 "Unable to upload change %s to deb repository for pipeline %s.",
                 artifact_name,
@@ -0,0 +1,36 @@
+"""
+Observers for the processing stages of a pipeline event.
+
+The handler wraps every stage (constraint evaluation, download, extraction
+and hook execution) in stage(). Observers are context manager factories
+that are entered for the duration of each stage and may be used for
+profiling, logging or tracing. stage() does nothing if no observer has been
+registered.
+"""
+
+import contextlib
+from typing import Any, Callable, ContextManager, Dict, Iterator, List
+
+StageObserver = Callable[[str, Dict[str, Any]], ContextManager]
+
+_observers: List[StageObserver] = []
+
+
+def add_observer(observer: StageObserver) -> StageObserver:
+    _observers.append(observer)
+    return observer
+
+
+def remove_observer(observer: StageObserver) -> None:
+    _observers.remove(observer)
+
+
+@contextlib.contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[None]:
+    if not _observers:
+        yield
+        return
+    with contextlib.ExitStack() as stack:
+        for observer in tuple(_observers):
+            stack.enter_context(observer(name, attributes))
+        yield
@@ -0,0 +1,360 @@
+"""
+Locks that serialize the deployments of hooks to the same target.
+
+Hooks declare a lock key, e.g. the repository they upload to, and hold the
+lock while they deploy. Locks are leases with a time to live that are
+renewed while they are held, so the lock of a crashed holder becomes
+available once its lease has expired. Every acquisition is assigned a
+fencing token that is larger than the tokens of all earlier acquisitions of
+the same key. Hooks check that their token is still current before they
+run a command, so a holder whose lease expired, e.g. because its node was
+paused, cannot upload after another holder has taken over.
+
+LocalLockBackend, the default, serializes the hooks of one process.
+FileLockBackend serializes the hooks of several nodes through a directory
+on a shared filesystem that supports flock, e.g. NFS. Its leases are compared with the clock of each
+node, so the clocks of all nodes must be synchronized.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class LockLost(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Lease:
+    key: str
+    owner: str
+    token: int
+    lost: threading.Event = dataclasses.field(
+        default_factory=threading.Event, compare=False
+    )
+
+
+class LockBackend:
+    def __init__(self, ttl: float = 60, timeout: float = 600) -> None:
+        """
+        :param ttl:
+            seconds after which a lock is released unless its holder renews it
+        :param timeout: seconds a hook waits for a lock before it fails
+        """
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def try_acquire(
+        self, key: str, owner: str, now: Optional[float] = None
+    ) -> Optional[int]:
+        """acquires the lock without waiting and returns its fencing token"""
+        raise NotImplementedError()
+
+    def renew(
+        self, key: str, owner: str, token: int, now: Optional[float] = None
+    ) -> bool:
+        """extends the lease of a lock and returns False if it has been lost"""
+        raise NotImplementedError()
+
+    def release(self, key: str, owner: str, token: int) -> None:
+        raise NotImplementedError()
+
+    def acquire(self, key: str) -> Lease:
+        """
+        Waits up to timeout seconds for the lock.
+
+        :raises LockTimeout: if the lock could not be acquired in time
+        """
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        delay = 0.01
+        while True:
+            token = self.try_acquire(key, owner)
+            if token is not None:
+                return Lease(key, owner, token)
+            if time.monotonic() >= deadline:
+                raise LockTimeout(
+                    f"Could not acquire the lock {key} within {self.timeout}s."
+                )
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 1)
+
+
+class LocalLockBackend(LockBackend):
+    """locks for the threads of one process"""
+
+    def __init__(self, ttl: float = 60, timeout: float = 600) -> None:
+        super().__init__(ttl, timeout)
+        self._lock = threading.Lock()
+        # key -> (owner, token, expires_at)
+        self._holders: Dict[str, Tuple[Optional[str], int, float]] = {}
+
+    def try_acquire(
+        self, key: str, owner: str, now: Optional[float] = None
+    ) -> Optional[int]:
+        now = time.time() if now is None else now
+        with self._lock:
+            holder, token, expires_at = self._holders.get(key, (None, 0, 0))
+            if holder is not None and expires_at >= now:
+                return None
+            self._holders[key] = (owner, token + 1, now + self.ttl)
+            return token + 1
+
+    def renew(
+        self, key: str, owner: str, token: int, now: Optional[float] = None
+    ) -> bool:
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._holders.get(key, (None, 0, 0))[:2] != (owner, token):
+                return False
+            self._holders[key] = (owner, token, now + self.ttl)
+            return True
+
+    def release(self, key: str, owner: str, token: int) -> None:
+        with self._lock:
+            if self._holders.get(key, (None, 0, 0))[:2] == (owner, token):
+                # the token survives, so tokens keep increasing
+                self._holders[key] = (None, token, 0)
+
+
+class FileLockBackend(LockBackend):
+    """
+    Locks in a directory that is shared by several nodes. The state of every
+    lock is a JSON file. Changes to it are guarded by an flock on a separate
+    guard file, which the kernel releases if its holder crashes.
+    """
+
+    def __init__(self, directory: str, ttl: float = 60, timeout: float = 600) -> None:
+        """
+        :param directory: the directory that contains the locks
+        """
+        super().__init__(ttl, timeout)
+        self.directory = directory
+        # flock emulated with POSIX locks, e.g. on NFS, doesn’t exclude the
+        # threads of a process from each other
+        self._thread_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        name = re.sub(r"[^A-Za-z0-9_-]+", "_", key)[:64]
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{digest}.lock")
+
+    @contextlib.contextmanager
+    def _guard(self, path: str) -> Iterator[None]:
+        # guard files are never removed, removing them would let a waiter
+        # lock a file that is no longer the guard
+        with self._thread_lock, open(path + ".guard", "a") as guard_file:
+            fcntl.flock(guard_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(guard_file.fileno(), fcntl.LOCK_UN)
+
+    def _read(self, path: str) -> Dict[str, Any]:
+        try:
+            with open(path) as lock_file:
+                return json.load(lock_file)
+        except FileNotFoundError:
+            return {"owner": None, "token": 0, "expires_at": 0}
+
+    def _write(self, path: str, state: Dict[str, Any]) -> None:
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as lock_file:
+            json.dump(state, lock_file)
+        os.replace(tmp_path, path)
+
+    def try_acquire(
+        self, key: str, owner: str, now: Optional[float] = None
+    ) -> Optional[int]:
+        now = time.time() if now is None else now
+        path = self._path(key)
+        with self._guard(path):
+            state = self._read(path)
+            if state["owner"] is not None and state["expires_at"] >= now:
+                return None
+            token = state["token"] + 1
+            self._write(
+                path,
+                {
+                    "key": key,
+                    "owner": owner,
+                    "token": token,
+                    "expires_at": now + self.ttl,
+                },
+            )
+            return token
+
+    def renew(
+        self, key: str, owner: str, token: int, now: Optional[float] = None
+    ) -> bool:
+        now = time.time() if now is None else now
+        path = self._path(key)
+        with self._guard(path):
+            state = self._read(path)
+            if (state["owner"], state["token"]) != (owner, token):
+                return False
+            state["expires_at"] = now + self.ttl
+            self._write(path, state)
+            return True
+
+    def release(self, key: str, owner: str, token: int) -> None:
+        path = self._path(key)
+        with self._guard(path):
+            state = self._read(path)
+            if (state["owner"], state["token"]) == (owner, token):
+                # the token survives, so tokens keep increasing
+                state.update(owner=None, expires_at=0)
+                self._write(path, state)
+
+
+_default_backend = LocalLockBackend()
+_backend: LockBackend = _default_backend
+_leases: contextvars.ContextVar[Tuple[Tuple[LockBackend, Lease], ...]] = (
+    contextvars.ContextVar("pipedput_leases", default=())
+)
+
+
+def set_backend(backend: Optional[LockBackend]) -> None:
+    """sets the lock backend, None restores the LocalLockBackend"""
+    global _backend
+    _backend = backend if backend is not None else _default_backend
+
+
+def get_backend() -> LockBackend:
+    return _backend
+
+
+def _renew_periodically(backend: LockBackend, lease: Lease, stopped: threading.Event):
+    while not stopped.wait(backend.ttl / 3):
+        try:
+            renewed = backend.renew(lease.key, lease.owner, lease.token)
+        except Exception:
+            logger.exception("Could not renew the lock %s.", lease.key)
+            continue
+        if not renewed:
+            logger.warning(
+                "Lost the lock %s with fencing token %d.", lease.key, lease.token
+            )
+            lease.lost.set()
+            return
+
+
+def _acquire(backend: LockBackend, key: str) -> Lease:
+    started_at = time.monotonic()
+    lease = backend.acquire(key)
+    logger.debug(
+        "Acquired the lock %s with fencing token %d after %.3fs.",
+        key,
+        lease.token,
+        time.monotonic() - started_at,
+    )
+    return lease
+
+
+def _release(backend: LockBackend, lease: Lease) -> None:
+    try:
+        backend.release(lease.key, lease.owner, lease.token)
+    except Exception:
+        logger.exception("Could not release the lock %s.", lease.key)
+
+
+def _release_acquired(backend: LockBackend, future: "asyncio.Future[Lease]") -> None:
+    if not future.cancelled() and future.exception() is None:
+        _release(backend, future.result())
+
+
+@contextlib.contextmanager
+def _holding(backend: LockBackend, lease: Lease) -> Iterator[Lease]:
+    stopped = threading.Event()
+    threading.Thread(
+        target=_renew_periodically,
+        args=(backend, lease, stopped),
+        name="pipedput-lock",
+        daemon=True,
+    ).start()
+    token = _leases.set(_leases.get() + ((backend, lease),))
+    try:
+        yield lease
+    finally:
+        _leases.reset(token)
+        stopped.set()
+        _release(backend, lease)
+
+
+@contextlib.contextmanager
+def hold(key: str) -> Iterator[Lease]:
+    """
+    Acquires the lock key and holds it until the context is left.
+
+    :raises LockTimeout: if the lock could not be acquired in time
+    """
+    backend = _backend
+    with _holding(backend, _acquire(backend, key)) as lease:
+        yield lease
+
+
+@contextlib.asynccontextmanager
+async def hold_async(key: str) -> AsyncIterator[Lease]:
+    """
+    Like hold(), but waits for the lock in a thread of the default executor
+    of the event loop, so the loop isn’t blocked.
+
+    :raises LockTimeout: if the lock could not be acquired in time
+    """
+    backend = _backend
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, _acquire, backend, key)
+    try:
+        lease = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # the lock may still be acquired after the task has been cancelled
+        future.add_done_callback(functools.partial(_release_acquired, backend))
+        raise
+    with _holding(backend, lease):
+        yield lease
+
+
+def check_leases() -> None:
+    """
+    Verifies that the locks held by the current thread or task are still
+    held with their fencing token.
+
+    :raises LockLost: if another holder has taken over a lock
+    """
+    for backend, lease in _leases.get():
+        if lease.lost.is_set() or not backend.renew(
+            lease.key, lease.owner, lease.token
+        ):
+            lease.lost.set()
+            raise LockLost(
+                f"The lock {lease.key} with fencing token {lease.token} has been "
+                "taken over by another holder."
+            )
+
+
+def get_fencing_token(key: str) -> Optional[int]:
+    """returns the fencing token of the lock key if it is held"""
+    for _, lease in _leases.get():
+        if lease.key == key:
+            return lease.token
+    return None
@@ -0,0 +1,145 @@
+"""
+Structured logging with correlation IDs.
+
+Every accepted pipeline event is assigned a correlation ID. The ID, the
+project key, the pipeline id and the hook that is currently executed are
+stored in a context variable that is carried into the scheduler, its worker
+threads and the async engine. The JsonFormatter emits them with every log
+record. Records only keep a reference to the context when they are created
+and the fields are serialized once a handler actually formats the record.
+
+    import logging
+    from pipedput.log import configure_json_logging
+
+    configure_json_logging(level=logging.INFO)
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import sys
+import time
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, Mapping, Optional, TextIO
+import uuid
+
+from pipedput.instrumentation import add_observer, remove_observer
+
+_EMPTY_CONTEXT: Mapping[str, Any] = MappingProxyType({})
+_context: contextvars.ContextVar[Mapping[str, Any]] = contextvars.ContextVar(
+    "pipedput_log_context", default=_EMPTY_CONTEXT
+)
+
+# attributes of every LogRecord that are not emitted as extra fields
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "log_context"}
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex
+
+
+def get_log_context() -> Mapping[str, Any]:
+    return _context.get()
+
+
+def get_correlation_id() -> Optional[str]:
+    return _context.get().get("correlation_id", None)
+
+
+@contextlib.contextmanager
+def log_context(**fields: Any) -> Iterator[Mapping[str, Any]]:
+    """adds fields to the log context of the current thread or task"""
+    context = MappingProxyType({**_context.get(), **fields})
+    token = _context.set(context)
+    try:
+        yield context
+    finally:
+        _context.reset(token)
+
+
+class LogContextFilter(logging.Filter):
+    """attaches the current log context to records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "log_context"):
+            record.log_context = _context.get()
+        return True
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    return str(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """formats records as JSON objects, one per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "log_context", None) or _context.get())
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=_to_json)
+
+
+_stage_logger = logging.getLogger("pipedput.stages")
+
+
+@contextlib.contextmanager
+def log_stage(name: str, attributes: Dict[str, Any]) -> Iterator[None]:
+    """stage observer that logs the duration of every processing stage"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _stage_logger.isEnabledFor(logging.INFO):
+            duration = time.perf_counter() - started_at
+            _stage_logger.info(
+                "Finished stage %s in %.3fs.",
+                name,
+                duration,
+                extra=dict(stage=name, duration=duration, **attributes),
+            )
+
+
+_handler: Optional[logging.Handler] = None
+
+
+def configure_json_logging(
+    level: int = logging.INFO,
+    stream: Optional[TextIO] = None,
+    log_stages: bool = True,
+) -> logging.Handler:
+    """
+    Logs JSON records to stream (stderr by default) from the root logger.
+    Calling it again, e.g. after the config file has been reloaded, replaces
+    the handler that was installed before.
+
+    :param log_stages: log the duration of every processing stage
+    """
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    with contextlib.suppress(ValueError):
+        remove_observer(log_stage)
+    _handler = logging.StreamHandler(stream or sys.stderr)
+    _handler.addFilter(LogContextFilter())
+    _handler.setFormatter(JsonFormatter())
+    root.addHandler(_handler)
+    root.setLevel(level)
+    if log_stages:
+        add_observer(log_stage)
+    return _handler
@@ -0,0 +1,244 @@
+"""
+Runs the external commands of hooks.
+
+Commands run in their own process group, so that a timeout kills the command
+together with everything it has spawned. Their output is streamed to the log
+while they are running and only the last bytes of each stream are kept in
+memory. The run time and peak memory usage of every command are recorded on
+its result.
+"""
+
+import collections
+import dataclasses
+import logging
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+from typing import Deque, List, Optional, Sequence, Tuple
+
+from pipedput import tracing
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcessLimits:
+    """Limits for external commands. None disables a limit."""
+
+    # wall-clock seconds before the process group is killed
+    timeout: Optional[float] = 3600
+    # CPU seconds of the command (RLIMIT_CPU)
+    max_cpu_seconds: Optional[int] = None
+    # size of the address space of the command (RLIMIT_AS)
+    max_memory_bytes: Optional[int] = None
+    # bytes kept of each output stream, the log receives everything
+    max_output_bytes: int = 1024 * 1024
+
+
+class ProcessResult(subprocess.CompletedProcess):
+    def __init__(
+        self,
+        args: Sequence[str],
+        returncode: int,
+        stdout: bytes,
+        stderr: bytes,
+        duration: float,
+        max_rss: int,
+    ):
+        super().__init__(args, returncode, stdout, stderr)
+        # wall-clock seconds
+        self.duration = duration
+        # peak resident set size of the command in bytes
+        self.max_rss = max_rss
+
+
+class _OutputBuffer:
+    """keeps the last max_bytes bytes of a stream"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.truncated = False
+        self._chunks: Deque[bytes] = collections.deque()
+        self._size = 0
+
+    def append(self, chunk: bytes):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > self.max_bytes and self._chunks:
+            excess = self._size - self.max_bytes
+            head = self._chunks.popleft()
+            if len(head) > excess:
+                self._chunks.appendleft(head[excess:])
+                self._size -= excess
+            else:
+                self._size -= len(head)
+            self.truncated = True
+
+    def getvalue(self) -> bytes:
+        return b"".join(self._chunks)
+
+
+def _read_stream(stream, buffer: _OutputBuffer, name: str, stream_name: str):
+    with stream:
+        for line in iter(stream.readline, b""):
+            buffer.append(line)
+            logger.debug(
+                "%s %s: %s",
+                name,
+                stream_name,
+                line.decode(errors="replace").rstrip(),
+            )
+
+
+def _get_rlimits(limits: ProcessLimits) -> List[Tuple[int, int]]:
+    rlimits = []
+    if limits.max_cpu_seconds is not None:
+        rlimits.append((resource.RLIMIT_CPU, limits.max_cpu_seconds))
+    if limits.max_memory_bytes is not None:
+        rlimits.append((resource.RLIMIT_AS, limits.max_memory_bytes))
+    return rlimits
+
+
+def _set_rlimits(process: subprocess.Popen, limits: ProcessLimits):
+    # the limits are set from the outside, because running Python code
+    # between fork and exec can deadlock the child of a threaded process
+    for rlimit, value in _get_rlimits(limits):
+        try:
+            resource.prlimit(process.pid, rlimit, (value, value))
+        except ProcessLookupError:
+            # the command has already exited
+            return
+
+
+def _kill_group(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run(
+    cmd: Sequence[str],
+    limits: Optional[ProcessLimits] = None,
+    check: bool = True,
+    cwd: Optional[str] = None,
+) -> ProcessResult:
+    """
+    Runs cmd with stdout and stderr captured. Behaves like subprocess.run.
+
+    :raises subprocess.CalledProcessError:
+        if check is True and the command returned a non-zero exit code
+    :raises subprocess.TimeoutExpired:
+        if the command didn’t finish within limits.timeout
+    """
+    name = os.path.basename(cmd[0])
+    with tracing.span(f"exec {name}", command=name) as span:
+        result = _run(cmd, name, limits or ProcessLimits(), check, cwd)
+        if span is not None:
+            span.set_attribute("exit_code", result.returncode)
+            span.set_attribute("max_rss", result.max_rss)
+        return result
+
+
+def _run(
+    cmd: Sequence[str],
+    name: str,
+    limits: ProcessLimits,
+    check: bool,
+    cwd: Optional[str],
+) -> ProcessResult:
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        start_new_session=True,
+    )
+    try:
+        _set_rlimits(process, limits)
+    except BaseException:
+        _kill_group(process)
+        process.wait()
+        raise
+    buffers = [_OutputBuffer(limits.max_output_bytes) for _ in range(2)]
+    readers: List[threading.Thread] = [
+        threading.Thread(
+            target=_read_stream,
+            args=(stream, buffer, name, stream_name),
+            daemon=True,
+        )
+        for stream, buffer, stream_name in zip(
+            (process.stdout, process.stderr), buffers, ("stdout", "stderr")
+        )
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = threading.Event()
+    lock = threading.Lock()
+    reaped = False
+
+    def on_timeout():
+        with lock:
+            if not reaped:
+                timed_out.set()
+                _kill_group(process)
+
+    timer = None
+    if limits.timeout is not None:
+        timer = threading.Timer(limits.timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        _kill_group(process)
+        process.wait()
+        raise
+    finally:
+        with lock:
+            reaped = True
+        if timer is not None:
+            timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    duration = time.monotonic() - started_at
+
+    # processes that were started by the command may still hold the pipes
+    for reader in readers:
+        remaining = None
+        if limits.timeout is not None:
+            remaining = max(limits.timeout - (time.monotonic() - started_at), 0)
+        reader.join(remaining)
+        if reader.is_alive():
+            timed_out.set()
+            _kill_group(process)
+            reader.join()
+    stdout, stderr = (buffer.getvalue() for buffer in buffers)
+    # ru_maxrss is reported in kilobytes on Linux
+    max_rss = rusage.ru_maxrss * 1024
+    logger.debug(
+        "%s exited with %d after %.3fs using at most %d bytes of memory.",
+        name,
+        process.returncode,
+        duration,
+        max_rss,
+        extra=dict(cmd=list(cmd), duration=duration, max_rss=max_rss),
+    )
+    if any(buffer.truncated for buffer in buffers):
+        logger.info("Output of %s exceeded the capture limit and was truncated.", name)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(
+            list(cmd), limits.timeout or 0, output=stdout, stderr=stderr
+        )
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, list(cmd), output=stdout, stderr=stderr
+        )
+    return ProcessResult(
+        list(cmd), process.returncode, stdout, stderr, duration, max_rss
+    )
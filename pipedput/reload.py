@@ -0,0 +1,143 @@
+import dataclasses
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from flask import Config, Flask
+
+from pipedput.auth import ProjectIndex
+from pipedput.utils import binaries, Configuration
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfigSnapshot:
+    config: Config
+    projects: ProjectIndex
+    mtime: float
+
+
+class ConfigReloader:
+    """
+    Re-executes the configuration file whenever it changes.
+
+    A new configuration is only swapped in once it has been loaded and
+    validated completely. Pipeline events that are being processed hold
+    references to the projects and hooks of the configuration they were
+    accepted with and are therefore not affected by a reload.
+    """
+
+    DEFAULT_CHECK_INTERVAL = 2.0
+
+    def __init__(self, app: Flask, config_file: str) -> None:
+        self._app = app
+        self._config_file = config_file
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[ConfigSnapshot], None]] = []
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._last_check = 0.0
+        self._last_failed_mtime: Optional[float] = None
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        if self._snapshot is None:
+            raise RuntimeError("The configuration has not been loaded yet.")
+        return self._snapshot
+
+    @property
+    def projects(self) -> ProjectIndex:
+        return self.snapshot.projects
+
+    def add_listener(self, listener: Callable[[ConfigSnapshot], None]):
+        """registers a callable that is executed after a new configuration was applied"""
+        self._listeners.append(listener)
+        return listener
+
+    def _mtime(self) -> float:
+        return os.stat(self._config_file).st_mtime
+
+    def _load(self) -> ConfigSnapshot:
+        mtime = self._mtime()
+        # hooks of the new configuration check their binaries again
+        binaries.clear()
+        config = self._app.make_config()
+        config.from_pyfile(self._config_file)
+        Configuration.assert_false(
+            "PROJECTS" not in config,
+            f"The configuration file '{self._config_file}' must define PROJECTS.",
+        )
+        return ConfigSnapshot(config, ProjectIndex(config["PROJECTS"]), mtime)
+
+    def _apply(self, snapshot: ConfigSnapshot):
+        # Assigning the new config object is atomic. Requests that are
+        # currently handled keep the config object they started with.
+        self._app.config = snapshot.config
+        self._snapshot = snapshot
+        for listener in self._listeners:
+            listener(snapshot)
+
+    def load(self) -> ConfigSnapshot:
+        """loads the configuration and raises if it is invalid"""
+        with self._lock:
+            snapshot = self._load()
+            self._apply(snapshot)
+            self._last_check = time.monotonic()
+            return snapshot
+
+    def reload(self) -> bool:
+        """
+        Loads the configuration and applies it if it is valid.
+        Errors are logged and the current configuration is kept.
+
+        :returns: True if the new configuration has been applied
+        """
+        with self._lock:
+            try:
+                snapshot = self._load()
+            except Exception as exc:
+                try:
+                    self._last_failed_mtime = self._mtime()
+                except OSError:
+                    self._last_failed_mtime = None
+                logger.error(
+                    "Could not reload configuration from '%s'. "
+                    "Keeping the current configuration.",
+                    self._config_file,
+                    exc_info=exc,
+                )
+                return False
+            self._apply(snapshot)
+            self._last_failed_mtime = None
+            logger.info(
+                "Reloaded configuration from '%s' with %d projects.",
+                self._config_file,
+                len(snapshot.projects),
+            )
+            return True
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reloads the configuration if the file has been modified.
+        The file is checked at most once per CONFIG_RELOAD_INTERVAL seconds.
+
+        :returns: True if a new configuration has been applied
+        """
+        if self._snapshot is None:
+            return False
+        interval = self._snapshot.config.get(
+            "CONFIG_RELOAD_INTERVAL", self.DEFAULT_CHECK_INTERVAL
+        )
+        now = time.monotonic()
+        if interval is None or now - self._last_check < interval:
+            return False
+        self._last_check = now
+        try:
+            mtime = self._mtime()
+        except OSError:
+            return False
+        if mtime == self._snapshot.mtime or mtime == self._last_failed_mtime:
+            return False
+        return self.reload()
@@ -0,0 +1,121 @@
+"""
+Aggregation of the deployments of a pipeline event into a single report.
+
+Pipelines may publish hundreds of assets, so the report doesn’t keep the
+deployments themselves. It summarizes them per hook and keeps details only
+for a limited number of failures and successfully published assets. An
+error that aborted the pipeline is reported together with the deployments
+that succeeded before it.
+"""
+
+import dataclasses
+from typing import Any, Dict, List, Optional
+
+from pipedput.typing import DeploymentStateLike
+
+
+def _get_detail(value: Any, max_length: int) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode(errors="replace")
+    text = str(value)
+    if len(text) > max_length:
+        # the end of an error output is usually the most relevant part
+        text = "…" + text[-max_length:]
+    return text or None
+
+
+@dataclasses.dataclass()
+class Failure:
+    asset: Optional[str]
+    exc: Optional[str]
+    error: Optional[str]
+
+
+@dataclasses.dataclass()
+class HookSummary:
+    target_name: str
+    succeeded: int = 0
+    failed: int = 0
+    # seconds spent in the hook, if the hook reported it
+    duration: float = 0
+    assets: List[str] = dataclasses.field(default_factory=list)
+    unlisted_assets: int = 0
+    failures: List[Failure] = dataclasses.field(default_factory=list)
+    omitted_failures: int = 0
+
+    @property
+    def was_successful(self) -> bool:
+        return self.failed == 0
+
+
+class DeploymentReport:
+    DEFAULT_MAX_LISTED_ASSETS = 20
+    DEFAULT_MAX_FAILURES = 50
+    MAX_DETAIL_LENGTH = 4000
+
+    def __init__(
+        self,
+        max_listed_assets: int = DEFAULT_MAX_LISTED_ASSETS,
+        max_failures: int = DEFAULT_MAX_FAILURES,
+    ) -> None:
+        """
+        :param max_listed_assets: successful assets listed per hook
+        :param max_failures: failures with details for all hooks
+        """
+        self.max_listed_assets = max_listed_assets
+        self.max_failures = max_failures
+        self.summaries: Dict[str, HookSummary] = {}
+        self.notify = False
+        self.exc: Optional[str] = None
+        self._failure_count = 0
+
+    @property
+    def succeeded(self) -> int:
+        return sum(summary.succeeded for summary in self.summaries.values())
+
+    @property
+    def failed(self) -> int:
+        return sum(summary.failed for summary in self.summaries.values())
+
+    @property
+    def was_successful(self) -> bool:
+        return self.exc is None and self.failed == 0
+
+    def add(self, deployment: DeploymentStateLike) -> None:
+        try:
+            summary = self.summaries[deployment.target_name]
+        except KeyError:
+            summary = self.summaries[deployment.target_name] = HookSummary(
+                deployment.target_name
+            )
+        self.notify |= deployment.notify
+        # hooks that don’t derive from Hook don’t time their deployments
+        summary.duration += getattr(deployment, "duration", None) or 0
+        if deployment.was_successful:
+            summary.succeeded += 1
+            if deployment.asset is None:
+                pass
+            elif len(summary.assets) < self.max_listed_assets:
+                summary.assets.append(deployment.asset)
+            else:
+                summary.unlisted_assets += 1
+            return
+        summary.failed += 1
+        if self._failure_count >= self.max_failures:
+            summary.omitted_failures += 1
+            return
+        self._failure_count += 1
+        summary.failures.append(
+            Failure(
+                deployment.asset,
+                _get_detail(deployment.exc, self.MAX_DETAIL_LENGTH),
+                _get_detail(deployment.error, self.MAX_DETAIL_LENGTH),
+            )
+        )
+
+    def set_error(self, exc: Exception) -> None:
+        """records the error that aborted the processing of the pipeline"""
+        self.exc = _get_detail(exc, self.MAX_DETAIL_LENGTH) or type(exc).__name__
+        self.notify = True
@@ -0,0 +1,266 @@
+import collections
+from concurrent.futures import Future
+import contextvars
+import dataclasses
+import functools
+import logging
+import threading
+import time
+from typing import (
+    Callable,
+    Counter,
+    Deque,
+    Dict,
+    Iterable,
+    Optional,
+    Sequence,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+from pipedput.constraints import compile_constraint
+from pipedput.typing import Constraint, GitLabPipelineEvent
+
+if TYPE_CHECKING:
+    from pipedput.handler import Project
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANE = "default"
+
+
+@dataclasses.dataclass(frozen=True)
+class Lane:
+    """
+    A priority lane of the scheduler. Lanes share the capacity of the
+    scheduler in proportion to their weight.
+    """
+
+    name: str
+    weight: float = 1
+    # Events are put into the first lane whose constraint matches. Use
+    # constraints that only look at the event payload, like IsTag, because
+    # they are evaluated while the web-hook request is handled. None matches
+    # every event.
+    constraint: Optional[Constraint] = None
+    _compiled_constraint: Optional[Constraint] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        if self.weight <= 0:
+            raise ValueError(f"The weight of lane {self.name} must be positive.")
+        object.__setattr__(
+            self, "_compiled_constraint", compile_constraint(self.constraint)
+        )
+
+    def matches(self, event: GitLabPipelineEvent) -> bool:
+        if self._compiled_constraint is None:
+            return True
+        return bool(self._compiled_constraint(event))
+
+
+def classify(lanes: Sequence[Lane], event: GitLabPipelineEvent) -> str:
+    """returns the name of the first lane that matches event"""
+    for lane in lanes:
+        if lane.matches(event):
+            return lane.name
+    return DEFAULT_LANE
+
+
+@dataclasses.dataclass()
+class Job:
+    project: "Project"
+    event: GitLabPipelineEvent
+    lane: str = DEFAULT_LANE
+    queued_at: float = dataclasses.field(default_factory=time.monotonic)
+    # the log context of the submitter
+    context: contextvars.Context = dataclasses.field(
+        default_factory=contextvars.copy_context
+    )
+    # resolves once the job has been executed
+    done: Future = dataclasses.field(default_factory=Future)
+
+    @property
+    def key(self) -> str:
+        return self.project.key
+
+
+class Scheduler:
+    """
+    Dispatches pipeline events to an executor.
+
+    Events of the same project are serialized: no more than the project’s
+    max_concurrent_runs events are executed at once. Events of different
+    projects run in parallel up to the capacity of the scheduler.
+
+    Events are queued in lanes that are served weighted-fair: a lane with
+    twice the weight of another lane starts twice as many events while both
+    have events waiting, but no lane is starved. Within a lane, projects
+    with a higher priority are served first and projects with the same
+    priority are served in turns, so a project with a large backlog
+    cannot starve the others.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[["Project", GitLabPipelineEvent], Future],
+        capacity: int = 1,
+        lanes: Iterable[Lane] = (),
+    ) -> None:
+        """
+        :param execute:
+            Starts processing an event and returns a future that resolves
+            once the event has been processed.
+        :param capacity: the maximum number of events that are executed at once
+        :param lanes: the weights of lanes, lanes that are not listed weigh 1
+        """
+        self._execute = execute
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        # lane -> project key -> jobs
+        self._queues: Dict[str, Dict[str, Deque[Job]]] = {}
+        self._weights: Dict[str, float] = {}
+        # the virtual time at which a lane is due next, see _pop_next_job
+        self._lane_due_at: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self.set_lanes(lanes)
+        # the dispatch count at the time a project was last served
+        self._served_at: Dict[str, int] = {}
+        self._dispatch_count = 0
+        self._running: Counter[str] = collections.Counter()
+        self._total_running = 0
+        self._local = threading.local()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def running(self) -> int:
+        return self._total_running
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(
+                len(queue)
+                for lane_queues in self._queues.values()
+                for queue in lane_queues.values()
+            )
+
+    def set_lanes(self, lanes: Iterable[Lane]) -> None:
+        weights = {lane.name: lane.weight for lane in lanes}
+        with self._lock:
+            self._weights = weights
+
+    def submit(
+        self,
+        project: "Project",
+        event: GitLabPipelineEvent,
+        lane: Optional[str] = None,
+    ) -> Future:
+        """returns a future that resolves once the event has been processed"""
+        job = Job(project, event, lane or DEFAULT_LANE)
+        with self._lock:
+            lane_queues = self._queues.get(job.lane, None)
+            if lane_queues is None:
+                lane_queues = self._queues[job.lane] = {}
+                # lanes that were idle don’t get credit for the time they waited
+                self._lane_due_at[job.lane] = max(
+                    self._lane_due_at.get(job.lane, 0.0), self._virtual_time
+                )
+            lane_queues.setdefault(job.key, collections.deque()).append(job)
+        self._dispatch()
+        return job.done
+
+    def _select_project(self, lane_queues: Dict[str, Deque[Job]]) -> Optional[str]:
+        selected_key = None
+        selected_rank = None
+        for key, queue in lane_queues.items():
+            project = queue[0].project
+            if self._running[key] >= project.max_concurrent_runs:
+                continue
+            # prefer higher priorities and projects that were served least recently
+            rank = (-project.priority, self._served_at.get(key, -1))
+            if selected_rank is None or rank < selected_rank:
+                selected_key = key
+                selected_rank = rank
+        return selected_key
+
+    def _pop_next_job(self) -> Optional[Job]:
+        # Stride scheduling: every lane is due at a virtual time that
+        # advances by 1 / weight whenever the lane is served. The lane that
+        # is due first and has a project that may run is served next.
+        selected: Optional[Tuple[Tuple[float, float], str, str]] = None
+        for lane, lane_queues in self._queues.items():
+            weight = self._weights.get(lane, 1)
+            rank = (self._lane_due_at[lane], -weight)
+            if selected is not None and rank >= selected[0]:
+                continue
+            key = self._select_project(lane_queues)
+            if key is not None:
+                selected = (rank, lane, key)
+        if selected is None:
+            return None
+        _, lane, selected_key = selected
+        self._virtual_time = self._lane_due_at[lane]
+        self._lane_due_at[lane] += 1 / self._weights.get(lane, 1)
+        lane_queues = self._queues[lane]
+        queue = lane_queues[selected_key]
+        job = queue.popleft()
+        if not queue:
+            del lane_queues[selected_key]
+            if not lane_queues:
+                del self._queues[lane]
+        self._running[selected_key] += 1
+        self._total_running += 1
+        self._served_at[selected_key] = self._dispatch_count
+        self._dispatch_count += 1
+        return job
+
+    def _dispatch(self) -> None:
+        # Executors may complete jobs synchronously, which calls back into
+        # _dispatch. The outer call takes care of those jobs instead.
+        if getattr(self._local, "is_dispatching", False):
+            return
+        self._local.is_dispatching = True
+        try:
+            while True:
+                with self._lock:
+                    if self._total_running >= self._capacity:
+                        return
+                    job = self._pop_next_job()
+                if job is None:
+                    return
+                logger.debug(
+                    "Starting job for project %s after %.3fs in queue.",
+                    job.key,
+                    time.monotonic() - job.queued_at,
+                )
+                try:
+                    future = job.context.run(self._execute, job.project, job.event)
+                except Exception as exc:
+                    future = Future()
+                    future.set_exception(exc)
+                future.add_done_callback(functools.partial(self._finish, job))
+        finally:
+            self._local.is_dispatching = False
+
+    def _finish(self, job: Job, future: Future) -> None:
+        with self._lock:
+            self._running[job.key] -= 1
+            if self._running[job.key] <= 0:
+                del self._running[job.key]
+                if not any(job.key in queues for queues in self._queues.values()):
+                    self._served_at.pop(job.key, None)
+            self._total_running -= 1
+        exc = None if future.cancelled() else future.exception()
+        if exc is not None:
+            logger.error(
+                "Job for project %s failed unexpectedly.", job.key, exc_info=exc
+            )
+            job.done.set_exception(exc)
+        else:
+            job.done.set_result(None)
+        self._dispatch()
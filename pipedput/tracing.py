@@ -0,0 +1,302 @@
+"""
+OpenTelemetry-compatible tracing without additional dependencies.
+
+Tracing is disabled unless an exporter has been configured with the
+TRACING_EXPORTER config variable. While it is disabled span() returns a
+shared no-op context manager, so instrumented code doesn’t allocate
+anything. Spans are encoded with the OTLP/JSON mapping and can be written
+to a file that the OpenTelemetry collector’s otlpjsonfile receiver reads
+or be sent to an OTLP/HTTP endpoint.
+
+The trace context is stored in a context variable and travels with the log
+context into worker threads. It is passed to the mule as a W3C traceparent.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+from urllib.request import Request, urlopen
+
+from pipedput import __version__
+from pipedput.instrumentation import add_observer, remove_observer
+
+logger = logging.getLogger(__name__)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+_STATUS_ERROR = 2
+_TRACEPARENT_PATTERN = re.compile(
+    r"^00-(?P<trace_id>[0-9a-f]{32})-(?P<span_id>[0-9a-f]{16})-[0-9a-f]{2}$"
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class SpanContext:
+    trace_id: str
+    span_id: str
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def from_traceparent(cls, traceparent: Optional[str]) -> Optional["SpanContext"]:
+        match = _TRACEPARENT_PATTERN.match((traceparent or "").strip().lower())
+        if match is None:
+            return None
+        return cls(match.group("trace_id"), match.group("span_id"))
+
+
+@dataclasses.dataclass()
+class Span:
+    name: str
+    context: SpanContext
+    parent_span_id: Optional[str]
+    kind: int
+    start_time_ns: int
+    end_time_ns: int = 0
+    attributes: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+
+def _encode_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 values are strings in the JSON mapping of protobuf
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _encode_attributes(attributes: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"key": key, "value": _encode_value(value)}
+        for key, value in attributes.items()
+        if value is not None
+    ]
+
+
+def encode_spans(spans: List[Span]) -> Dict[str, Any]:
+    """returns an OTLP/JSON ExportTraceServiceRequest for spans"""
+    encoded_spans = []
+    for span in spans:
+        encoded_span: Dict[str, Any] = {
+            "traceId": span.context.trace_id,
+            "spanId": span.context.span_id,
+            "name": span.name,
+            "kind": span.kind,
+            "startTimeUnixNano": str(span.start_time_ns),
+            "endTimeUnixNano": str(span.end_time_ns),
+            "attributes": _encode_attributes(span.attributes),
+        }
+        if span.parent_span_id is not None:
+            encoded_span["parentSpanId"] = span.parent_span_id
+        if span.error is not None:
+            encoded_span["status"] = {"code": _STATUS_ERROR, "message": span.error}
+        encoded_spans.append(encoded_span)
+    resource = {"service.name": "pipedput", "service.version": __version__}
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": _encode_attributes(resource)},
+                "scopeSpans": [{"scope": {"name": "pipedput"}, "spans": encoded_spans}],
+            }
+        ]
+    }
+
+
+class SpanExporter:
+    def export(self, span: Span) -> None:
+        raise NotImplementedError()
+
+
+class FileSpanExporter(SpanExporter):
+    """appends every span as an OTLP/JSON line to a file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(encode_spans([span])) + "\n"
+        with self._lock, open(self.path, "a") as span_file:
+            span_file.write(line)
+
+
+class OTLPSpanExporter(SpanExporter):
+    """
+    Sends spans in batches to an OTLP/HTTP endpoint, e.g.
+    http://localhost:4318/v1/traces. Spans are dropped if the endpoint
+    can’t keep up.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        headers: Optional[Mapping[str, str]] = None,
+        batch_size: int = 512,
+        interval: float = 5,
+        max_queue_size: int = 8192,
+        timeout: float = 10,
+    ) -> None:
+        self.endpoint = endpoint
+        self.headers = dict(headers or {})
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._max_queue_size = max_queue_size
+        self._queue: "queue.Queue[Span]" = queue.Queue(max_queue_size)
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def _ensure_worker(self) -> None:
+        # the worker thread of the parent doesn’t survive a fork
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._queue = queue.Queue(self._max_queue_size)
+                threading.Thread(
+                    target=self._run, name="pipedput-tracing", daemon=True
+                ).start()
+                self._pid = pid
+
+    def export(self, span: Span) -> None:
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _send(self, spans: List[Span]) -> None:
+        request = Request(
+            self.endpoint,
+            data=json.dumps(encode_spans(spans)).encode(),
+            headers={"Content-Type": "application/json", **self.headers},
+            method="POST",
+        )
+        with urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def _run(self) -> None:
+        spans_queue = self._queue
+        while True:
+            batch = [spans_queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(spans_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception:
+                logger.warning(
+                    "Could not export %d spans to %s.",
+                    len(batch),
+                    self.endpoint,
+                    exc_info=True,
+                )
+
+
+_exporter: Optional[SpanExporter] = None
+_current: contextvars.ContextVar[Optional[SpanContext]] = contextvars.ContextVar(
+    "pipedput_span_context", default=None
+)
+_exporter_lock = threading.Lock()
+_NOOP = contextlib.nullcontext()
+
+
+def set_exporter(exporter: Optional[SpanExporter]) -> None:
+    """enables tracing with exporter or disables it if exporter is None"""
+    global _exporter
+    with _exporter_lock:
+        if exporter is not None and _exporter is None:
+            add_observer(trace_stage)
+        elif exporter is None and _exporter is not None:
+            remove_observer(trace_stage)
+        _exporter = exporter
+
+
+def is_enabled() -> bool:
+    return _exporter is not None
+
+
+def get_traceparent() -> Optional[str]:
+    context = _current.get()
+    return context.traceparent if context is not None else None
+
+
+@contextlib.contextmanager
+def _span(
+    exporter: SpanExporter,
+    name: str,
+    kind: int,
+    traceparent: Optional[str],
+    attributes: Dict[str, Any],
+) -> Iterator[Span]:
+    parent = _current.get() or SpanContext.from_traceparent(traceparent)
+    trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+    span = Span(
+        name,
+        SpanContext(trace_id, os.urandom(8).hex()),
+        parent.span_id if parent is not None else None,
+        kind,
+        time.time_ns(),
+        attributes=attributes,
+    )
+    token = _current.set(span.context)
+    try:
+        yield span
+    except BaseException as exc:
+        span.error = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        _current.reset(token)
+        span.end_time_ns = time.time_ns()
+        try:
+            exporter.export(span)
+        except Exception:
+            logger.warning("Could not export span %s.", name, exc_info=True)
+
+
+def span(
+    name: str,
+    kind: int = SPAN_KIND_INTERNAL,
+    traceparent: Optional[str] = None,
+    **attributes: Any,
+):
+    """
+    Returns a context manager that records a span, or a no-op context
+    manager that yields None if tracing is disabled.
+
+    :param traceparent: the W3C traceparent of a remote parent span that is
+        used if there is no current span
+    """
+    exporter = _exporter
+    if exporter is None:
+        return _NOOP
+    return _span(exporter, name, kind, traceparent, attributes)
+
+
+def trace_stage(name: str, attributes: Dict[str, Any]):
+    """stage observer that records a span for every processing stage"""
+    return span(name, **attributes)
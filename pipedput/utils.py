@@ -1,24 +1,37 @@
+import contextlib
+import dataclasses
+import functools
 import logging
 import os
 import shutil
 import socket
-from typing import Optional
+import sqlite3
+import threading
+from typing import cast, Dict, List, Optional, Tuple
 import urllib.error
 from urllib.parse import urlparse
 from urllib.request import Request, urlopen
+import uuid
 import zipfile
 
-from flask_mail import Message
-import html2text
-from jinja2 import Environment, PackageLoader
-
+from pipedput import tracing
+from pipedput.event import PipelineEvent
 from pipedput.typing import GitLabPipelineEvent
 
-
 _logger = logging.getLogger(__name__)
-_jinja_env = Environment(
-    loader=PackageLoader("pipedput"),
-)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_jinja_env():
+    # Mail rendering is only needed once the first report is sent, so the
+    # template environment is created on first use to keep startup cheap.
+    from jinja2 import Environment, PackageLoader
+
+    jinja_env = Environment(
+        loader=PackageLoader("pipedput"),
+    )
+    jinja_env.filters["url_hostname"] = get_url_hostname
+    return jinja_env
 
 
 def get_url_hostname(url: str):
@@ -42,25 +55,197 @@ def download_file(url: str, destination: str, token: Optional[str] = None) -> No
         raise
 
 
-def unzip(file: str, destination: str) -> None:
-    zip_file = zipfile.ZipFile(file)
-    zip_file.extractall(destination)
-    zip_file.close()
+# see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+
+def _reflink(source_fd: int, destination_fd: int, size: int) -> None:
+    import fcntl
+
+    fcntl.ioctl(destination_fd, _FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(  # type: ignore
+            source_fd, destination_fd, size - offset, offset, offset
+        )
+        if copied == 0:
+            raise OSError("copy_file_range stopped before the end of the file")
+        offset += copied
+
+
+def publish_file(source: str, destination: str, allow_hardlink: bool = True) -> str:
+    """
+    Publishes source to destination without copying the data if possible.
+
+    The file is hardlinked, cloned with a reflink, or copied in the kernel
+    with copy_file_range. It is only copied byte by byte if none of these
+    methods is supported, e.g. across filesystems. The destination is
+    replaced atomically. Like shutil.copy, destination may be a directory.
+
+    :param allow_hardlink: hardlinked files share their content and
+        permissions with the source, so disable this if either file might
+        be modified in place
+    :returns: the method that was used: hardlink, reflink,
+        copy_file_range or copy
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    tmp_destination = os.path.join(
+        os.path.dirname(os.path.abspath(destination)),
+        f".{os.path.basename(destination)}.{uuid.uuid4().hex}.tmp",
+    )
+    if allow_hardlink:
+        try:
+            os.link(source, tmp_destination)
+        except OSError:
+            pass
+        else:
+            os.replace(tmp_destination, destination)
+            return "hardlink"
+
+    try:
+        method = "copy"
+        with open(source, "rb") as source_file, open(
+            tmp_destination, "xb"
+        ) as destination_file:
+            size = os.fstat(source_file.fileno()).st_size
+            for name, copy in (
+                ("reflink", _reflink),
+                ("copy_file_range", _copy_file_range),
+            ):
+                try:
+                    copy(source_file.fileno(), destination_file.fileno(), size)
+                except (OSError, AttributeError):
+                    destination_file.truncate(0)
+                else:
+                    method = name
+                    break
+            else:
+                shutil.copyfileobj(source_file, destination_file)
+        shutil.copymode(source, tmp_destination)
+        os.replace(tmp_destination, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_destination)
+        raise
+    return method
+
+
+@dataclasses.dataclass(frozen=True)
+class ExtractionLimits:
+    """Limits for extracting artifact archives. None disables a limit."""
+
+    # total number of bytes of all extracted files
+    max_bytes: Optional[int] = None
+    # number of files and directories in the archive
+    max_members: Optional[int] = None
+    # extracted bytes relative to the size of the archive
+    max_ratio: Optional[float] = None
+    # number of path components of a member
+    max_depth: Optional[int] = None
+
+    class Exceeded(Exception):
+        pass
+
+
+def _get_member_path_components(member: zipfile.ZipInfo) -> List[str]:
+    # sanitizes the path like ZipFile.extract does
+    path = os.path.splitdrive(member.filename.replace("/", os.path.sep))[1]
+    return [
+        component
+        for component in path.split(os.path.sep)
+        if component not in ("", os.path.curdir, os.path.pardir)
+    ]
+
+
+def _extract_with_limits(
+    zip_file: zipfile.ZipFile,
+    archive_size: int,
+    destination: str,
+    limits: ExtractionLimits,
+):
+    members = zip_file.infolist()
+    if limits.max_members is not None and len(members) > limits.max_members:
+        raise ExtractionLimits.Exceeded(
+            f"The archive contains {len(members)} members, "
+            f"but only {limits.max_members} are allowed."
+        )
+    max_bytes = limits.max_bytes
+    if limits.max_ratio is not None:
+        max_ratio_bytes = int(max(archive_size, 1) * limits.max_ratio)
+        max_bytes = (
+            max_ratio_bytes if max_bytes is None else min(max_bytes, max_ratio_bytes)
+        )
+    extracted_bytes = 0
+    for member in members:
+        components = _get_member_path_components(member)
+        if not components:
+            continue
+        if limits.max_depth is not None and len(components) > limits.max_depth:
+            raise ExtractionLimits.Exceeded(
+                f"The path of {member.filename} exceeds the maximum depth "
+                f"of {limits.max_depth}."
+            )
+        target = os.path.join(destination, *components)
+        if member.is_dir():
+            os.makedirs(target, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # the sizes in the archive can’t be trusted, so the extracted bytes
+        # are counted while they are written
+        with zip_file.open(member) as source, open(target, "wb") as output:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                extracted_bytes += len(chunk)
+                if max_bytes is not None and extracted_bytes > max_bytes:
+                    raise ExtractionLimits.Exceeded(
+                        f"The extracted archive exceeds {max_bytes} bytes "
+                        f"(archive size {archive_size} bytes)."
+                    )
+                output.write(chunk)
+
+
+def unzip(
+    file: str, destination: str, limits: Optional[ExtractionLimits] = None
+) -> None:
+    """
+    Extracts the archive to destination.
+
+    :raises ExtractionLimits.Exceeded:
+        if the archive violates one of the limits. Files that have been
+        extracted up to that point are left in destination.
+    """
+    with zipfile.ZipFile(file) as zip_file:
+        if limits is None or limits == ExtractionLimits():
+            zip_file.extractall(destination)
+        else:
+            _extract_with_limits(zip_file, os.stat(file).st_size, destination, limits)
 
 
 def get_api_base_url_from_event(event: GitLabPipelineEvent) -> str:
+    if isinstance(event, PipelineEvent):
+        return event.api_base_url
     base_url = urlparse(event["project"]["web_url"])
     return f"{base_url.scheme}://{base_url.netloc}/api/v4"
 
 
 def html_to_markdown(html: str, width: int = 72) -> str:
+    import html2text
+
     return html2text.html2text(html, bodywidth=width)
 
 
 def send_mail(**kwargs):
+    from flask_mail import Message
+
     from pipedput.app import app, mail
 
-    with app.app_context():
+    with app.app_context(), tracing.span("send mail", kind=tracing.SPAN_KIND_CLIENT):
         if "html" in kwargs and "body" not in kwargs:
             kwargs["body"] = html_to_markdown(kwargs["html"])
 
@@ -72,7 +257,7 @@ def send_mail(**kwargs):
 
 
 def render_template(template_name: str, **context):
-    template = _jinja_env.get_template(template_name)
+    template = _get_jinja_env().get_template(template_name)
     hostname = socket.gethostname()
     return template.render(
         hostname=hostname,
@@ -88,6 +273,99 @@ def create_template_renderer(template_name: str, **context_defaults):
     return _render_template
 
 
+class BinaryRegistry:
+    """
+    Resolves binaries to absolute paths once instead of searching PATH for
+    every command. A resolved path is looked up again if its mtime changes,
+    if it disappears, if PATH changes or after clear() was called on
+    configuration reloads. Binaries that are not found are not cached.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._paths: Dict[Tuple[str, Optional[str]], Tuple[str, int]] = {}
+
+    def resolve(self, bin_name: str) -> Optional[str]:
+        search_path = os.environ.get("PATH", None)
+        key = (bin_name, search_path)
+        with self._lock:
+            entry = self._paths.get(key, None)
+        if entry is not None:
+            path, mtime_ns = entry
+            try:
+                if os.stat(path).st_mtime_ns == mtime_ns:
+                    return path
+            except OSError:
+                pass
+        path = shutil.which(bin_name, path=search_path)
+        if path is None:
+            with self._lock:
+                self._paths.pop(key, None)
+            return None
+        path = os.path.abspath(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return path
+        with self._lock:
+            self._paths[key] = (path, mtime_ns)
+        return path
+
+    def clear(self) -> None:
+        with self._lock:
+            self._paths.clear()
+
+
+binaries = BinaryRegistry()
+
+
+def is_process_running(pid: int) -> bool:
+    """returns whether a process with the given pid exists on this host"""
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SQLiteDatabase:
+    """
+    The SQLite database of a store that is shared by the threads and
+    processes of one host. Every thread of every process uses a connection
+    of its own.
+    """
+
+    def __init__(self, path: str, schema: str) -> None:
+        """
+        :param path: the path of the SQLite database
+        :param schema: the script that creates missing tables and indices
+        """
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # connections must neither be shared between threads nor survive a fork
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.connection = self.connect()
+            self._local.pid = pid
+        return self._local.connection
+
+
 class Configuration:
     class ConfigurationError(Exception):
         pass
@@ -105,13 +383,21 @@ class Configuration:
         cls._check(condition, message, warn_only)
 
     @classmethod
-    def check_bin_exists(cls, bin_name: str, warn_only: bool = False):
+    def check_bin_exists(cls, bin_name: str, warn_only: bool = False) -> Optional[str]:
+        """returns the absolute path of the binary if it exists"""
+        path = binaries.resolve(bin_name)
         cls._check(
-            shutil.which(bin_name) is None,
+            path is None,
             f"Could not find '{bin_name}' binary on PATH, but it is required. "
             f"Did you forget to install it on the system?",
             warn_only,
         )
+        return path
+
+    @classmethod
+    def get_bin_path(cls, bin_name: str) -> str:
+        """returns the absolute path of a binary that is required"""
+        return cast(str, cls.check_bin_exists(bin_name))
 
     @classmethod
     def check_file_exists(cls, file_path: str, warn_only: bool = False):
@@ -121,6 +407,3 @@ class Configuration:
             f"does not exist.",
             warn_only,
         )
-
-
-_jinja_env.filters["url_hostname"] = get_url_hostname
@@ -0,0 +1,486 @@
+"""
+A work queue that is shared by several pipedput nodes.
+
+By default every node processes the pipeline events it receives itself.
+With a work queue, nodes append accepted events to the queue and every
+node that runs a QueueConsumer takes events from it. A consumer leases the
+events it processes and renews its leases with heartbeats while they are
+running. Events whose lease expires, because their node died, are
+delivered again to another node, so events are processed at least once.
+
+SQLiteQueueBackend shares a queue between the processes of one host.
+FileQueueBackend shares a queue between hosts through a shared filesystem,
+like NFS, and only relies on atomic renames. Leases are compared with the
+clock of each node, so the clocks of all nodes must be synchronized.
+"""
+
+from concurrent.futures import Future
+import contextlib
+import dataclasses
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+import uuid
+
+from pipedput.typing import GitLabPipelineEvent
+from pipedput.utils import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkItem:
+    id: str
+    project_key: str
+    event: GitLabPipelineEvent
+    correlation_id: Optional[str]
+    traceparent: Optional[str]
+    # the number of times the item has been delivered, including this one
+    attempts: int
+    # identifies the lease of the consumer that claimed the item
+    lease: str
+    # the scheduler lane the event was classified into when it was accepted
+    lane: Optional[str] = None
+
+
+def _new_item_id() -> str:
+    # item ids sort in the order they were enqueued
+    return f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+
+
+class QueueBackend:
+    def __init__(self, lease_duration: float = 60, max_attempts: int = 5) -> None:
+        """
+        :param lease_duration:
+            seconds after which an item is delivered again unless its lease
+            has been renewed
+        :param max_attempts:
+            items are dropped once they have been delivered this many times
+            without being completed, e.g. because they crash the node
+        """
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+
+    def put(
+        self,
+        project_key: str,
+        event: GitLabPipelineEvent,
+        correlation_id: Optional[str] = None,
+        traceparent: Optional[str] = None,
+        lane: Optional[str] = None,
+    ) -> str:
+        """appends an event to the queue and returns the id of its item"""
+        raise NotImplementedError()
+
+    def claim(self, node: str, now: Optional[float] = None) -> Optional[WorkItem]:
+        """
+        Leases the oldest item that is neither leased nor completed,
+        including items whose lease has expired.
+        """
+        raise NotImplementedError()
+
+    def heartbeat(self, item: WorkItem, now: Optional[float] = None) -> bool:
+        """renews the lease of item and returns False if it has been lost"""
+        raise NotImplementedError()
+
+    def complete(self, item: WorkItem) -> None:
+        """removes an item that has been processed"""
+        raise NotImplementedError()
+
+    def release(self, item: WorkItem) -> None:
+        """makes a leased item available again without counting the attempt"""
+        raise NotImplementedError()
+
+    def count_pending(self) -> int:
+        """returns the number of items that have not been completed"""
+        raise NotImplementedError()
+
+    def _drop(self, item_id: str, project_key: str, attempts: int) -> None:
+        logger.error(
+            "Dropped event %s of project %s after %d failed deliveries.",
+            item_id,
+            project_key,
+            attempts,
+        )
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    project_key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease TEXT,
+    node TEXT,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS items_lease_expires_at ON items (lease_expires_at);
+"""
+
+
+class SQLiteQueueBackend(QueueBackend):
+    """a queue for the processes of one host"""
+
+    def __init__(
+        self, path: str, lease_duration: float = 60, max_attempts: int = 5
+    ) -> None:
+        """
+        :param path: the path of the SQLite database
+        """
+        super().__init__(lease_duration, max_attempts)
+        self.path = path
+        self._database = SQLiteDatabase(path, _SCHEMA)
+
+    def put(
+        self,
+        project_key: str,
+        event: GitLabPipelineEvent,
+        correlation_id: Optional[str] = None,
+        traceparent: Optional[str] = None,
+        lane: Optional[str] = None,
+    ) -> str:
+        item_id = _new_item_id()
+        data = dict(
+            event=event,
+            correlation_id=correlation_id,
+            traceparent=traceparent,
+            lane=lane,
+        )
+        with self._database.connection as connection:
+            connection.execute(
+                "INSERT INTO items (id, project_key, data) VALUES (?, ?, ?)",
+                (item_id, project_key, json.dumps(data)),
+            )
+        return item_id
+
+    def claim(self, node: str, now: Optional[float] = None) -> Optional[WorkItem]:
+        now = time.time() if now is None else now
+        connection = self._database.connection
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            while True:
+                row = connection.execute(
+                    "SELECT id, project_key, data, attempts FROM items "
+                    "WHERE lease IS NULL OR lease_expires_at < ? "
+                    "ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                item_id, project_key, data, attempts = row
+                if attempts >= self.max_attempts:
+                    connection.execute("DELETE FROM items WHERE id = ?", (item_id,))
+                    self._drop(item_id, project_key, attempts)
+                    continue
+                lease = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE items SET attempts = ?, lease = ?, node = ?, "
+                    "lease_expires_at = ? WHERE id = ?",
+                    (attempts + 1, lease, node, now + self.lease_duration, item_id),
+                )
+                data = json.loads(data)
+                return WorkItem(
+                    item_id,
+                    project_key,
+                    data["event"],
+                    data["correlation_id"],
+                    data["traceparent"],
+                    attempts + 1,
+                    lease,
+                    data.get("lane", None),
+                )
+
+    def heartbeat(self, item: WorkItem, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        with self._database.connection as connection:
+            cursor = connection.execute(
+                "UPDATE items SET lease_expires_at = ? WHERE id = ? AND lease = ?",
+                (now + self.lease_duration, item.id, item.lease),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, item: WorkItem) -> None:
+        with self._database.connection as connection:
+            connection.execute(
+                "DELETE FROM items WHERE id = ? AND lease = ?", (item.id, item.lease)
+            )
+
+    def release(self, item: WorkItem) -> None:
+        with self._database.connection as connection:
+            connection.execute(
+                "UPDATE items SET attempts = attempts - 1, lease = NULL, "
+                "node = NULL, lease_expires_at = NULL WHERE id = ? AND lease = ?",
+                (item.id, item.lease),
+            )
+
+    def count_pending(self) -> int:
+        return self._database.connection.execute(
+            "SELECT COUNT(*) FROM items"
+        ).fetchone()[0]
+
+
+class FileQueueBackend(QueueBackend):
+    """
+    A queue in a directory that is shared by several hosts. Every item is a
+    file that is moved between the pending and the leased directory. The
+    modification time of a leased file is the time its lease was renewed.
+    """
+
+    _SUFFIX = ".json"
+
+    def __init__(
+        self, directory: str, lease_duration: float = 60, max_attempts: int = 5
+    ) -> None:
+        """
+        :param directory: the directory that contains the queue
+        """
+        super().__init__(lease_duration, max_attempts)
+        self.directory = directory
+        for name in ("pending", "leased", "tmp"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _pending_path(self, item_id: str) -> str:
+        return os.path.join(self.directory, "pending", item_id + self._SUFFIX)
+
+    def _leased_path(self, item_id: str, lease: str) -> str:
+        return os.path.join(
+            self.directory, "leased", f"{item_id}.{lease}{self._SUFFIX}"
+        )
+
+    def _write(self, path: str, data: Dict) -> None:
+        # readers must never see partially written files
+        tmp_path = os.path.join(self.directory, "tmp", uuid.uuid4().hex)
+        with open(tmp_path, "w") as item_file:
+            json.dump(data, item_file)
+            item_file.flush()
+            os.fsync(item_file.fileno())
+        os.replace(tmp_path, path)
+
+    def put(
+        self,
+        project_key: str,
+        event: GitLabPipelineEvent,
+        correlation_id: Optional[str] = None,
+        traceparent: Optional[str] = None,
+        lane: Optional[str] = None,
+    ) -> str:
+        item_id = _new_item_id()
+        data = dict(
+            project_key=project_key,
+            event=event,
+            correlation_id=correlation_id,
+            traceparent=traceparent,
+            lane=lane,
+            attempts=0,
+        )
+        self._write(self._pending_path(item_id), data)
+        return item_id
+
+    def _iter_candidates(self, now: float) -> Iterator[Tuple[str, str]]:
+        # yields the item ids and paths of expired leases and pending items
+        leased_dir = os.path.join(self.directory, "leased")
+        for name in sorted(os.listdir(leased_dir)):
+            path = os.path.join(leased_dir, name)
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_mtime + self.lease_duration < now:
+                    yield name.split(".", 1)[0], path
+        pending_dir = os.path.join(self.directory, "pending")
+        for name in sorted(os.listdir(pending_dir)):
+            if name.endswith(self._SUFFIX):
+                yield name[: -len(self._SUFFIX)], os.path.join(pending_dir, name)
+
+    def claim(self, node: str, now: Optional[float] = None) -> Optional[WorkItem]:
+        now = time.time() if now is None else now
+        for item_id, path in self._iter_candidates(now):
+            lease = uuid.uuid4().hex
+            leased_path = self._leased_path(item_id, lease)
+            try:
+                # renaming keeps the modification time, the lease must not be
+                # expired once the file is in leased/
+                os.utime(path, (now, now))
+                # only one node succeeds in renaming the file
+                os.rename(path, leased_path)
+            except FileNotFoundError:
+                continue
+            with open(leased_path) as item_file:
+                data = json.load(item_file)
+            if data["attempts"] >= self.max_attempts:
+                os.remove(leased_path)
+                self._drop(item_id, data["project_key"], data["attempts"])
+                continue
+            data["attempts"] += 1
+            data["node"] = node
+            self._write(leased_path, data)
+            os.utime(leased_path, (now, now))
+            return WorkItem(
+                item_id,
+                data["project_key"],
+                data["event"],
+                data["correlation_id"],
+                data["traceparent"],
+                data["attempts"],
+                lease,
+                data.get("lane", None),
+            )
+        return None
+
+    def heartbeat(self, item: WorkItem, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        try:
+            os.utime(self._leased_path(item.id, item.lease), (now, now))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, item: WorkItem) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._leased_path(item.id, item.lease))
+
+    def release(self, item: WorkItem) -> None:
+        leased_path = self._leased_path(item.id, item.lease)
+        try:
+            with open(leased_path) as item_file:
+                data = json.load(item_file)
+            data["attempts"] -= 1
+            self._write(leased_path, data)
+            os.rename(leased_path, self._pending_path(item.id))
+        except FileNotFoundError:
+            pass
+
+    def count_pending(self) -> int:
+        return sum(
+            len(os.listdir(os.path.join(self.directory, name)))
+            for name in ("pending", "leased")
+        )
+
+
+def get_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class QueueConsumer:
+    """
+    Takes items from a queue and submits them for processing as long as
+    less than capacity items are running. The leases of running items are
+    renewed in a separate thread.
+    """
+
+    def __init__(
+        self,
+        backend: QueueBackend,
+        submit: Callable[[WorkItem], Future],
+        capacity: int = 1,
+        poll_interval: float = 1,
+    ) -> None:
+        """
+        :param submit:
+            Starts processing an item and returns a future that resolves
+            once the item has been processed.
+        :param poll_interval: seconds between polls of an empty queue
+        """
+        self.backend = backend
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.node = get_node_id()
+        self._submit = submit
+        self._lock = threading.Lock()
+        self._active: Dict[str, WorkItem] = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    def wake(self) -> None:
+        """checks the queue right away, e.g. after an item has been added"""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        for target, name in (
+            (self.run, "pipedput-queue"),
+            (self._renew_leases, "pipedput-queue-heartbeat"),
+        ):
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    def stop(self) -> None:
+        """stops claiming items, running items are completed nonetheless"""
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self) -> None:
+        """claims and submits items until the consumer is stopped"""
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            if self.active < self.capacity and self._claim_next():
+                continue
+            self._wakeup.wait(self.poll_interval)
+
+    def _claim_next(self) -> bool:
+        try:
+            item = self.backend.claim(self.node)
+        except Exception:
+            logger.exception("Could not claim an item from the work queue.")
+            return False
+        if item is None:
+            return False
+        if item.attempts > 1:
+            logger.warning(
+                "Delivering event %s of project %s again (attempt %d).",
+                item.id,
+                item.project_key,
+                item.attempts,
+            )
+        with self._lock:
+            self._active[item.id] = item
+        try:
+            future = self._submit(item)
+        except Exception as exc:
+            future = Future()
+            future.set_exception(exc)
+        future.add_done_callback(functools.partial(self._finish, item))
+        return True
+
+    def _finish(self, item: WorkItem, future: Future) -> None:
+        with self._lock:
+            self._active.pop(item.id, None)
+        exc = None if future.cancelled() else future.exception()
+        if exc is not None:
+            logger.error(
+                "Processing event %s of project %s failed unexpectedly.",
+                item.id,
+                item.project_key,
+                exc_info=exc,
+            )
+        try:
+            self.backend.complete(item)
+        except Exception:
+            logger.exception("Could not complete event %s.", item.id)
+        self._wakeup.set()
+
+    def _renew_leases(self) -> None:
+        interval = self.backend.lease_duration / 3
+        lost = set()
+        while not self._stopped.is_set() or self.active:
+            time.sleep(interval)
+            with self._lock:
+                items = list(self._active.values())
+            for item in items:
+                try:
+                    renewed = self.backend.heartbeat(item)
+                except Exception:
+                    logger.exception("Could not renew the lease of event %s.", item.id)
+                    continue
+                if not renewed and item.id not in lost:
+                    lost.add(item.id)
+                    logger.warning(
+                        "Lost the lease of event %s of project %s, it may be "
+                        "processed by another node as well.",
+                        item.id,
+                        item.project_key,
+                    )
@@ -0,0 +1,189 @@
+"""
+Workspaces for downloading and extracting pipeline artifacts.
+
+The workspace manager creates workspaces below a configurable root and
+reserves the space an artifact needs once it has been extracted. The space
+a workspace has already written is missing from the free space of the
+filesystem, so only the rest of its reservation is subtracted. Jobs that
+don’t fit wait until other jobs have released their space, and are rejected
+if they never could fit or if the space doesn’t become available in time.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional, Set
+
+from pipedput.utils import is_process_running
+
+logger = logging.getLogger(__name__)
+
+
+class Workspace:
+    def __init__(self, manager: "WorkspaceManager", path: str, reserved: int):
+        self.path = path
+        self.reserved = reserved
+        # the size of the files when get_used_bytes was last called
+        self.used_bytes = 0
+        self._manager = manager
+
+    def get_used_bytes(self) -> int:
+        """returns the size of the files in the workspace"""
+        used = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    used += os.lstat(os.path.join(dirpath, filename)).st_size
+                except FileNotFoundError:
+                    pass
+        self.used_bytes = used
+        return used
+
+    def close(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._manager._release(self)
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class WorkspaceManager:
+    class InsufficientSpace(Exception):
+        pass
+
+    DEFAULT_EXPANSION_FACTOR = 4.0
+    PREFIX = "pipedput-workspace-"
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        expansion_factor: float = DEFAULT_EXPANSION_FACTOR,
+        min_free_bytes: int = 0,
+        wait_timeout: Optional[float] = 600,
+    ) -> None:
+        """
+        :param root: the directory that contains all workspaces
+        :param expansion_factor: the size of an extracted artifact relative
+            to the size of its archive
+        :param min_free_bytes: space that is always left free
+        :param wait_timeout: the number of seconds a job waits for space,
+            or None to wait indefinitely
+        """
+        self.root = root or tempfile.gettempdir()
+        self.expansion_factor = expansion_factor
+        self.min_free_bytes = min_free_bytes
+        self.wait_timeout = wait_timeout
+        self._reserved = 0
+        self._workspaces: Set[Workspace] = set()
+        self._condition = threading.Condition()
+        os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def get_required_bytes(self, archive_size: Optional[int]) -> int:
+        """returns the space needed for the archive and its extracted content"""
+        if not archive_size:
+            return 0
+        return int(archive_size * (1 + self.expansion_factor))
+
+    def _update_used_bytes(self) -> None:
+        # the workspaces are walked without holding the lock, which only
+        # reads the sizes they cached
+        with self._condition:
+            workspaces = list(self._workspaces)
+        for workspace in workspaces:
+            workspace.get_used_bytes()
+
+    def _get_available_bytes(self) -> int:
+        free = shutil.disk_usage(self.root).free
+        # written bytes are already missing from the free space
+        written = sum(
+            min(workspace.used_bytes, workspace.reserved)
+            for workspace in self._workspaces
+        )
+        return free - (self._reserved - written) - self.min_free_bytes
+
+    def acquire(self, archive_size: Optional[int] = None) -> Workspace:
+        """
+        Creates a workspace with enough space for an archive of the given
+        size. Blocks until enough space is available.
+
+        :raises WorkspaceManager.InsufficientSpace:
+            if there is not enough space and no other job can free it up,
+            or if the space doesn’t become available within wait_timeout
+        """
+        required = self.get_required_bytes(archive_size)
+        deadline = (
+            time.monotonic() + self.wait_timeout
+            if self.wait_timeout is not None
+            else None
+        )
+        while True:
+            self._update_used_bytes()
+            with self._condition:
+                available = self._get_available_bytes()
+                if available >= required:
+                    self._reserved += required
+                    break
+                if self._reserved == 0:
+                    raise self.InsufficientSpace(
+                        f"The artifact needs {required} bytes, but only "
+                        f"{available} bytes are available in {self.root}."
+                    )
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        raise self.InsufficientSpace(
+                            f"Timed out waiting for {required} bytes in {self.root}."
+                        )
+                logger.info(
+                    "Waiting for %d bytes of free space in %s.", required, self.root
+                )
+                self._condition.wait(timeout)
+        try:
+            path = tempfile.mkdtemp(
+                prefix=f"{self.PREFIX}{os.getpid()}-", dir=self.root
+            )
+        except BaseException:
+            self._release_bytes(required)
+            raise
+        workspace = Workspace(self, path, required)
+        with self._condition:
+            self._workspaces.add(workspace)
+        return workspace
+
+    def _release_bytes(self, reserved: int, workspace: Optional[Workspace] = None):
+        with self._condition:
+            self._reserved -= reserved
+            self._workspaces.discard(workspace)
+            self._condition.notify_all()
+
+    def _release(self, workspace: Workspace):
+        self._release_bytes(workspace.reserved, workspace)
+        workspace.reserved = 0
+
+    def cleanup_orphans(self) -> int:
+        """removes workspaces of processes that are no longer running"""
+        removed = 0
+        for filename in os.listdir(self.root):
+            if not filename.startswith(self.PREFIX):
+                continue
+            try:
+                pid = int(filename[len(self.PREFIX) :].split("-", 1)[0])
+            except ValueError:
+                continue
+            if is_process_running(pid):
+                continue
+            shutil.rmtree(os.path.join(self.root, filename), ignore_errors=True)
+            logger.info("Removed orphaned workspace %s.", filename)
+            removed += 1
+        return removed
@@ -37,4 +37,5 @@ setup(
         "jinja2",
     ],
     package_data={"": ["README.md"]},
+    entry_points={"console_scripts": ["pipedput = pipedput.cli:main"]},
 )
@@ -44,6 +44,8 @@ MAIL_SERVER = "localhost"
 MAIL_PORT = 25
 MAIL_DEFAULT_SENDER = "noreply@localhost"
 DEFAULT_MAIL_RECIPIENTS = ["tester@localhost"]
+# process events in the thread that receives them
+SCHEDULER_WORKERS = 0
 DEPLOYMENT_DOCUMENTATION_URL = (
     "https://our-internal-deployment-documentation.example.org"
 )
@@ -53,6 +55,7 @@ PROJECTS = [
     Project("pypi-to-gitlab", to_pypi_repo(publish_to_gitlab=True)),
     Project("deb-and-pypi", [to_deb_repo(), to_pypi_repo()]),
     Project("auth", None, "cde456"),
+    Project("auth-rotation", None, ["cde456", "efg789"]),
     Project("with-gitlab-token", to_deb_repo(), artifact_download_token=api_token),
     Project("fail-badly", FailHook()),
     Project(
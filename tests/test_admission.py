@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+from pipedput.admission import AdmissionControl, AdmissionStore
+
+
+def _event(pipeline_id, tag=False):
+    return {"object_attributes": {"id": pipeline_id, "tag": tag}}
+
+
+class AdmissionStoreTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.store = AdmissionStore(
+            os.path.join(self._tmp_dir.name, "admission.sqlite3")
+        )
+        self.control = AdmissionControl(max_pending=4, reserved_for_tags=1, max_age=100)
+
+    def _admit(self, pipeline_id, project_key="foo", tag=False, now=0):
+        return self.store.admit(
+            self.control, project_key, _event(pipeline_id, tag), now=now
+        )
+
+    def test_depth_is_limited(self):
+        tickets = [self._admit(pipeline_id).ticket for pipeline_id in range(3)]
+        self.assertNotIn(None, tickets)
+        decision = self._admit(3)
+        self.assertFalse(decision.was_admitted)
+        self.assertEqual(decision.status, 429)
+        # started events no longer wait
+        self.assertTrue(self.store.start(tickets[0]))
+        self.assertTrue(self._admit(3).was_admitted)
+
+    def test_capacity_is_reserved_for_tags(self):
+        for pipeline_id in range(3):
+            self._admit(pipeline_id)
+        self.assertFalse(self._admit(3).was_admitted)
+        self.assertTrue(self._admit(4, tag=True).was_admitted)
+        self.assertEqual(self._admit(5, tag=True).status, 429)
+
+    def test_superseded_events_are_dropped_first(self):
+        first = self._admit(1).ticket
+        self._admit(1)
+        other = self._admit(2).ticket
+        decision = self._admit(1)
+        self.assertTrue(decision.was_admitted)
+        self.assertEqual(decision.dropped, 2)
+        self.assertFalse(self.store.start(first))
+        self.assertTrue(self.store.start(other))
+        self.assertTrue(self.store.start(decision.ticket))
+        self.store.finish(first)
+        self.assertEqual(self.store.count_waiting(), 0)
+
+    def test_old_events_reject_branch_pipelines(self):
+        self._admit(1, now=0)
+        decision = self._admit(2, now=101)
+        self.assertEqual(decision.status, 503)
+        self.assertTrue(self._admit(3, tag=True, now=101).was_admitted)
+
+    def test_lost_tickets_expire(self):
+        control = AdmissionControl(max_pending=1, reserved_for_tags=0, max_age=None)
+        ticket = self.store.admit(control, "foo", _event(1), now=0).ticket
+        self.assertEqual(self.store.admit(control, "foo", _event(2), now=1).status, 429)
+        decision = self.store.admit(
+            control, "foo", _event(2), now=control.ticket_timeout + 1
+        )
+        self.assertTrue(decision.was_admitted)
+        # the event of an expired ticket still runs
+        self.assertTrue(self.store.start(ticket))
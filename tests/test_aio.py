@@ -0,0 +1,161 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pipedput.aio import AsyncEngine, AsyncHook, run_command
+from pipedput.handler import Project
+from pipedput.hooks import Hook
+from pipedput.process import ProcessLimits
+
+PYTHON = sys.executable
+
+
+def _create_event(pipeline_id: int):
+    return {
+        "object_attributes": {"id": pipeline_id},
+        "project": {"id": 1, "web_url": "http://gitlab.localhost:31312/dummy/dummy"},
+        "builds": [{"id": pipeline_id, "artifacts_file": {"filename": "a.zip"}}],
+    }
+
+
+class BarrierHook(Hook):
+    def __init__(self, barrier: threading.Barrier, **kwargs):
+        super().__init__(**kwargs)
+        self._barrier = barrier
+
+    def _execute(self, event, artifacts_directory):
+        self._barrier.wait(timeout=5)
+        yield self._success(asset=str(event["object_attributes"]["id"]))
+
+
+class EchoHook(AsyncHook):
+    async def _execute_async(self, event, artifacts_directory):
+        process = await run_command([PYTHON, "-c", "print('hello')"], check=True)
+        yield self._success(asset=process.stdout.decode().strip())
+
+
+class UploadHook(AsyncHook):
+    def __init__(self, uploads: list, **kwargs):
+        super().__init__(**kwargs)
+        self._uploads = uploads
+
+    async def _execute_async(self, event, artifacts_directory):
+        self._uploads.append("start")
+        await asyncio.sleep(0.05)
+        self._uploads.append("end")
+        yield self._success(asset="upload")
+
+
+@patch("pipedput.aio.unzip", MagicMock())
+@patch("pipedput.aio.download_file", MagicMock())
+class AsyncEngineTest(unittest.TestCase):
+    @patch("pipedput.aio._report_deployments")
+    def test_events_are_processed_concurrently(self, report: MagicMock):
+        # both events must be in their hook at the same time to pass the barrier
+        project = Project("foo", BarrierHook(threading.Barrier(2)))
+        engine = AsyncEngine(concurrency=2)
+        asyncio.run(
+            engine.process_many(
+                [(project, _create_event(1)), (project, _create_event(2))]
+            )
+        )
+        self.assertEqual(report.call_count, 2)
+        for call in report.call_args_list:
+            deployments = call.args[2]
+            self.assertEqual(len(deployments), 1)
+            self.assertTrue(deployments[0].was_successful)
+
+    @patch("pipedput.aio._report_deployments")
+    def test_async_hook(self, report: MagicMock):
+        engine = AsyncEngine()
+        asyncio.run(engine.process(Project("foo", EchoHook()), _create_event(1)))
+        deployments = report.call_args.args[2]
+        self.assertEqual(deployments[0].asset, "hello")
+
+    @patch("pipedput.aio._report_deployments")
+    def test_async_hooks_with_the_same_lock_key_are_serialized(self, report):
+        uploads: list = []
+        engine = AsyncEngine(concurrency=2)
+        asyncio.run(
+            engine.process_many(
+                [
+                    (Project(key, UploadHook(uploads, lock_key="repo")), event)
+                    for key, event in (
+                        ("foo", _create_event(1)),
+                        ("bar", _create_event(2)),
+                    )
+                ]
+            )
+        )
+        self.assertEqual(uploads, ["start", "end", "start", "end"])
+        for call in report.call_args_list:
+            self.assertTrue(call.args[2][0].was_successful)
+
+    def test_async_hook_in_sync_context(self):
+        deployments = list(EchoHook()(_create_event(1), "foo"))
+        self.assertEqual(deployments[0].asset, "hello")
+
+    @patch("pipedput.aio._report_error")
+    def test_errors_are_reported(self, report_error: MagicMock):
+        engine = AsyncEngine()
+        project = Project("foo", Hook(should_deploy=MagicMock(side_effect=ValueError)))
+        asyncio.run(engine.process(project, _create_event(1)))
+        self.assertIsInstance(report_error.call_args.args[2], ValueError)
+
+    @patch("pipedput.aio._report_deployments")
+    def test_submit_from_other_thread(self, report: MagicMock):
+        engine = AsyncEngine()
+        try:
+            future = engine.submit(Project("foo", EchoHook()), _create_event(1))
+            future.result(timeout=10)
+        finally:
+            engine.stop()
+        report.assert_called_once()
+
+
+class RunCommandTest(unittest.TestCase):
+    def test_output(self):
+        process = asyncio.run(
+            run_command([PYTHON, "-c", "import sys; sys.stderr.write('err')"])
+        )
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(process.stderr, b"err")
+
+    def test_check(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            asyncio.run(run_command([PYTHON, "-c", "exit(3)"], check=True))
+
+    def test_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            asyncio.run(
+                run_command([PYTHON, "-c", "import time; time.sleep(5)"], timeout=0.1)
+            )
+
+    def test_timeout_kills_process_group(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            marker = os.path.join(tmp_dir, "marker")
+            child = f"import time; time.sleep(2); open({marker!r}, 'w')"
+            code = (
+                "import subprocess, sys, time; "
+                f"subprocess.Popen([sys.executable, '-c', {child!r}]); "
+                "time.sleep(30)"
+            )
+            with self.assertRaises(subprocess.TimeoutExpired):
+                asyncio.run(run_command([PYTHON, "-c", code], timeout=0.5))
+            time.sleep(2.5)
+            self.assertFalse(os.path.exists(marker))
+
+    def test_limits_and_measurements(self):
+        limits = ProcessLimits(max_cpu_seconds=1)
+        process = asyncio.run(
+            run_command([PYTHON, "-c", "while True: pass"], limits=limits)
+        )
+        self.assertLess(process.returncode, 0)
+        self.assertGreater(process.duration, 0)
+        self.assertGreater(process.max_rss, 0)
@@ -2,21 +2,35 @@ import datetime
 import json
 import os
 from os.path import join
+import tempfile
+import time
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from pipedput.utils import html_to_markdown
+from pipedput.utils import ExtractionLimits, html_to_markdown
+from tests.test_tracing import TracingTestMixin
 from tests.utils import (
     create_bin_patcher,
     css_query_select,
+    ensure_gitlab_mock_server,
     FILES_DIR,
     HTMLInMixin,
-    start_gitlab_mock_server,
 )
 
 os.environ.setdefault("PIPEDPUT_CONFIG_FILE", join(FILES_DIR, "config.py"))
 
-from pipedput.app import app, mail  # noqa: E402 I100 I202
+from pipedput.admission import AdmissionControl  # noqa: E402 I100 I202
+from pipedput.app import app, get_admission_store, get_event_store, mail  # noqa: E402
+from pipedput.constraints import IsTag  # noqa: E402
+from pipedput.digest import MailDigest  # noqa: E402
+from pipedput.handler import (  # noqa: E402
+    get_queue_consumer,
+    get_scheduler,
+    resume_digests,
+    send_due_digests,
+)
+from pipedput.scheduler import Lane  # noqa: E402
+from pipedput.workqueue import FileQueueBackend  # noqa: E402
 
 patch_twine = create_bin_patcher(
     "pipedput.hooks.PublishToPythonRepository._twine", "twine"
@@ -69,6 +83,24 @@ class APISecurityTest(FlaskTest):
         )
         self.assertEqual(res.status_code, 200)
 
+    def test_accept_all_rotated_access_tokens(self):
+        for token in ("cde456", "efg789"):
+            res = self.app.post(
+                "/api/projects/auth-rotation/publish",
+                json={"object_kind": "build"},
+                headers={"X-Gitlab-Token": token},
+            )
+            # authentication passed, but the event itself is rejected
+            self.assertEqual(res.status_code, 400)
+
+    def test_reject_invalid_rotated_access_token(self):
+        res = self.app.post(
+            "/api/projects/auth-rotation/publish",
+            json={"object_kind": "build"},
+            headers={"X-Gitlab-Token": "cde4567"},
+        )
+        self.assertEqual(res.status_code, 403)
+
     def test_reject_empty_event(self):
         res = self.app.post("/api/projects/deb/publish", json={})
         self.assertEqual(res.status_code, 400)
@@ -82,6 +114,137 @@ class APISecurityTest(FlaskTest):
         self.assertEqual(res.status_code, 400)
 
 
+class CorrelationIdTest(FlaskTest):
+    def test_correlation_id_is_returned(self):
+        event = {
+            "object_kind": "pipeline",
+            "object_attributes": {
+                "id": 1,
+                "finished_at": datetime.datetime.now().isoformat(),
+                "ref": "v1.0.0",
+            },
+            "project": {"path_with_namespace": "dummy/dummy"},
+        }
+        headers = {"X-Gitlab-Token": "cde456"}
+        res = self.app.post("/api/projects/auth/publish", json=event, headers=headers)
+        self.assertEqual(len(res.headers["X-Correlation-Id"]), 32)
+        res = self.app.post(
+            "/api/projects/auth/publish",
+            json=event,
+            headers={**headers, "X-Request-Id": "abc"},
+        )
+        self.assertEqual(res.headers["X-Correlation-Id"], "abc")
+
+
+class AdmissionControlTest(FlaskTest):
+    event = {
+        "object_kind": "pipeline",
+        "object_attributes": {
+            "id": 1,
+            "finished_at": datetime.datetime.now().isoformat(),
+            "ref": "v1.0.0",
+            "tag": False,
+        },
+        "project": {"path_with_namespace": "dummy/dummy"},
+    }
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = patch.dict(
+            app.config,
+            {
+                "ADMISSION_CONTROL": AdmissionControl(
+                    max_pending=2, reserved_for_tags=1, retry_after=30
+                ),
+                "ADMISSION_DB": join(tmp_dir.name, "admission.sqlite3"),
+            },
+        )
+        config.start()
+        self.addCleanup(config.stop)
+
+    def test_events_are_rejected_when_too_many_are_waiting(self):
+        headers = {"X-Gitlab-Token": "cde456"}
+        res = self.app.post(
+            "/api/projects/auth/publish", json=self.event, headers=headers
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(get_admission_store().count_waiting(), 0)
+        # an event that is still waiting for a mule
+        get_admission_store().admit(
+            app.config["ADMISSION_CONTROL"], "auth", {"object_attributes": {"id": 2}}
+        )
+        res = self.app.post(
+            "/api/projects/auth/publish", json=self.event, headers=headers
+        )
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers["Retry-After"], "30")
+        tag_event = {
+            **self.event,
+            "object_attributes": {**self.event["object_attributes"], "tag": True},
+        }
+        res = self.app.post(
+            "/api/projects/auth/publish", json=tag_event, headers=headers
+        )
+        self.assertEqual(res.status_code, 200)
+
+    def test_events_are_rejected_when_old_events_are_waiting(self):
+        app.config["ADMISSION_CONTROL"] = AdmissionControl(max_age=60)
+        get_admission_store().admit(
+            app.config["ADMISSION_CONTROL"],
+            "auth",
+            {"object_attributes": {"id": 2}},
+            now=time.time() - 1000,
+        )
+        res = self.app.post(
+            "/api/projects/auth/publish",
+            json=self.event,
+            headers={"X-Gitlab-Token": "cde456"},
+        )
+        self.assertEqual(res.status_code, 503)
+        self.assertIn(b"have been waiting for too long", res.data)
+
+
+class PriorityLanesTest(FlaskTest):
+    def test_lanes_without_workers_are_reported(self):
+        lanes = [Lane("releases", weight=8, constraint=IsTag())]
+        with patch.dict(app.config, {"PRIORITY_LANES": lanes}):
+            with self.assertLogs("pipedput.handler", "WARNING"):
+                get_scheduler()
+            with self.assertNoLogs("pipedput.handler", "WARNING"):
+                get_scheduler()
+        get_scheduler()
+
+
+class EventStoreTest(FlaskTest):
+    def test_accepted_events_are_stored(self):
+        event = {
+            "object_kind": "pipeline",
+            "object_attributes": {
+                "id": 1,
+                "finished_at": datetime.datetime.now().isoformat(),
+                "ref": "v1.0.0",
+                "sha": "abc",
+                "status": "success",
+            },
+            "project": {"path_with_namespace": "dummy/dummy"},
+        }
+        with tempfile.TemporaryDirectory() as store_dir:
+            with patch.dict(app.config, {"EVENT_STORE_DIR": store_dir}):
+                res = self.app.post(
+                    "/api/projects/auth/publish",
+                    json=event,
+                    headers={"X-Gitlab-Token": "cde456"},
+                )
+                self.assertEqual(res.status_code, 200)
+                self.app.post("/api/projects/auth/publish", json=event)
+                stored_events = get_event_store().find(project_key="auth")
+                self.assertEqual(len(stored_events), 1)
+                self.assertEqual(stored_events[0].sha, "abc")
+                self.assertEqual(get_event_store().load(stored_events[0]), event)
+
+
 class ErrorReportTest(FlaskTest):
     def test_error_in_hook_triggers_error_report(self):
         with mail.record_messages() as outbox:
@@ -125,6 +288,100 @@ class ErrorReportTest(FlaskTest):
             self.assertIn("nope", report_message.html)
 
 
+class TracingTest(TracingTestMixin, FlaskTest):
+    def test_pipeline_is_traced(self):
+        data = {
+            "object_kind": "pipeline",
+            "object_attributes": {
+                "id": 1,
+                "finished_at": datetime.datetime.now().isoformat(),
+                "ref": "0000000000000000000000000000000000000000",
+            },
+            "user": {"name": "Herbert", "email": "herbert@gitlab.localhost"},
+            "project": {
+                "id": 1,
+                "path_with_namespace": "dummy/dummy",
+                "web_url": "http://gitlab.localhost:31312/dummy/dummy",
+            },
+            "builds": [
+                {
+                    "id": 376,
+                    "artifacts_file": {"filename": "artifacts-deb.zip", "size": 1620},
+                }
+            ],
+        }
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        with patch.dict(app.config, {"TRACING_EXPORTER": self.exporter}):
+            res = self.app.post(
+                "/api/projects/fail-badly/publish",
+                json=data,
+                headers={"traceparent": traceparent},
+            )
+        self.assertEqual(res.status_code, 200)
+        spans = {span.name: span for span in self.exporter.spans}
+        self.assertLessEqual(
+            {
+                "accept pipeline event",
+                "schedule pipeline",
+                "process pipeline",
+                "download",
+                "hook",
+                "send mail",
+            },
+            set(spans),
+        )
+        self.assertEqual(
+            {span.context.trace_id for span in self.exporter.spans},
+            {"0af7651916cd43dd8448eb211c80319c"},
+        )
+        self.assertEqual(
+            spans["accept pipeline event"].parent_span_id, "b7ad6b7169203331"
+        )
+        self.assertEqual(
+            spans["process pipeline"].parent_span_id,
+            spans["schedule pipeline"].context.span_id,
+        )
+        self.assertEqual(spans["hook"].attributes, {"hook": "FailHook"})
+
+
+class WorkQueueTest(FlaskTest):
+    def test_events_are_processed_from_the_work_queue(self):
+        data = {
+            "object_kind": "pipeline",
+            "object_attributes": {
+                "id": 1,
+                "finished_at": datetime.datetime.now().isoformat(),
+                "ref": "0000000000000000000000000000000000000000",
+            },
+            "user": {"name": "Herbert", "email": "herbert@gitlab.localhost"},
+            "project": {
+                "id": 1,
+                "path_with_namespace": "dummy/dummy",
+                "web_url": "http://gitlab.localhost:31312/dummy/dummy",
+            },
+            "builds": [
+                {
+                    "id": 376,
+                    "artifacts_file": {"filename": "artifacts-deb.zip", "size": 1620},
+                }
+            ],
+        }
+        with tempfile.TemporaryDirectory() as queue_dir, mail.record_messages() as outbox:
+            backend = FileQueueBackend(queue_dir)
+            with patch.dict(
+                app.config, {"WORK_QUEUE": backend, "WORK_QUEUE_POLL_INTERVAL": 0.01}
+            ):
+                self.addCleanup(get_queue_consumer)
+                res = self.app.post("/api/projects/fail-badly/publish", json=data)
+                self.assertEqual(res.status_code, 200)
+                deadline = time.monotonic() + 5
+                while backend.count_pending() and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            self.assertEqual(backend.count_pending(), 0)
+            self.assertEqual(len(outbox), 1)
+            self.assertIn("nope", outbox[0].html)
+
+
 class PublishToDebRepositoryTest(FlaskTest):
     @patch_dput(inject_mock_as="dput")
     def test_successful_deployment(self, dput: MagicMock):
@@ -159,6 +416,22 @@ class PublishToDebRepositoryTest(FlaskTest):
                 css_query_select(mail_html, "li.is-failure .title"),
             )
 
+    @patch_dput(inject_mock_as="dput")
+    def test_extraction_limits_trigger_deployment_error(self, dput: MagicMock):
+        test_data = self._load_event("success-tag.json")
+        limits = ExtractionLimits(max_members=1)
+        with mail.record_messages() as outbox, patch.dict(
+            app.config, {"EXTRACTION_LIMITS": limits}
+        ):
+            res = self.app.post("/api/projects/deb/publish", json=test_data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(outbox), 1)
+            self.assertIn(
+                "artifact extraction",
+                css_query_select(outbox[0].html, "li.is-failure .title"),
+            )
+            dput.assert_not_called()
+
     @patch_dput(inject_mock_as="dput")
     def test_skip_deployment_if_not_tagged(self, dput: MagicMock):
         test_data = self._load_event("success-no-tag.json")
@@ -169,6 +442,73 @@ class PublishToDebRepositoryTest(FlaskTest):
             dput.assert_not_called()
 
 
+class MailDigestTest(FlaskTest):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.dict(
+            app.config,
+            {
+                "MAIL_DIGEST": MailDigest(interval=3600),
+                "MAIL_DIGEST_DB": join(self._tmp_dir.name, "digests.sqlite3"),
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    @patch_dput()
+    def test_successful_deployments_are_collected(self):
+        test_data = self._load_event("success-tag.json")
+        with mail.record_messages() as outbox:
+            for _ in range(2):
+                res = self.app.post("/api/projects/deb/publish", json=test_data)
+                self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(outbox), 0)
+            self.assertEqual(send_due_digests(), 0)
+            self.assertEqual(send_due_digests(force=True), 2)
+            self.assertEqual(
+                {message.recipients[0] for message in outbox},
+                {"user@gitlab.localhost", "user_email@gitlab.localhost"},
+            )
+            mail_html = outbox[0].html
+            self.assertIn("2 pipelines", mail_html)
+            self.assertIn(
+                "bleuartd_0.1.0-1_amd64.changes",
+                css_query_select(mail_html, "li.is-success .title small"),
+            )
+            self.assertEqual(send_due_digests(force=True), 0)
+
+    @patch_dput()
+    def test_pending_digests_are_sent_after_a_restart(self):
+        app.config["MAIL_DIGEST"] = MailDigest(interval=0.01)
+        test_data = self._load_event("success-tag.json")
+        with mail.record_messages() as outbox:
+            res = self.app.post("/api/projects/deb/publish", json=test_data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(outbox), 0)
+            time.sleep(0.05)
+            # a restarted process sends due digests without further events
+            with patch("pipedput.handler._digest_sender_pid", None):
+                resume_digests()
+            deadline = time.monotonic() + 5
+            while len(outbox) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(outbox), 2)
+
+    @patch_dput(fail=True)
+    def test_failures_are_sent_immediately(self):
+        test_data = self._load_event("success-tag.json")
+        with mail.record_messages() as outbox:
+            res = self.app.post("/api/projects/deb/publish", json=test_data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(outbox), 1)
+            self.assertEqual(send_due_digests(force=True), 0)
+
+
 class PublishToPythonRepositoryTest(FlaskTest):
     @patch_twine(inject_mock_as="twine")
     def test_successful_deployment(self, twine: MagicMock):
@@ -305,4 +645,4 @@ class MailNotificationTest(HTMLInMixin, FlaskTest):
                 self.assertEqual(message.body, html_to_markdown(message.html))
 
 
-start_gitlab_mock_server()
+ensure_gitlab_mock_server()
@@ -0,0 +1,48 @@
+import unittest
+
+from pipedput.auth import ProjectIndex
+from pipedput.handler import Project
+from pipedput.utils import Configuration
+
+
+class ProjectIndexTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = ProjectIndex(
+            [
+                Project("public"),
+                Project("single", pipeline_secret="abc"),
+                Project("rotated", pipeline_secret=["abc", "def"]),
+            ]
+        )
+
+    def test_public_project_needs_no_token(self):
+        self.assertEqual(self.index.authenticate("public", None).key, "public")
+        self.assertEqual(self.index.authenticate("public", "foo").key, "public")
+
+    def test_single_secret(self):
+        self.assertEqual(self.index.authenticate("single", "abc").key, "single")
+        with self.assertRaises(ProjectIndex.NotAllowed):
+            self.index.authenticate("single", "def")
+        with self.assertRaises(ProjectIndex.NotAllowed):
+            self.index.authenticate("single", None)
+
+    def test_rotated_secrets(self):
+        self.assertEqual(self.index.authenticate("rotated", "abc").key, "rotated")
+        self.assertEqual(self.index.authenticate("rotated", "def").key, "rotated")
+        with self.assertRaises(ProjectIndex.NotAllowed):
+            self.index.authenticate("rotated", "ghi")
+
+    def test_unknown_project(self):
+        with self.assertRaises(Project.DoesNotExist):
+            self.index.authenticate("unknown", "abc")
+        with self.assertRaises(Project.DoesNotExist):
+            self.index.get("unknown")
+
+    def test_secrets_are_not_stored_in_plain_text(self):
+        _, digests = self.index._entries["single"]
+        self.assertNotIn(b"abc", digests)
+
+    def test_duplicate_keys_are_rejected(self):
+        with self.assertRaises(Configuration.ConfigurationError):
+            ProjectIndex([Project("foo"), Project("foo")])
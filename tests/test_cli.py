@@ -0,0 +1,114 @@
+import contextlib
+import io
+import os
+from os.path import join
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from tests.utils import create_bin_patcher, ensure_gitlab_mock_server, FILES_DIR
+
+os.environ.setdefault("PIPEDPUT_CONFIG_FILE", join(FILES_DIR, "config.py"))
+
+from pipedput import locks  # noqa: E402 I100 I202
+from pipedput.app import app, mail  # noqa: E402
+from pipedput.cli import main  # noqa: E402
+
+patch_dput = create_bin_patcher("pipedput.hooks.PublishToDebRepository._dput", "dput")
+TAG_EVENT = join(FILES_DIR, "events", "success-tag.json")
+
+
+class RecordingLockBackend(locks.LocalLockBackend):
+    def __init__(self):
+        super().__init__()
+        self.keys = []
+
+    def try_acquire(self, key, owner, now=None):
+        self.keys.append(key)
+        return super().try_acquire(key, owner, now)
+
+
+class ReplayTest(unittest.TestCase):
+    def _replay(self, *args: str):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            exit_code = main(["replay", *args])
+        return exit_code, output.getvalue()
+
+    @patch_dput(inject_mock_as="dput")
+    def test_dry_run_lists_assets(self, dput: MagicMock):
+        exit_code, output = self._replay("--project", "deb", "--dry-run", TAG_EVENT)
+        self.assertEqual(exit_code, 0)
+        self.assertIn("deb repository: 1 matching assets", output)
+        self.assertIn("artifacts/debian/bleuartd_0.1.0-1_amd64.changes", output)
+        dput.assert_not_called()
+
+    @patch_dput(inject_mock_as="dput")
+    def test_replay_deploys_without_mails(self, dput: MagicMock):
+        with mail.record_messages() as outbox:
+            exit_code, output = self._replay("--project", "deb", TAG_EVENT)
+            self.assertEqual(len(outbox), 0)
+        self.assertEqual(exit_code, 0)
+        self.assertIn("bleuartd_0.1.0-1_amd64.changes: success", output)
+        dput.assert_called_once()
+
+    @patch_dput()
+    def test_replay_sends_mails_on_request(self):
+        with mail.record_messages() as outbox:
+            self._replay("--project", "deb", "--send-mail", TAG_EVENT)
+            self.assertEqual(len(outbox), 1)
+
+    @patch_dput()
+    def test_profile(self):
+        exit_code, output = self._replay("--project", "deb", "--profile", TAG_EVENT)
+        self.assertEqual(exit_code, 0)
+        for stage in ("constraints", "download", "extract", "hook:deb repository"):
+            self.assertIn(f"=== {stage} ===", output)
+
+    @patch_dput(inject_mock_as="dput")
+    def test_batch_replay(self, dput: MagicMock):
+        with tempfile.TemporaryDirectory() as event_dir:
+            for index in range(3):
+                shutil.copy(TAG_EVENT, join(event_dir, f"{index}.json"))
+            exit_code, output = self._replay(
+                "--project", "deb", "--concurrency", "3", event_dir
+            )
+        self.assertEqual(exit_code, 0)
+        self.assertIn("replayed 3 events", output)
+        self.assertEqual(dput.call_count, 3)
+
+    @patch_dput()
+    def test_replay_uses_the_configured_lock_backend(self):
+        backend = RecordingLockBackend()
+        self.addCleanup(locks.set_backend, None)
+        with patch.dict(app.config, {"LOCK_BACKEND": backend}):
+            exit_code, _ = self._replay("--project", "deb", TAG_EVENT)
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(backend.keys)
+        for key in backend.keys:
+            self.assertTrue(key.startswith("deb:"))
+
+    def test_failed_deployments_are_listed(self):
+        exit_code, output = self._replay("--project", "fail-badly", TAG_EVENT)
+        self.assertEqual(exit_code, 1)
+        self.assertIn("FailHook: failure", output)
+
+    def test_unknown_project(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            exit_code, _ = self._replay("--project", "unknown", TAG_EVENT)
+        self.assertEqual(exit_code, 2)
+
+    def test_sentry_is_initialized_before_the_command_runs(self):
+        calls = MagicMock()
+        calls.replay.return_value = 0
+        with patch("pipedput.app.init_sentry", calls.init_sentry), patch(
+            "pipedput.cli.replay", calls.replay
+        ):
+            self._replay("--project", "unknown", TAG_EVENT)
+        self.assertEqual(
+            [name for name, _, _ in calls.mock_calls], ["init_sentry", "replay"]
+        )
+
+
+ensure_gitlab_mock_server()
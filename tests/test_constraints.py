@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+import json
 from os.path import join
 import unittest
 from unittest.mock import MagicMock, patch
@@ -5,15 +7,22 @@ import warnings
 
 from pipedput.constraints import (
     Callback,
+    compile_constraint,
+    IsDefaultBranch,
     IsProject,
+    IsProjectIn,
     IsTag,
+    JobNameIn,
     OnBranch,
     OnDefaultBranch,
+    RefIn,
+    RefResolver,
+    UserIn,
     WasManuallyStarted,
     WasPipelineStartedFromUI,
     WasSuccessful,
 )
-from tests.utils import TestFileMock
+from tests.utils import MockResponse, TestFileMock
 
 default_commit_ref = TestFileMock(
     join("commit-refs", "583972aba628265857e551ebeb3b58293c060591.json")
@@ -42,6 +51,19 @@ class ConstraintTest(unittest.TestCase):
         self.assertTrue(is_tag({"object_attributes": {"tag": True}}))
         self.assertFalse(is_tag({"object_attributes": {"tag": False}}))
 
+    def test_is_default_branch_constraint(self):
+        is_default_branch = IsDefaultBranch()
+
+        def event(ref, tag=False):
+            return {
+                "object_attributes": {"ref": ref, "tag": tag},
+                "project": {"default_branch": "main"},
+            }
+
+        self.assertTrue(is_default_branch(event("main")))
+        self.assertFalse(is_default_branch(event("feature")))
+        self.assertFalse(is_default_branch(event("main", tag=True)))
+
     @patch("pipedput.constraints.urlopen", default_commit_ref)
     def test_on_branch_constraint(self):
         event = {
@@ -185,3 +207,192 @@ class ConstraintTest(unittest.TestCase):
             was_not_successful({"object_attributes": {"status": "success"}})
         )
         self.assertTrue(was_not_successful({"object_attributes": {"status": "failed"}}))
+
+
+class CompileConstraintTest(unittest.TestCase):
+    EVENTS = [
+        {"object_attributes": {"status": status, "tag": tag, "source": source}}
+        for status in ("success", "failed")
+        for tag in (True, False)
+        for source in ("web", "push")
+    ]
+
+    def assertEquivalent(self, constraint):
+        compiled_constraint = compile_constraint(constraint)
+        for event in self.EVENTS:
+            self.assertEqual(
+                bool(compiled_constraint(event)), bool(constraint(event)), event
+            )
+
+    def test_compiled_constraint_is_equivalent(self):
+        self.assertEquivalent(WasSuccessful() & IsTag())
+        self.assertEquivalent(WasSuccessful() | IsTag() | WasPipelineStartedFromUI())
+        self.assertEquivalent(
+            (WasSuccessful() & ~IsTag()) | ~(WasPipelineStartedFromUI() | IsTag())
+        )
+        self.assertEquivalent(~~(WasSuccessful() & ~~IsTag()))
+        self.assertEquivalent(~(~WasSuccessful() & ~~~IsTag()))
+
+    def test_identical_constraints_are_evaluated_once(self):
+        callback = MagicMock(return_value=True)
+        constraint = Callback(callback) & IsTag() & Callback(callback) & IsTag()
+        compiled_constraint = compile_constraint(constraint)
+        self.assertTrue(compiled_constraint({"object_attributes": {"tag": True}}))
+        callback.assert_called_once()
+
+    def test_double_negation_is_removed(self):
+        is_tag = IsTag()
+        self.assertIs(compile_constraint(~~is_tag), is_tag)
+
+    def test_long_chains_do_not_exceed_recursion_limit(self):
+        callbacks = [Callback(lambda event: True) for _ in range(5000)]
+        constraint = callbacks[0]
+        for callback in callbacks[1:]:
+            constraint = constraint & callback
+        self.assertTrue(compile_constraint(constraint)({}))
+
+    def test_none(self):
+        self.assertIsNone(compile_constraint(None))
+
+
+class MembershipConstraintTest(unittest.TestCase):
+    def test_is_project_in_constraint(self):
+        is_project_in = IsProjectIn(
+            ["foo/bar"], globs=["mirrors/*"], regexes=[r"forks/bar-\d+"]
+        )
+        for name, expected in (
+            ("foo/bar", True),
+            ("mirrors/bar", True),
+            ("forks/bar-1", True),
+            ("forks/bar-1x", False),
+            ("foo/baz", False),
+        ):
+            event = {"project": {"path_with_namespace": name}}
+            self.assertEqual(is_project_in(event), expected, name)
+
+    def test_ref_in_constraint(self):
+        ref_in = RefIn(["main"], globs=["release/*"])
+        self.assertTrue(ref_in({"object_attributes": {"ref": "main"}}))
+        self.assertTrue(ref_in({"object_attributes": {"ref": "release/1.0"}}))
+        self.assertFalse(ref_in({"object_attributes": {"ref": "feature"}}))
+
+    def test_user_in_constraint(self):
+        user_in = UserIn(["alice", "bob"])
+        self.assertTrue(user_in({"user": {"username": "bob"}}))
+        self.assertFalse(user_in({"user": {"username": "eve"}}))
+
+    def test_job_name_in_constraint(self):
+        job_name_in = JobNameIn(["deploy"], regexes=["publish:.+"])
+        self.assertTrue(
+            job_name_in({"builds": [{"name": "build"}, {"name": "deploy"}]})
+        )
+        self.assertTrue(job_name_in({"builds": [{"name": "publish:pypi"}]}))
+        self.assertFalse(job_name_in({"builds": [{"name": "build"}]}))
+
+    def test_or_of_projects_is_folded(self):
+        constraint = (
+            IsProject("foo/a")
+            | IsTag()
+            | IsProject("foo/b")
+            | IsProjectIn(globs=["bar/*"])
+        )
+        compiled_constraint = compile_constraint(constraint)
+        with patch("pipedput.constraints.IsProjectIn.__call__") as call:
+            call.return_value = False
+            compiled_constraint({"object_attributes": {"tag": False}})
+        # all project constraints are evaluated with a single lookup
+        call.assert_called_once()
+        for name, expected in (("foo/a", True), ("foo/b", True), ("bar/c", True)):
+            event = {
+                "project": {"path_with_namespace": name},
+                "object_attributes": {"tag": False},
+            }
+            self.assertEqual(compiled_constraint(event), expected)
+        self.assertFalse(
+            compiled_constraint(
+                {
+                    "project": {"path_with_namespace": "foo/c"},
+                    "object_attributes": {"tag": False},
+                }
+            )
+        )
+
+
+class RefResolverTest(unittest.TestCase):
+    EVENT = {
+        "commit": {"id": "abc"},
+        "project": {
+            "id": 1,
+            "web_url": "http://gitlab.localhost:31312/dummy/dummy",
+            "default_branch": "main",
+        },
+    }
+
+    def _create_urlopen(self, pages):
+        @contextmanager
+        def urlopen(request):
+            url, _, page = request.full_url.partition("&page=")
+            index = int(page or 0)
+            headers = {}
+            if index + 1 < len(pages):
+                headers["Link"] = f'<{url}&page={index + 1}>; rel="next"'
+            yield MockResponse(json.dumps(pages[index]).encode(), headers)
+
+        return MagicMock(side_effect=urlopen)
+
+    def test_all_pages_are_fetched(self):
+        urlopen = self._create_urlopen(
+            [
+                [{"type": "branch", "name": "foo"}],
+                [{"type": "tag", "name": "v1"}, {"type": "branch", "name": "main"}],
+            ]
+        )
+        resolver = RefResolver()
+        with patch("pipedput.constraints.urlopen", urlopen):
+            self.assertTrue(OnDefaultBranch("token", resolver)(self.EVENT))
+        self.assertEqual(urlopen.call_count, 2)
+
+    def test_refs_are_shared(self):
+        urlopen = self._create_urlopen([[{"type": "branch", "name": "main"}]])
+        resolver = RefResolver()
+        with patch("pipedput.constraints.urlopen", urlopen):
+            self.assertTrue(OnDefaultBranch("token", resolver)(self.EVENT))
+            self.assertTrue(OnBranch("token", "main", resolver)(self.EVENT))
+            self.assertFalse(OnBranch("token", "foo", resolver)(self.EVENT))
+        urlopen.assert_called_once()
+        resolver.ttl = 0
+        with patch("pipedput.constraints.urlopen", urlopen):
+            OnDefaultBranch("token", resolver)(self.EVENT)
+        self.assertEqual(urlopen.call_count, 2)
+
+    def test_refs_are_not_shared_between_tokens(self):
+        urlopen = self._create_urlopen([[{"type": "branch", "name": "main"}]])
+        resolver = RefResolver()
+        with patch("pipedput.constraints.urlopen", urlopen):
+            self.assertTrue(OnDefaultBranch("token", resolver)(self.EVENT))
+            self.assertTrue(OnBranch("other-token", "main", resolver)(self.EVENT))
+        self.assertEqual(
+            [call.args[0].get_header("Private-token") for call in urlopen.mock_calls],
+            ["token", "other-token"],
+        )
+
+    def test_next_pages_of_other_origins_are_not_followed(self):
+        @contextmanager
+        def urlopen(request):
+            headers = {"Link": '<http://evil.localhost/refs?page=2>; rel="next"'}
+            yield MockResponse(b"[]", headers)
+
+        urlopen = MagicMock(side_effect=urlopen)
+        with patch("pipedput.constraints.urlopen", urlopen):
+            with self.assertRaises(ValueError):
+                RefResolver().get_refs(self.EVENT, "token")
+        urlopen.assert_called_once()
+
+    def test_failed_lookups_are_not_cached(self):
+        urlopen = MagicMock(side_effect=OSError("unreachable"))
+        resolver = RefResolver()
+        with patch("pipedput.constraints.urlopen", urlopen):
+            for _ in range(2):
+                with self.assertRaises(OSError):
+                    resolver.get_refs(self.EVENT, "token")
+        self.assertEqual(urlopen.call_count, 2)
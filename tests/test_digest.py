@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+from pipedput.digest import DigestStore, MailDigest
+from pipedput.report import DeploymentReport
+
+
+class DigestStoreTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp_dir.name, "digests.sqlite3")
+        self.store = DigestStore(self.path)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def _add(self, group_key: str, pipeline_id: int, now: float, interval=60):
+        self.store.add(
+            [(group_key, f"{group_key}@example.com", None)],
+            {"pipeline_id": pipeline_id},
+            interval,
+            now=now,
+        )
+
+    def test_groups_are_due_after_their_interval(self):
+        self._add("a", 1, now=0)
+        self._add("a", 2, now=50)
+        self._add("b", 3, now=30)
+        self.assertEqual(self.store.claim_due(now=59), [])
+        (digest,) = self.store.claim_due(now=60)
+        self.assertEqual(digest.group_key, "a")
+        self.assertEqual(digest.recipient, "a@example.com")
+        self.assertEqual([entry["pipeline_id"] for entry in digest.entries], [1, 2])
+        # claimed digests are not claimed a second time
+        self.assertEqual(self.store.claim_due(now=60), [])
+        self.store.complete(digest)
+        self.assertEqual(self.store.count_pending(), 1)
+
+    def test_force(self):
+        self._add("a", 1, now=0)
+        self.assertEqual(len(self.store.claim_due(force=True, now=0)), 1)
+
+    def test_released_digests_are_claimed_again(self):
+        self._add("a", 1, now=0)
+        (digest,) = self.store.claim_due(now=60)
+        self.store.release(digest)
+        self.assertEqual(len(self.store.claim_due(now=60)), 1)
+
+    def test_claims_of_crashed_processes_expire(self):
+        self._add("a", 1, now=0)
+        self.store.claim_due(now=60)
+        self.assertEqual(self.store.claim_due(now=61), [])
+        self.assertEqual(
+            len(self.store.claim_due(now=61 + DigestStore.CLAIM_TIMEOUT)), 1
+        )
+
+    def test_pending_digests_survive_restarts(self):
+        self._add("a", 1, now=0)
+        self.assertEqual(len(DigestStore(self.path).claim_due(now=60)), 1)
+
+
+class MailDigestTest(unittest.TestCase):
+    def test_group_key(self):
+        self.assertEqual(
+            MailDigest().get_group_key("foo", "a@example.com"), "foo:a@example.com"
+        )
+        per_recipient = MailDigest(group_by=MailDigest.PER_RECIPIENT)
+        self.assertEqual(
+            per_recipient.get_group_key("foo", "a@example.com"), "a@example.com"
+        )
+
+    def test_failures_bypass_the_digest(self):
+        report = DeploymentReport()
+        report.set_error(ValueError("nope"))
+        self.assertFalse(MailDigest().accepts(report))
+        self.assertTrue(MailDigest(send_failures_immediately=False).accepts(report))
+        self.assertTrue(MailDigest().accepts(DeploymentReport()))
+        self.assertFalse(MailDigest(interval=0).accepts(DeploymentReport()))
@@ -0,0 +1,46 @@
+import json
+import pickle
+import unittest
+
+from pipedput.event import PipelineEvent
+
+
+class PipelineEventTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = {
+            "object_kind": "pipeline",
+            "project": {"id": 1, "web_url": "https://git.example.com/foo/bar"},
+            "builds": [
+                {"id": 1, "name": "build", "manual": False, "artifacts_file": {}},
+                {
+                    "id": 2,
+                    "name": "deploy",
+                    "manual": True,
+                    "artifacts_file": {"filename": "artifacts.zip", "size": 1},
+                },
+                {"id": 3, "name": "deploy", "manual": False, "artifacts_file": {}},
+            ],
+        }
+
+    def test_indexes(self):
+        event = PipelineEvent(self.data)
+        self.assertEqual(event.builds_by_name["deploy"]["id"], 2)
+        self.assertEqual([build["id"] for build in event.builds_with_artifacts], [2])
+        self.assertEqual(event.api_base_url, "https://git.example.com/api/v4")
+
+    def test_is_dict_compatible(self):
+        event = PipelineEvent(self.data)
+        self.assertEqual(event, self.data)
+        self.assertEqual(json.loads(json.dumps(event)), self.data)
+        self.assertFalse(hasattr(event, "__dict__"))
+
+    def test_parse_returns_parsed_events(self):
+        event = PipelineEvent.parse(self.data)
+        self.assertIs(PipelineEvent.parse(event), event)
+
+    def test_pickle(self):
+        event = PipelineEvent(self.data)
+        unpickled_event = pickle.loads(pickle.dumps(event))
+        self.assertEqual(unpickled_event, event)
+        self.assertEqual(unpickled_event.builds_by_name, event.builds_by_name)
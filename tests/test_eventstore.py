@@ -0,0 +1,133 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from pipedput.eventstore import EventStore
+
+
+def _create_event(pipeline_id: int, sha: str = "abc", status: str = "success"):
+    return {
+        "object_kind": "pipeline",
+        "object_attributes": {"id": pipeline_id, "sha": sha, "status": status},
+        "builds": [],
+    }
+
+
+class EventStoreTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.store = EventStore(self._tmp_dir.name, segment_size=512)
+
+    def tearDown(self):
+        self.store.close()
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def _files(self, suffix: str):
+        return [
+            filename
+            for filename in os.listdir(self._tmp_dir.name)
+            if filename.endswith(suffix)
+        ]
+
+    def test_find_by_index(self):
+        self.store.append("foo", _create_event(1, sha="abc"))
+        self.store.append("foo", _create_event(2, sha="def", status="failed"))
+        self.store.append("bar", _create_event(3, sha="abc"))
+        self.assertEqual([e.pipeline_id for e in self.store.find()], [1, 2, 3])
+        self.assertEqual(
+            [e.pipeline_id for e in self.store.find(project_key="foo")], [1, 2]
+        )
+        self.assertEqual([e.pipeline_id for e in self.store.find(sha="abc")], [1, 3])
+        self.assertEqual([e.pipeline_id for e in self.store.find(status="failed")], [2])
+        self.assertEqual(
+            list(self.store.iter_events(project_key="bar")), [_create_event(3)]
+        )
+
+    def test_segments_are_rotated_and_compressed(self):
+        for pipeline_id in range(20):
+            self.store.append("foo", _create_event(pipeline_id))
+        self.assertTrue(self._files(EventStore.CLOSED_SUFFIX))
+        self.assertEqual(len(self._files(EventStore.OPEN_SUFFIX)), 1)
+        self.store.maintain()
+        self.assertFalse(self._files(EventStore.CLOSED_SUFFIX))
+        self.assertTrue(self._files(EventStore.COMPRESSED_SUFFIX))
+        # events remain readable from compressed and open segments
+        self.assertEqual(
+            list(self.store.iter_events()),
+            [_create_event(pipeline_id) for pipeline_id in range(20)],
+        )
+
+    def test_retention_by_age(self):
+        for pipeline_id in range(20):
+            self.store.append("foo", _create_event(pipeline_id))
+        self.store.close()
+        self.store.maintain()
+        self.store.max_age = 60
+        self.store.maintain(now=time.time() + 120)
+        self.assertFalse(self._files(EventStore.COMPRESSED_SUFFIX))
+        self.assertEqual(self.store.find(), [])
+
+    def test_old_segments_are_closed(self):
+        self.store.append("foo", _create_event(1))
+        self.store.segment_max_age = 60
+        # maintenance closes the open segment of a running process
+        self.store.maintain(now=time.time() + 120)
+        self.assertEqual(self._files(EventStore.OPEN_SUFFIX), [])
+        self.assertEqual(len(self._files(EventStore.COMPRESSED_SUFFIX)), 1)
+        # the writer notices that its segment has been closed
+        self.store.append("foo", _create_event(2))
+        self.assertEqual(len(self._files(EventStore.OPEN_SUFFIX)), 1)
+        self.assertEqual(
+            list(self.store.iter_events()), [_create_event(1), _create_event(2)]
+        )
+
+    def test_retention_by_age_includes_open_segments(self):
+        self.store.append("foo", _create_event(1))
+        self.store.max_age = 60
+        self.store.segment_max_age = 60
+        self.store.maintain(now=time.time() + 120)
+        for suffix in (
+            EventStore.OPEN_SUFFIX,
+            EventStore.CLOSED_SUFFIX,
+            EventStore.COMPRESSED_SUFFIX,
+        ):
+            self.assertEqual(self._files(suffix), [])
+        self.assertEqual(self.store.find(), [])
+
+    def test_retention_by_age_of_late_compressed_segments(self):
+        self.store.append("foo", _create_event(1))
+        self.store.close()
+        self.store.max_age = 60
+        # the segment is compressed long after its event has been received
+        later = time.time() + 120
+        with patch("pipedput.eventstore.time.time", return_value=later):
+            self.store.append("foo", _create_event(2))
+            self.store.close()
+            self.store.maintain(now=later)
+        self.assertEqual([e.pipeline_id for e in self.store.find()], [2])
+        self.assertEqual(len(self._files(EventStore.COMPRESSED_SUFFIX)), 1)
+
+    def test_retention_by_size(self):
+        for pipeline_id in range(40):
+            self.store.append("foo", _create_event(pipeline_id))
+        self.store.close()
+        self.store.maintain()
+        segment_count = len(self._files(EventStore.COMPRESSED_SUFFIX))
+        self.store.max_size = 1
+        self.store.maintain()
+        self.assertEqual(len(self._files(EventStore.COMPRESSED_SUFFIX)), 0)
+        self.assertGreater(segment_count, 1)
+        self.assertEqual(self.store.find(), [])
+
+    def test_segments_of_dead_processes_are_closed(self):
+        open(os.path.join(self._tmp_dir.name, "segment-1-999999999.jsonl.open"), "w")
+        self.store.maintain()
+        self.assertEqual(self._files(EventStore.OPEN_SUFFIX), [])
+        self.assertEqual(
+            self._files(EventStore.COMPRESSED_SUFFIX),
+            ["segment-1-999999999.jsonl.gz"],
+        )
@@ -1,6 +1,7 @@
 from contextlib import contextmanager
 import os
 from os.path import join
+import shutil
 import tarfile
 import tempfile
 from typing import Iterator, Optional
@@ -85,7 +86,7 @@ class PublishToPythonRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase
         with self.assertRaises(Configuration.ConfigurationError):
             hook._twine("foo.tar.gz")
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_fails_if_config_file_is_missing(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         config_file = "does_not_exist.pypirc"
@@ -94,7 +95,7 @@ class PublishToPythonRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase
             hook._twine("foo.tar.gz")
             subprocess_run.assert_not_called()
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_twine_with_config(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         hook = PublishToPythonRepository(self.SAMPLE_CONFIG)
@@ -105,7 +106,7 @@ class PublishToPythonRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase
             subprocess_run.call_args[0][0],
         )
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_twine_with_repository(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         hook = PublishToPythonRepository(repository="foo")
@@ -116,7 +117,7 @@ class PublishToPythonRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase
             subprocess_run.call_args[0][0],
         )
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_twine_with_repository_url(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         hook = PublishToPythonRepository(repository="https://foo")
@@ -137,7 +138,7 @@ class PublishToDebRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase):
         with self.assertRaises(Configuration.ConfigurationError):
             hook._dput("foo.tar.gz")
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_fails_if_config_file_is_missing(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         config_file = "does_not_exist.dput.cf"
@@ -146,13 +147,19 @@ class PublishToDebRepositoryHookTest(ContainedInOrderMixin, unittest.TestCase):
             hook._dput("foo.deb")
             subprocess_run.assert_not_called()
 
-    @patch("subprocess.run")
+    @patch("pipedput.process.run")
     def test_dput_execution(self, subprocess_run: MagicMock):
         subprocess_run.return_value = SubprocessRunResult()
         hook = PublishToDebRepository(self.SAMPLE_CONFIG)
         hook._dput("foo.deb")
         subprocess_run.assert_called_once()
         self.assertInOrder(
-            ["dput", "--config", self.SAMPLE_CONFIG],
+            [shutil.which("dput"), "--config", self.SAMPLE_CONFIG],
             subprocess_run.call_args[0][0],
         )
+
+    def test_lock_key(self):
+        hook = PublishToDebRepository(self.SAMPLE_CONFIG)
+        self.assertEqual(hook.get_lock_key({}), f"deb:{self.SAMPLE_CONFIG}")
+        hook = PublishToDebRepository(self.SAMPLE_CONFIG, lock_key="repo")
+        self.assertEqual(hook.get_lock_key({}), "repo")
@@ -0,0 +1,141 @@
+import tempfile
+import threading
+import unittest
+
+from pipedput import locks
+from pipedput.hooks import Hook
+from pipedput.locks import (
+    check_leases,
+    FileLockBackend,
+    get_fencing_token,
+    hold,
+    LocalLockBackend,
+    LockLost,
+    LockTimeout,
+)
+
+
+class LockBackendTestMixin:
+    def create_backend(self, **kwargs):
+        raise NotImplementedError()
+
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.backend = self.create_backend(ttl=10)
+
+    def test_locks_are_exclusive(self):
+        token = self.backend.try_acquire("repo", "a", now=0)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.backend.try_acquire("repo", "b", now=5))
+        self.assertIsNotNone(self.backend.try_acquire("other", "b", now=5))
+        self.backend.release("repo", "a", token)
+        self.assertEqual(self.backend.try_acquire("repo", "b", now=5), token + 1)
+
+    def test_expired_locks_are_taken_over(self):
+        token = self.backend.try_acquire("repo", "a", now=0)
+        self.assertTrue(self.backend.renew("repo", "a", token, now=8))
+        self.assertIsNone(self.backend.try_acquire("repo", "b", now=15))
+        new_token = self.backend.try_acquire("repo", "b", now=19)
+        self.assertGreater(new_token, token)
+        self.assertFalse(self.backend.renew("repo", "a", token, now=19))
+        # a stale holder doesn’t release the lock of its successor
+        self.backend.release("repo", "a", token)
+        self.assertIsNone(self.backend.try_acquire("repo", "c", now=20))
+
+    def test_acquire_times_out(self):
+        backend = self.create_backend(timeout=0.05)
+        lease = backend.acquire("repo")
+        with self.assertRaises(LockTimeout):
+            backend.acquire("repo")
+        backend.release(lease.key, lease.owner, lease.token)
+        self.assertGreater(backend.acquire("repo").token, lease.token)
+
+
+class LocalLockBackendTest(LockBackendTestMixin, unittest.TestCase):
+    def create_backend(self, **kwargs):
+        return LocalLockBackend(**kwargs)
+
+
+class FileLockBackendTest(LockBackendTestMixin, unittest.TestCase):
+    def create_backend(self, **kwargs):
+        return FileLockBackend(self._tmp_dir.name, **kwargs)
+
+    def test_nodes_are_exclusive(self):
+        # every backend stands for a node with its own guard file handles
+        backends = [self.create_backend() for _ in range(8)]
+        for key in range(20):
+            barrier = threading.Barrier(len(backends))
+            tokens = []
+
+            def acquire(backend, owner):
+                barrier.wait(timeout=5)
+                tokens.append(backend.try_acquire(f"repo-{key}", owner))
+
+            threads = [
+                threading.Thread(target=acquire, args=(backend, str(owner)))
+                for owner, backend in enumerate(backends)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual([token for token in tokens if token is not None], [1])
+
+
+class LockedHook(Hook):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tokens = []
+
+    def _execute(self, event, artifacts_directory):
+        self.tokens.append(get_fencing_token("repo"))
+        check_leases()
+        yield self._success(asset="foo")
+
+
+class HoldTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = LocalLockBackend(timeout=0.05)
+        locks.set_backend(self.backend)
+        self.addCleanup(locks.set_backend, None)
+
+    def test_lost_locks_are_detected(self):
+        with hold("repo") as lease:
+            check_leases()
+            self.backend.release(lease.key, lease.owner, lease.token)
+            self.backend.try_acquire("repo", "other")
+            with self.assertRaises(LockLost):
+                check_leases()
+        self.assertIsNone(get_fencing_token("repo"))
+
+    def test_hooks_hold_their_lock(self):
+        hook = LockedHook(lock_key="repo")
+        (deployment,) = hook({}, "")
+        self.assertTrue(deployment.was_successful)
+        (deployment,) = hook({}, "")
+        self.assertEqual(hook.tokens, [1, 2])
+
+    def test_hooks_fail_if_their_lock_is_held(self):
+        hook = LockedHook(lock_key="repo")
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with hold("repo"):
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        acquired.wait(5)
+        try:
+            (deployment,) = hook({}, "")
+        finally:
+            release.set()
+            thread.join()
+        self.assertFalse(deployment.was_successful)
+        self.assertIsInstance(deployment.exc, LockTimeout)
+        self.assertEqual(hook.tokens, [])
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+from pipedput.handler import _submit_in_context, Project
+from pipedput.log import (
+    get_correlation_id,
+    get_log_context,
+    JsonFormatter,
+    log_context,
+    LogContextFilter,
+)
+from pipedput.scheduler import Scheduler
+
+
+class LogContextTest(unittest.TestCase):
+    def test_nested_contexts(self):
+        with log_context(correlation_id="abc", project_key="foo"):
+            with log_context(hook="deb repository"):
+                self.assertEqual(
+                    dict(get_log_context()),
+                    {
+                        "correlation_id": "abc",
+                        "project_key": "foo",
+                        "hook": "deb repository",
+                    },
+                )
+            self.assertNotIn("hook", get_log_context())
+        self.assertIsNone(get_correlation_id())
+
+    def test_context_is_carried_into_worker_threads(self):
+        correlation_ids = []
+
+        def process(project, event):
+            correlation_ids.append(get_correlation_id())
+
+        with ThreadPoolExecutor(1) as executor, patch(
+            "pipedput.handler._process_project_pipeline", process
+        ):
+            scheduler = Scheduler(
+                lambda project, event: _submit_in_context(executor, project, event)
+            )
+            with log_context(correlation_id="abc"):
+                scheduler.submit(Project("foo"), {})
+            with log_context(correlation_id="def"):
+                scheduler.submit(Project("foo"), {})
+        self.assertEqual(correlation_ids, ["abc", "def"])
+
+
+class JsonFormatterTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.stream = io.StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.addFilter(LogContextFilter())
+        handler.setFormatter(JsonFormatter())
+        self.logger = logging.getLogger("pipedput.tests.log")
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def _get_records(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_record_contains_context_and_extra_fields(self):
+        with log_context(correlation_id="abc", pipeline_id=42):
+            self.logger.info("Uploaded %s.", "foo.deb", extra=dict(stdout=b"ok"))
+        (record,) = self._get_records()
+        self.assertEqual(record["message"], "Uploaded foo.deb.")
+        self.assertEqual(record["level"], "INFO")
+        self.assertEqual(record["correlation_id"], "abc")
+        self.assertEqual(record["pipeline_id"], 42)
+        self.assertEqual(record["stdout"], "ok")
+
+    def test_exceptions(self):
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            self.logger.exception("Failed.")
+        (record,) = self._get_records()
+        self.assertIn("ValueError: nope", record["exc_info"])
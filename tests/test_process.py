@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from pipedput.process import ProcessLimits, run
+
+
+class RunTest(unittest.TestCase):
+    def _python(self, code: str):
+        return [sys.executable, "-c", code]
+
+    def test_captures_output(self):
+        result = run(
+            self._python("import sys; print('out'); print('err', file=sys.stderr)")
+        )
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, b"out\n")
+        self.assertEqual(result.stderr, b"err\n")
+        self.assertGreater(result.duration, 0)
+        self.assertGreater(result.max_rss, 0)
+
+    def test_check(self):
+        cmd = self._python("import sys; print('failed'); sys.exit(3)")
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            run(cmd)
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.stdout, b"failed\n")
+        self.assertEqual(run(cmd, check=False).returncode, 3)
+
+    def test_cwd(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(self._python("import os; print(os.getcwd())"), cwd=tmp_dir)
+        self.assertEqual(result.stdout.decode().strip(), os.path.realpath(tmp_dir))
+
+    def test_output_is_bounded(self):
+        limits = ProcessLimits(max_output_bytes=100)
+        result = run(self._python("print('x' * 10000); print('end')"), limits=limits)
+        self.assertEqual(len(result.stdout), 100)
+        self.assertTrue(result.stdout.endswith(b"end\n"))
+
+    def test_timeout_kills_process_group(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            marker = os.path.join(tmp_dir, "marker")
+            # the child inherits the pipes and would keep them open
+            child = f"import time; time.sleep(2); open({marker!r}, 'w')"
+            code = (
+                "import subprocess, sys, time; "
+                f"subprocess.Popen([sys.executable, '-c', {child!r}]); "
+                "time.sleep(30)"
+            )
+            started_at = time.monotonic()
+            with self.assertRaises(subprocess.TimeoutExpired):
+                run(self._python(code), limits=ProcessLimits(timeout=0.5))
+            self.assertLess(time.monotonic() - started_at, 10)
+            time.sleep(2.5)
+            self.assertFalse(os.path.exists(marker))
+
+    def test_cpu_limit(self):
+        limits = ProcessLimits(max_cpu_seconds=1)
+        result = run(self._python("while True: pass"), limits=limits, check=False)
+        self.assertLess(result.returncode, 0)
+
+    def test_memory_limit(self):
+        limits = ProcessLimits(max_memory_bytes=256 * 1024 * 1024)
+        code = "data = bytearray(512 * 1024 * 1024)"
+        result = run(self._python(code), limits=limits, check=False)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn(b"MemoryError", result.stderr)
@@ -0,0 +1,80 @@
+import os
+from os.path import join
+import tempfile
+import unittest
+
+from flask import Flask
+
+from pipedput.reload import ConfigReloader
+from pipedput.utils import Configuration
+
+CONFIG_TEMPLATE = """
+from pipedput.conf import Project
+
+CONFIG_RELOAD_INTERVAL = 0
+PROJECTS = [{projects}]
+"""
+
+
+class ConfigReloaderTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.config_file = join(self._tmp_dir.name, "config.py")
+        self.app = Flask("pipedput-reload-test")
+        self.reloader = ConfigReloader(self.app, self.config_file)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def _write_config(self, content: str, mtime: int):
+        with open(self.config_file, "w") as config_file:
+            config_file.write(content)
+        os.utime(self.config_file, (mtime, mtime))
+
+    def _write_projects(self, *keys: str, mtime: int):
+        projects = ", ".join(f"Project({key!r})" for key in keys)
+        self._write_config(CONFIG_TEMPLATE.format(projects=projects), mtime)
+
+    def test_initial_load_fails_for_invalid_config(self):
+        self._write_config("FOO = 1", 1)
+        with self.assertRaises(Configuration.ConfigurationError):
+            self.reloader.load()
+
+    def test_reload_if_changed(self):
+        self._write_projects("foo", mtime=1)
+        self.reloader.load()
+        self.assertFalse(self.reloader.reload_if_changed())
+        old_project = self.reloader.projects.get("foo")
+        self._write_projects("foo", "bar", mtime=2)
+        self.assertTrue(self.reloader.reload_if_changed())
+        self.assertEqual(len(self.reloader.projects), 2)
+        self.assertIs(self.app.config, self.reloader.snapshot.config)
+        # projects from the previous configuration are left untouched
+        self.assertIsNot(old_project, self.reloader.projects.get("foo"))
+        self.assertEqual(old_project.key, "foo")
+
+    def test_invalid_config_keeps_current_snapshot(self):
+        self._write_projects("foo", mtime=1)
+        snapshot = self.reloader.load()
+        for mtime, content in enumerate(
+            ("raise RuntimeError()", CONFIG_TEMPLATE.format(projects="1")), start=2
+        ):
+            with self.subTest(content=content):
+                self._write_config(content, mtime)
+                with self.assertLogs("pipedput.reload", "ERROR"):
+                    self.assertFalse(self.reloader.reload_if_changed())
+                self.assertIs(self.reloader.snapshot, snapshot)
+                self.assertIs(self.app.config, snapshot.config)
+
+    def test_listeners_are_notified(self):
+        snapshots = []
+        self.reloader.add_listener(snapshots.append)
+        self._write_projects("foo", mtime=1)
+        self.reloader.load()
+        self._write_projects("bar", mtime=2)
+        self.reloader.reload_if_changed()
+        self.assertEqual(
+            [list(snapshot.projects)[0].key for snapshot in snapshots], ["foo", "bar"]
+        )
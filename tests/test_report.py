@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pipedput.handler import _report_deployments, Project
+from pipedput.hooks import DeploymentState
+from pipedput.report import DeploymentReport
+from tests.utils import css_query_select
+
+EVENT = {
+    "project": {"path_with_namespace": "foo/bar", "name": "bar", "web_url": ""},
+    "user": {"name": "Herbert", "email": "herbert@gitlab.localhost"},
+}
+
+
+def _success(asset: str, target_name: str = "deb repository", **kwargs):
+    return DeploymentState(target_name, True, notify=False, asset=asset, **kwargs)
+
+
+def _failure(asset: str, target_name: str = "deb repository", **kwargs):
+    return DeploymentState(target_name, False, notify=True, asset=asset, **kwargs)
+
+
+class DeploymentReportTest(unittest.TestCase):
+    def test_summary_per_hook(self):
+        report = DeploymentReport()
+        report.add(_success("a.changes", duration=1.5))
+        report.add(_failure("b.changes", duration=0.5, error=b"upload failed"))
+        report.add(_success("c.tar.gz", target_name="python repository"))
+        deb, python = report.summaries.values()
+        self.assertEqual((deb.succeeded, deb.failed, deb.duration), (1, 1, 2.0))
+        self.assertEqual(deb.assets, ["a.changes"])
+        self.assertEqual(deb.failures[0].asset, "b.changes")
+        self.assertEqual(deb.failures[0].error, "upload failed")
+        self.assertTrue(python.was_successful)
+        self.assertEqual((report.succeeded, report.failed), (2, 1))
+        self.assertTrue(report.notify)
+        self.assertFalse(report.was_successful)
+
+    def test_details_are_bounded(self):
+        report = DeploymentReport(max_listed_assets=2, max_failures=3)
+        for index in range(1000):
+            report.add(_success(f"{index}.changes"))
+            report.add(_failure(f"{index}.changes", error="x" * 10000))
+        summary = report.summaries["deb repository"]
+        self.assertEqual((summary.succeeded, summary.failed), (1000, 1000))
+        self.assertEqual(len(summary.assets), 2)
+        self.assertEqual(summary.unlisted_assets, 998)
+        self.assertEqual(len(summary.failures), 3)
+        self.assertEqual(summary.omitted_failures, 997)
+        self.assertLessEqual(
+            len(summary.failures[0].error), DeploymentReport.MAX_DETAIL_LENGTH + 1
+        )
+
+    def test_no_notification_for_quiet_successes(self):
+        report = DeploymentReport()
+        report.add(_success("a.changes"))
+        self.assertFalse(report.notify)
+
+
+@patch("pipedput.handler._send_report_mail")
+class ReportDeploymentsTest(unittest.TestCase):
+    def test_partial_results_and_error_are_merged(self, send_report_mail: MagicMock):
+        def deployments():
+            yield _success("a.changes")
+            raise RuntimeError("artifact download failed")
+
+        _report_deployments(Project("foo"), EVENT, deployments())
+        send_report_mail.assert_called_once()
+        render_template = send_report_mail.call_args.args[2]
+        html = render_template(project=Project("foo"))
+        self.assertIn("artifact download failed", css_query_select(html, "pre"))
+        self.assertIn("a.changes", css_query_select(html, "li.is-success small"))
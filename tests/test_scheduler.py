@@ -0,0 +1,176 @@
+from concurrent.futures import Future
+import unittest
+
+from pipedput.constraints import IsTag
+from pipedput.handler import Project
+from pipedput.scheduler import classify, DEFAULT_LANE, Lane, Scheduler
+
+
+class ManualExecutor:
+    """Records started jobs and lets the test decide when they are done."""
+
+    def __init__(self):
+        self.started = []
+        self._futures = []
+
+    def __call__(self, project, event) -> Future:
+        future = Future()
+        self.started.append((project.key, event))
+        self._futures.append(future)
+        return future
+
+    def finish(self, index=0):
+        self._futures.pop(index).set_result(None)
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_events_of_one_project_are_serialized(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, capacity=4)
+        project = Project("foo")
+        scheduler.submit(project, 1)
+        scheduler.submit(project, 2)
+        self.assertEqual(executor.started, [("foo", 1)])
+        self.assertEqual(scheduler.pending, 1)
+        executor.finish()
+        self.assertEqual(executor.started, [("foo", 1), ("foo", 2)])
+        self.assertEqual(scheduler.pending, 0)
+
+    def test_max_concurrent_runs(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, capacity=4)
+        project = Project("foo", max_concurrent_runs=2)
+        for event in range(3):
+            scheduler.submit(project, event)
+        self.assertEqual(executor.started, [("foo", 0), ("foo", 1)])
+
+    def test_projects_run_in_parallel(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, capacity=2)
+        for key in ("foo", "bar", "baz"):
+            scheduler.submit(Project(key), key)
+        self.assertEqual(executor.started, [("foo", "foo"), ("bar", "bar")])
+        self.assertEqual(scheduler.running, 2)
+
+    def test_projects_are_served_in_turns(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, capacity=1)
+        busy, other = Project("busy", max_concurrent_runs=4), Project("other")
+        for event in range(3):
+            scheduler.submit(busy, event)
+        scheduler.submit(other, "x")
+        for _ in range(3):
+            executor.finish()
+        self.assertEqual(
+            [key for key, _ in executor.started], ["busy", "other", "busy", "busy"]
+        )
+
+    def test_priority(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, capacity=1)
+        scheduler.submit(Project("first"), 1)
+        scheduler.submit(Project("low"), 2)
+        scheduler.submit(Project("high", priority=10), 3)
+        executor.finish()
+        executor.finish()
+        self.assertEqual([key for key, _ in executor.started], ["first", "high", "low"])
+
+    def test_synchronous_executor(self):
+        processed = []
+
+        def execute(project, event):
+            processed.append(event)
+            if event < 3:
+                scheduler.submit(project, event + 1)
+            future = Future()
+            future.set_result(None)
+            return future
+
+        scheduler = Scheduler(execute)
+        scheduler.submit(Project("foo"), 0)
+        self.assertEqual(processed, [0, 1, 2, 3])
+        self.assertEqual(scheduler.running, 0)
+
+    def test_failing_executor_frees_capacity(self):
+        def execute(project, event):
+            raise RuntimeError()
+
+        scheduler = Scheduler(execute)
+        with self.assertLogs("pipedput.scheduler", "ERROR"):
+            scheduler.submit(Project("foo"), 1)
+        self.assertEqual(scheduler.running, 0)
+
+    def test_submit_returns_future(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor)
+        first = scheduler.submit(Project("foo"), 1)
+        second = scheduler.submit(Project("bar"), 2)
+        self.assertFalse(first.done())
+        executor.finish()
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        executor.finish()
+        self.assertIsNone(second.result())
+
+    def test_lanes_are_weighted_fair(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, lanes=[Lane("release", weight=3)])
+        projects = [Project(f"project-{index}") for index in range(12)]
+        for index, project in enumerate(projects[:6]):
+            scheduler.submit(project, index)
+        for index, project in enumerate(projects[6:]):
+            scheduler.submit(project, f"tag-{index}", "release")
+        for _ in range(8):
+            executor.finish()
+        # the first event started right away, then three release events
+        # start for every other event
+        self.assertEqual(
+            [event for _, event in executor.started],
+            [0, "tag-0", "tag-1", "tag-2", "tag-3", 1, "tag-4", "tag-5", 2],
+        )
+
+    def test_idle_lanes_get_no_credit(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, lanes=[Lane("release", weight=2)])
+        scheduler.submit(Project("foo"), 0)
+        for index in range(1, 5):
+            scheduler.submit(Project(f"foo-{index}"), index)
+            executor.finish()
+        for index in range(4):
+            scheduler.submit(Project(f"bar-{index}"), f"tag-{index}", "release")
+        scheduler.submit(Project("foo-5"), 5)
+        for _ in range(5):
+            executor.finish()
+        # the release lane is served twice as often, but doesn’t catch up on
+        # the time it had no events
+        self.assertEqual(
+            [event for _, event in executor.started][4:],
+            [4, "tag-0", "tag-1", "tag-2", 5, "tag-3"],
+        )
+
+    def test_events_of_a_project_may_overtake_in_another_lane(self):
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, lanes=[Lane("release", weight=10)])
+        project = Project("foo")
+        scheduler.submit(project, 1)
+        scheduler.submit(project, 2)
+        scheduler.submit(project, "tag", "release")
+        executor.finish()
+        executor.finish()
+        self.assertEqual([event for _, event in executor.started], [1, "tag", 2])
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_first_matching_lane(self):
+        lanes = [Lane("release", 4, IsTag()), Lane("branch", 1)]
+        self.assertEqual(
+            classify(lanes, {"object_attributes": {"tag": True}}), "release"
+        )
+        self.assertEqual(
+            classify(lanes, {"object_attributes": {"tag": False}}), "branch"
+        )
+        self.assertEqual(classify([], {}), DEFAULT_LANE)
+
+    def test_weight_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            Lane("never", weight=0)
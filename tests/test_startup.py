@@ -0,0 +1,27 @@
+import os
+from os.path import join
+import unittest
+
+from benchmarks.startup import DEFAULT_BUDGET_MS, LAZY_MODULES, measure
+from tests.utils import FILES_DIR
+
+
+class StartupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.report = measure(config_file=join(FILES_DIR, "config.py"))
+
+    def test_lazy_modules_are_not_imported(self):
+        for module in LAZY_MODULES:
+            with self.subTest(module=module):
+                self.assertNotIn(module, self.report.imports)
+
+    # wall-clock limits are unreliable on slow or loaded machines, the time
+    # budget is enforced by benchmarks.startup
+    @unittest.skipUnless(
+        os.environ.get("PIPEDPUT_STARTUP_BUDGET_MS", None),
+        "set PIPEDPUT_STARTUP_BUDGET_MS to check the startup time",
+    )
+    def test_startup_within_budget(self):
+        self.assertLessEqual(self.report.total_ms, DEFAULT_BUDGET_MS)
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import unittest
+
+from pipedput import tracing
+from pipedput.instrumentation import stage
+from pipedput.tracing import FileSpanExporter, span, SpanContext, SpanExporter
+
+
+class MemorySpanExporter(SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTestMixin:
+    def setUp(self):
+        super().setUp()
+        self.exporter = MemorySpanExporter()
+        tracing.set_exporter(self.exporter)
+        self.addCleanup(tracing.set_exporter, None)
+
+
+class SpanContextTest(unittest.TestCase):
+    def test_traceparent_round_trip(self):
+        context = SpanContext("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331")
+        self.assertEqual(
+            context.traceparent,
+            "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01",
+        )
+        self.assertEqual(SpanContext.from_traceparent(context.traceparent), context)
+
+    def test_invalid_traceparent(self):
+        self.assertIsNone(SpanContext.from_traceparent(None))
+        self.assertIsNone(SpanContext.from_traceparent("00-abc-def-01"))
+
+
+class DisabledTracingTest(unittest.TestCase):
+    def test_span_is_noop(self):
+        self.assertFalse(tracing.is_enabled())
+        self.assertIs(span("foo", bar=1), tracing._NOOP)
+        with span("foo") as current_span:
+            self.assertIsNone(current_span)
+            self.assertIsNone(tracing.get_traceparent())
+
+
+class SpanTest(TracingTestMixin, unittest.TestCase):
+    def test_nested_spans(self):
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        with span("parent", traceparent=traceparent) as parent:
+            with span("child", foo="bar") as child:
+                self.assertEqual(tracing.get_traceparent(), child.context.traceparent)
+        self.assertIsNone(tracing.get_traceparent())
+        self.assertEqual(
+            [exported.name for exported in self.exporter.spans], ["child", "parent"]
+        )
+        self.assertEqual(parent.context.trace_id, "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(parent.parent_span_id, "b7ad6b7169203331")
+        self.assertEqual(child.context.trace_id, parent.context.trace_id)
+        self.assertEqual(child.parent_span_id, parent.context.span_id)
+        self.assertEqual(child.attributes, {"foo": "bar"})
+        self.assertGreaterEqual(parent.end_time_ns, child.end_time_ns)
+
+    def test_errors_are_recorded(self):
+        with self.assertRaises(ValueError):
+            with span("failing"):
+                raise ValueError("nope")
+        self.assertEqual(self.exporter.spans[0].error, "ValueError: nope")
+
+    def test_stages_are_traced(self):
+        with span("parent") as parent, stage("download", url="http://localhost"):
+            pass
+        download = self.exporter.spans[0]
+        self.assertEqual(download.name, "download")
+        self.assertEqual(download.parent_span_id, parent.context.span_id)
+        self.assertEqual(download.attributes, {"url": "http://localhost"})
+
+
+class FileSpanExporterTest(unittest.TestCase):
+    def test_spans_are_written_as_otlp_json(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "spans.jsonl")
+            tracing.set_exporter(FileSpanExporter(path))
+            self.addCleanup(tracing.set_exporter, None)
+            with span("foo", kind=tracing.SPAN_KIND_CLIENT, count=3):
+                pass
+            with span("bar"):
+                pass
+            with open(path) as span_file:
+                requests = [json.loads(line) for line in span_file]
+        self.assertEqual(len(requests), 2)
+        encoded_span = requests[0]["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        self.assertEqual(encoded_span["name"], "foo")
+        self.assertEqual(encoded_span["kind"], tracing.SPAN_KIND_CLIENT)
+        self.assertEqual(
+            encoded_span["attributes"], [{"key": "count", "value": {"intValue": "3"}}]
+        )
+        self.assertNotIn("parentSpanId", encoded_span)
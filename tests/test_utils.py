@@ -0,0 +1,199 @@
+import errno
+import os
+from os.path import join
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import zipfile
+
+from pipedput.utils import (
+    BinaryRegistry,
+    ExtractionLimits,
+    publish_file,
+    SQLiteDatabase,
+    unzip,
+)
+
+
+class BinaryRegistryTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.bin_path = join(self._tmp_dir.name, "tool")
+        with open(self.bin_path, "w") as bin_file:
+            bin_file.write("#!/bin/sh\n")
+        os.chmod(self.bin_path, 0o755)
+        self.registry = BinaryRegistry()
+        patcher = patch.dict(os.environ, {"PATH": self._tmp_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_resolve_once(self):
+        with patch("pipedput.utils.shutil.which", wraps=shutil.which) as which:
+            self.assertEqual(self.registry.resolve("tool"), self.bin_path)
+            self.assertEqual(self.registry.resolve("tool"), self.bin_path)
+            self.assertEqual(which.call_count, 1)
+            self.registry.clear()
+            self.registry.resolve("tool")
+            self.assertEqual(which.call_count, 2)
+
+    def test_resolve_again_if_binary_changed(self):
+        self.registry.resolve("tool")
+        with patch("pipedput.utils.shutil.which", wraps=shutil.which) as which:
+            os.utime(self.bin_path, ns=(0, 0))
+            self.assertEqual(self.registry.resolve("tool"), self.bin_path)
+            os.remove(self.bin_path)
+            self.assertIsNone(self.registry.resolve("tool"))
+            self.assertEqual(which.call_count, 2)
+
+    def test_resolve_again_if_path_changed(self):
+        self.registry.resolve("tool")
+        with patch.dict(os.environ, {"PATH": ""}):
+            self.assertIsNone(self.registry.resolve("tool"))
+
+
+class SQLiteDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.database = SQLiteDatabase(
+            join(self._tmp_dir.name, "db", "store.sqlite3"),
+            "CREATE TABLE IF NOT EXISTS items (value TEXT);",
+        )
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_connections_are_not_shared_between_threads(self):
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(self.database.connection)
+        )
+        thread.start()
+        thread.join()
+        self.assertIs(self.database.connection, self.database.connection)
+        self.assertIsNot(connections[0], self.database.connection)
+
+    def test_connections_do_not_survive_a_fork(self):
+        connection = self.database.connection
+        with patch("pipedput.utils.os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(self.database.connection, connection)
+
+    def test_schema(self):
+        with self.database.connection as connection:
+            connection.execute("INSERT INTO items VALUES ('a')")
+        self.assertEqual(
+            self.database.connect().execute("SELECT value FROM items").fetchall(),
+            [("a",)],
+        )
+
+
+class PublishFileTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.source = join(self._tmp_dir.name, "artifact.jpeg")
+        with open(self.source, "wb") as source_file:
+            source_file.write(os.urandom(256 * 1024))
+        os.chmod(self.source, 0o640)
+        self.destination_dir = join(self._tmp_dir.name, "backups")
+        os.mkdir(self.destination_dir)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def assertPublished(self, destination):
+        with open(self.source, "rb") as source_file, open(
+            destination, "rb"
+        ) as destination_file:
+            self.assertEqual(source_file.read(), destination_file.read())
+        self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0o640)
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(os.path.dirname(destination)), ["artifact.jpeg"])
+
+    def test_hardlink_into_directory(self):
+        method = publish_file(self.source, self.destination_dir)
+        destination = join(self.destination_dir, "artifact.jpeg")
+        self.assertEqual(method, "hardlink")
+        self.assertTrue(os.path.samefile(self.source, destination))
+        self.assertPublished(destination)
+
+    def test_fallback_without_hardlink(self):
+        destination = join(self.destination_dir, "artifact.jpeg")
+        method = publish_file(self.source, destination, allow_hardlink=False)
+        self.assertIn(method, ("reflink", "copy_file_range", "copy"))
+        self.assertFalse(os.path.samefile(self.source, destination))
+        self.assertPublished(destination)
+
+    def test_fallback_across_filesystems(self):
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+        destination = join(self.destination_dir, "artifact.jpeg")
+        with open(destination, "w") as destination_file:
+            destination_file.write("outdated")
+        with patch("os.link", side_effect=cross_device), patch(
+            "pipedput.utils._reflink", side_effect=cross_device
+        ), patch("os.copy_file_range", side_effect=cross_device, create=True):
+            method = publish_file(self.source, destination)
+        self.assertEqual(method, "copy")
+        self.assertPublished(destination)
+
+
+class UnzipTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.archive = join(self._tmp_dir.name, "artifacts.zip")
+        self.destination = join(self._tmp_dir.name, "data")
+        with zipfile.ZipFile(self.archive, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("dist/a/b/package.deb", b"\0" * 1024 * 1024)
+            archive.writestr("dist/README", b"read me")
+            archive.writestr("../../escape.txt", b"escape")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_unzip_within_limits(self):
+        unzip(
+            self.archive,
+            self.destination,
+            ExtractionLimits(max_bytes=2 * 1024 * 1024, max_members=3, max_depth=4),
+        )
+        self.assertEqual(
+            os.path.getsize(join(self.destination, "dist/a/b/package.deb")),
+            1024 * 1024,
+        )
+        # paths are sanitized like ZipFile.extractall does
+        self.assertTrue(os.path.exists(join(self.destination, "escape.txt")))
+        self.assertFalse(os.path.exists(join(self._tmp_dir.name, "escape.txt")))
+
+    def test_limits(self):
+        for limits in (
+            ExtractionLimits(max_bytes=1024),
+            ExtractionLimits(max_members=2),
+            ExtractionLimits(max_ratio=10),
+            ExtractionLimits(max_depth=3),
+        ):
+            with self.subTest(limits=limits):
+                with self.assertRaises(ExtractionLimits.Exceeded):
+                    unzip(self.archive, self.destination, limits)
+
+    def test_limit_is_enforced_while_streaming(self):
+        with self.assertRaises(ExtractionLimits.Exceeded):
+            unzip(self.archive, self.destination, ExtractionLimits(max_bytes=1000))
+        # nothing beyond the limit has been written
+        extracted_bytes = sum(
+            os.path.getsize(join(directory, filename))
+            for directory, _, filenames in os.walk(self.destination)
+            for filename in filenames
+        )
+        self.assertLessEqual(extracted_bytes, 1000)
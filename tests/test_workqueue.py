@@ -0,0 +1,165 @@
+from concurrent.futures import Future
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from pipedput.workqueue import (
+    FileQueueBackend,
+    QueueConsumer,
+    SQLiteQueueBackend,
+)
+
+
+class QueueBackendTestMixin:
+    def create_backend(self, directory, **kwargs):
+        raise NotImplementedError()
+
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.backend = self.create_backend(self._tmp_dir.name, lease_duration=60)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_items_are_claimed_in_order(self):
+        self.backend.put("foo", {"id": 1}, "abc", "00-trace", "release")
+        self.backend.put("bar", {"id": 2})
+        first = self.backend.claim("node-a", now=0)
+        second = self.backend.claim("node-b", now=0)
+        self.assertEqual(
+            (first.project_key, first.event, first.correlation_id, first.traceparent),
+            ("foo", {"id": 1}, "abc", "00-trace"),
+        )
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(first.lane, "release")
+        self.assertEqual((second.project_key, second.event), ("bar", {"id": 2}))
+        self.assertIsNone(self.backend.claim("node-c", now=0))
+        self.assertEqual(self.backend.count_pending(), 2)
+        self.backend.complete(first)
+        self.backend.complete(second)
+        self.assertEqual(self.backend.count_pending(), 0)
+
+    def test_expired_leases_are_delivered_again(self):
+        self.backend.put("foo", {"id": 1})
+        item = self.backend.claim("node-a", now=0)
+        self.assertTrue(self.backend.heartbeat(item, now=50))
+        self.assertIsNone(self.backend.claim("node-b", now=100))
+        redelivered = self.backend.claim("node-b", now=111)
+        self.assertEqual(redelivered.id, item.id)
+        self.assertEqual(redelivered.attempts, 2)
+        # the first node has lost its lease
+        self.assertFalse(self.backend.heartbeat(item, now=112))
+        self.backend.complete(item)
+        self.assertEqual(self.backend.count_pending(), 1)
+        self.backend.complete(redelivered)
+        self.assertEqual(self.backend.count_pending(), 0)
+
+    def test_released_items_are_available_again(self):
+        self.backend.put("foo", {"id": 1})
+        item = self.backend.claim("node-a", now=0)
+        self.backend.release(item)
+        item = self.backend.claim("node-b", now=0)
+        self.assertEqual(item.attempts, 1)
+
+    def test_items_are_dropped_after_max_attempts(self):
+        backend = self.create_backend(
+            self._tmp_dir.name, lease_duration=10, max_attempts=2
+        )
+        backend.put("foo", {"id": 1})
+        self.assertIsNotNone(backend.claim("node-a", now=0))
+        self.assertIsNotNone(backend.claim("node-b", now=11))
+        with self.assertLogs("pipedput.workqueue", "ERROR"):
+            self.assertIsNone(backend.claim("node-c", now=22))
+        self.assertEqual(backend.count_pending(), 0)
+
+
+class SQLiteQueueBackendTest(QueueBackendTestMixin, unittest.TestCase):
+    def create_backend(self, directory, **kwargs):
+        return SQLiteQueueBackend(os.path.join(directory, "queue.sqlite3"), **kwargs)
+
+
+class FileQueueBackendTest(QueueBackendTestMixin, unittest.TestCase):
+    def create_backend(self, directory, **kwargs):
+        return FileQueueBackend(os.path.join(directory, "queue"), **kwargs)
+
+    def test_old_pending_items_are_claimed_once(self):
+        item_id = self.backend.put("foo", {"id": 1})
+        path = self.backend._pending_path(item_id)
+        os.utime(path, (0, 0))
+        other_backend = self.create_backend(self._tmp_dir.name, lease_duration=60)
+        rename = os.rename
+        claimed_by_other = []
+
+        def rename_and_claim(source, destination):
+            rename(source, destination)
+            # another node scans the queue right after the item has been leased
+            if source == path:
+                claimed_by_other.append(other_backend.claim("node-b", now=1000))
+
+        with patch("pipedput.workqueue.os.rename", side_effect=rename_and_claim):
+            item = self.backend.claim("node-a", now=1000)
+        self.assertEqual(item.id, item_id)
+        self.assertEqual(claimed_by_other, [None])
+
+
+class QueueConsumerTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.backend = FileQueueBackend(self._tmp_dir.name, lease_duration=0.3)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_consumer_respects_capacity(self):
+        futures = []
+
+        def submit(item):
+            future = Future()
+            futures.append((item, future))
+            return future
+
+        consumer = QueueConsumer(self.backend, submit, capacity=2, poll_interval=0.01)
+        for event_id in range(3):
+            self.backend.put("foo", {"id": event_id})
+        consumer.start()
+        self.addCleanup(consumer.stop)
+        self._wait_for(lambda: len(futures) == 2)
+        time.sleep(0.05)
+        self.assertEqual(len(futures), 2)
+        futures[0][1].set_result(None)
+        self._wait_for(lambda: len(futures) == 3)
+        self.assertEqual([item.event["id"] for item, _ in futures], [0, 1, 2])
+        for _, future in futures[1:]:
+            future.set_result(None)
+        self._wait_for(lambda: self.backend.count_pending() == 0)
+
+    def test_running_items_keep_their_lease(self):
+        futures = []
+
+        def submit(item):
+            future = Future()
+            futures.append(future)
+            return future
+
+        self.backend.put("foo", {"id": 1})
+        consumer = QueueConsumer(self.backend, submit, poll_interval=0.01)
+        consumer.start()
+        self.addCleanup(consumer.stop)
+        self._wait_for(lambda: futures)
+        # the lease is renewed while the item is running
+        time.sleep(0.6)
+        self.assertIsNone(self.backend.claim("node-b"))
+        futures[0].set_result(None)
+        self._wait_for(lambda: self.backend.count_pending() == 0)
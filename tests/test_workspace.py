@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from pipedput.workspace import WorkspaceManager
+
+
+class WorkspaceManagerTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.manager = WorkspaceManager(
+            self._tmp_dir.name, expansion_factor=3, wait_timeout=5
+        )
+        # pretend that the filesystem has 1000 free bytes
+        usage = shutil.disk_usage(self._tmp_dir.name)._replace(free=1000)
+        patcher = patch("pipedput.workspace.shutil.disk_usage", return_value=usage)
+        self.disk_usage = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_workspace_is_removed(self):
+        with self.manager.acquire(100) as workspace:
+            self.assertTrue(os.path.isdir(workspace.path))
+            self.assertEqual(self.manager.reserved, 400)
+        self.assertFalse(os.path.exists(workspace.path))
+        self.assertEqual(self.manager.reserved, 0)
+
+    def test_reject_artifacts_that_never_fit(self):
+        with self.assertRaises(WorkspaceManager.InsufficientSpace):
+            self.manager.acquire(300)
+        self.manager.min_free_bytes = 700
+        with self.assertRaises(WorkspaceManager.InsufficientSpace):
+            self.manager.acquire(100)
+
+    def test_wait_for_space(self):
+        workspace = self.manager.acquire(200)
+        acquired = threading.Event()
+
+        def acquire():
+            with self.manager.acquire(200):
+                acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(acquired.is_set())
+        workspace.close()
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_wait_timeout(self):
+        self.manager.wait_timeout = 0.05
+        with self.manager.acquire(200):
+            with self.assertRaises(WorkspaceManager.InsufficientSpace):
+                self.manager.acquire(200)
+
+    def test_written_bytes_are_not_subtracted_twice(self):
+        workspace = self.manager.acquire(100)
+        with open(os.path.join(workspace.path, "artifact"), "wb") as artifact:
+            artifact.write(b"x" * 300)
+        # the written bytes are missing from the free space
+        self.disk_usage.return_value = self.disk_usage.return_value._replace(free=700)
+        # 700 free bytes minus the 100 bytes that haven’t been written yet
+        with self.manager.acquire(150):
+            self.assertEqual(self.manager.reserved, 1000)
+        workspace.close()
+
+    def test_workspaces_are_walked_without_holding_the_lock(self):
+        workspace = self.manager.acquire(100)
+        get_used_bytes = workspace.get_used_bytes
+
+        def check_lock():
+            # the lock can be acquired by another thread
+            thread = threading.Thread(target=self.manager._release_bytes, args=(0,))
+            thread.start()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+            return get_used_bytes()
+
+        with patch.object(workspace, "get_used_bytes", side_effect=check_lock) as walk:
+            with self.manager.acquire(100):
+                pass
+        self.assertEqual(walk.call_count, 1)
+        workspace.close()
+
+    def test_cleanup_orphans(self):
+        orphan = os.path.join(
+            self._tmp_dir.name, f"{WorkspaceManager.PREFIX}999999999-abc"
+        )
+        os.makedirs(os.path.join(orphan, "data"))
+        with self.manager.acquire() as workspace:
+            self.assertEqual(self.manager.cleanup_orphans(), 1)
+            self.assertFalse(os.path.exists(orphan))
+            self.assertTrue(os.path.exists(workspace.path))
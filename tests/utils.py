@@ -2,6 +2,7 @@ from contextlib import contextmanager
 import functools
 import glob
 from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
 import json
 import logging
 import os
@@ -9,7 +10,7 @@ from os.path import dirname, join
 import re
 import subprocess
 import threading
-from typing import Optional, Sequence
+from typing import Dict, Optional, Sequence
 from unittest.mock import MagicMock, patch
 
 import lxml.etree
@@ -83,12 +84,18 @@ def css_query_select(content, selector):
         return None
 
 
+class MockResponse(io.BytesIO):
+    def __init__(self, data: bytes, headers: Optional[Dict[str, str]] = None):
+        super().__init__(data)
+        self.headers = headers or {}
+
+
 class TestFileMock(MagicMock):
     def __init__(self, test_filename, *args, **kwargs):
         @contextmanager
         def side_effect(*args, **kwargs):
             with open(join(FILES_DIR, test_filename), "rb") as test_file:
-                yield test_file
+                yield MockResponse(test_file.read())
 
         super().__init__(*args, side_effect=side_effect, **kwargs)
 
@@ -133,7 +140,9 @@ class MockGitLabServer(BaseHTTPRequestHandler):
     close_connection = True
 
     ARTIFACTS_PATTERN = re.compile(r"jobs/(?P<build_id>[0-9]+)/artifacts$")
-    COMMIT_REFS_PATTERN = re.compile(r"commits/(?P<commit_sha>[a-zA-Z0-9]+)/refs$")
+    COMMIT_REFS_PATTERN = re.compile(
+        r"commits/(?P<commit_sha>[a-zA-Z0-9]+)/refs(\?.*)?$"
+    )
 
     @contextmanager
     def _find_artifact(self, build_id):
@@ -205,13 +214,28 @@ class MockGitLabServer(BaseHTTPRequestHandler):
         pass
 
 
-def start_gitlab_mock_server(daemonize=True):
-    mock_server = HTTPServer(
-        ("gitlab.localhost", HTTP_TEST_SERVER_PORT), MockGitLabServer
-    )
+def start_gitlab_mock_server(
+    daemonize=True,
+    handler_class=MockGitLabServer,
+    address=("gitlab.localhost", HTTP_TEST_SERVER_PORT),
+    server_class=HTTPServer,
+):
+    mock_server = server_class(address, handler_class)
     mock_server_thread = threading.Thread(target=mock_server.serve_forever)
-    mock_server_thread.setDaemon(daemonize)
+    mock_server_thread.daemon = daemonize
     mock_server_thread.start()
+    return mock_server
+
+
+_gitlab_mock_server = None
+
+
+def ensure_gitlab_mock_server():
+    """starts the mock server for the test suite unless it’s already running"""
+    global _gitlab_mock_server
+    if _gitlab_mock_server is None:
+        _gitlab_mock_server = start_gitlab_mock_server()
+    return _gitlab_mock_server
 
 
 if __name__ == "__main__":